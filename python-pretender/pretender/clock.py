@@ -0,0 +1,189 @@
+"""
+Monotonic, integer nanosecond timestamps, and the clocks of emulation.
+
+Recordings stamp every event with the number of nanoseconds since the
+recording started, taken from a monotonic clock so that they can't go
+backwards (or jump) when the wall clock is adjusted.
+
+When emulating, the models that depend on time (IncreasingModel, the
+interrupters) ask emulation_clock() what time it is: the wall clock, or (with
+G.CLOCK set to a VirtualClock) a clock that is driven by the MMIO accesses of
+the firmware.
+"""
+import ctypes
+import ctypes.util
+import heapq
+import logging
+import threading
+import time
+
+import pretender.globals as G
+
+logger = logging.getLogger(__name__)
+
+NS_PER_SECOND = 1000000000
+
+CLOCK_MONOTONIC = 1
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_nsec', ctypes.c_long)]
+
+
+def _find_clock_gettime():
+    for name in [ctypes.util.find_library('rt'),
+                 ctypes.util.find_library('c')]:
+        if name is None:
+            continue
+        try:
+            return ctypes.CDLL(name, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+    return None
+
+
+_clock_gettime = _find_clock_gettime()
+_timespec = _Timespec()
+
+
+def monotonic_ns():
+    """
+    Nanoseconds on the monotonic clock (the starting point is arbitrary, only
+    differences are meaningful)
+
+    :return:
+    """
+    if _clock_gettime is None or \
+            _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(_timespec)) != 0:
+        return int(time.time() * NS_PER_SECOND)
+    return _timespec.tv_sec * NS_PER_SECOND + _timespec.tv_nsec
+
+
+if _clock_gettime is None:
+    logger.warning("No monotonic clock available, timestamps will follow the "
+                   "wall clock")
+
+
+def to_seconds(ns):
+    """ Convert nanoseconds to (float) seconds """
+    return ns / float(NS_PER_SECOND)
+
+
+def from_seconds(seconds):
+    """ Convert (float) seconds to integer nanoseconds """
+    return int(round(float(seconds) * NS_PER_SECOND))
+
+
+class WallClock(object):
+    """
+    Real time: emulated peripherals see time go by like the firmware did when
+    it was recorded, however fast (or slow) the emulator is
+    """
+
+    def __repr__(self):
+        return "<WallClock>"
+
+    def time(self):
+        """ Seconds (float), only differences are meaningful """
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def tick(self, accesses=1):
+        """ The firmware accessed a peripheral (time goes on regardless) """
+        pass
+
+
+class VirtualClock(object):
+    """
+    Time that only goes by when the firmware accesses a (modeled) peripheral:
+    every access is seconds_per_access.  The emulator can then run as fast as
+    it can, and the same firmware sees the same timer values and interrupts
+    whatever the load of the host.
+
+    Something sleeping (e.g., an Interrupter) wakes up once enough accesses
+    have happened.  If the firmware stops accessing peripherals altogether
+    (e.g., it waits for the very interrupt that is sleeping), time skips ahead
+    to the earliest wake-up after idle_timeout (wall clock) seconds.
+    """
+
+    def __init__(self, seconds_per_access=1e-6, idle_timeout=0.1):
+        """
+        :param seconds_per_access: How much time goes by with every access
+        :param idle_timeout: Wall clock seconds without any access before
+        skipping ahead (None: never)
+        """
+        self.seconds_per_access = seconds_per_access
+        self.idle_timeout = idle_timeout
+        self.accesses = 0
+        self._now = 0.0
+        # Time skipped while idle (or advance()d)
+        self._skipped = 0.0
+        self._wakeups = []
+        self._cond = threading.Condition()
+
+    def __repr__(self):
+        return "<VirtualClock %fs (%d accesses)>" % (self._now, self.accesses)
+
+    def time(self):
+        """ Seconds (float) since the clock was created """
+        return self._now
+
+    def tick(self, accesses=1):
+        """
+        The firmware accessed a peripheral
+
+        :param accesses: How many accesses
+        :return:
+        """
+        with self._cond:
+            self.accesses += accesses
+            self._now = self.accesses * self.seconds_per_access + self._skipped
+            if self._wakeups and self._now >= self._wakeups[0]:
+                self._cond.notify_all()
+
+    def advance(self, seconds):
+        """ Let some time go by (without any access) """
+        with self._cond:
+            self._skipped += seconds
+            self._now += seconds
+            self._cond.notify_all()
+
+    def sleep(self, seconds):
+        """
+        Wait until seconds have gone by on this clock
+
+        :param seconds:
+        :return:
+        """
+        with self._cond:
+            wakeup = self._now + seconds
+            heapq.heappush(self._wakeups, wakeup)
+            try:
+                while self._now < wakeup:
+                    accesses = self.accesses
+                    self._cond.wait(self.idle_timeout)
+                    if self.accesses == accesses and self._now < wakeup and \
+                            self.idle_timeout is not None:
+                        # Nothing is going on, go to the next wake-up (which
+                        # may be someone else's)
+                        skip = self._wakeups[0] - self._now
+                        if skip > 0:
+                            self._skipped += skip
+                            self._now += skip
+                            self._cond.notify_all()
+            finally:
+                self._wakeups.remove(wakeup)
+                heapq.heapify(self._wakeups)
+
+
+def emulation_clock():
+    """ The clock of emulated peripherals (G.CLOCK, or the wall clock) """
+    if G.CLOCK is None:
+        return WALL_CLOCK
+    return G.CLOCK
+
+
+WALL_CLOCK = WallClock()
@@ -2,33 +2,58 @@ import numpy as np
 import sys
 import logging
 
-from sklearn.cluster import DBSCAN
-from sklearn import metrics
-
 logger = logging.getLogger(__name__)
 
-def cluster_peripherals(data):
-    mem_locs = np.array(data).reshape(-1, 1)
-    db = DBSCAN(eps=0x100, min_samples=1).fit(mem_locs)
-    core_samples_mask = np.zeros_like(db.labels_, dtype=bool)
-    core_samples_mask[db.core_sample_indices_] = True
-    labels = db.labels_
+# Addresses more than this far apart belong to different peripherals
+CLUSTER_GAP = 0x100
+
+
+def cluster_peripherals(data, gap=CLUSTER_GAP, return_intervals=False):
+    """
+    Group memory addresses into peripherals.
+
+    In one dimension, density-based clustering that is happy with single
+    points (what we used to do, with DBSCAN(eps=0x100, min_samples=1)) just
+    splits the sorted addresses wherever two neighbours are more than gap
+    apart, so that is what we do.  Clusters are numbered in the order in
+    which their first address shows up in the data, like DBSCAN did.
 
-    # Number of clusters in labels, ignoring noise if present.
-    n_clusters_ = len(set(labels)) - (1 if -1 in labels else 0)
+    :param data: Addresses (duplicates are fine)
+    :param gap: Largest distance between neighbours in a cluster
+    :param return_intervals: Also return the interval table
+    :return: {cluster number: set of addresses}, and if return_intervals,
+    (starts, ends, labels): the first and last address of every cluster
+    (sorted by address, so that an address can be looked up with
+    searchsorted()) and its cluster number
+    """
+    mem_locs = np.asarray(data, dtype=np.int64).ravel()
+    order = np.argsort(mem_locs, kind='mergesort')
+    locs = mem_locs[order]
+
+    # Where does a new cluster start?
+    breaks = np.flatnonzero(np.diff(locs) > gap) + 1
+    group = np.zeros(len(locs), dtype=np.intp)
+    group[breaks] = 1
+    group = np.cumsum(group)
+    n_clusters_ = len(breaks) + 1 if len(locs) else 0
+
+    # Number them by their first appearance
+    first = np.full(n_clusters_, len(locs), dtype=np.intp)
+    np.minimum.at(first, group, order)
+    labels = np.empty(n_clusters_, dtype=np.intp)
+    labels[np.argsort(first, kind='mergesort')] = np.arange(n_clusters_)
 
     print('Estimated number of clusters: %d' % n_clusters_)
-    cluster_dict = {i: mem_locs[db.labels_ == i] for i in xrange(n_clusters_)}
-    for n, cluster in cluster_dict.items():
-        locs = set([x[0] for x in cluster.tolist()])
-        logger.debug("Addresses in Cluster %d: %s" % (n, repr([hex(x) for x in
-                                                          locs])))
-    # Um, scikit, this is not how you organize data.
     clusters = {}
-    for k, v in cluster_dict.items():
-        s = v.tolist()
-        t = [u[0] for u in s]
-        clusters[k] = set(t)
+    for label, cluster in zip(labels.tolist(), np.split(locs, breaks)):
+        clusters[label] = set(cluster.tolist())
+        logger.debug("Addresses in Cluster %d: %s" % (
+            label, repr([hex(x) for x in clusters[label]])))
+
+    if return_intervals:
+        starts = locs[np.r_[0, breaks]] if n_clusters_ else locs
+        ends = locs[np.r_[breaks - 1, -1]] if n_clusters_ else locs
+        return clusters, (starts, ends, labels)
     return clusters
 
 
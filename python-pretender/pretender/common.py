@@ -127,18 +127,18 @@ def add_partial_model(avatar, emulator, hardware, model_fn, base=0x40000000,
     # Load the model
     with open(model_fn, 'rb') as f:
         pm = pickle.load(f)
-        good_models = set()
+        good_models = {}
         for m in pm.values():
             mdl = m['model']
             if mdl.irq_num and mdl.interrupt_timings and mdl.interrupt_trigger:
-                good_models.add(mdl.min_addr())
+                good_models[mdl.min_addr()] = mdl
         cur_addr = base
         count = 0
         # For each range we're going to not forward, add a forwarded range under it, then add the range.
         # Add a final range to fill up the rest
-        l.info("Going to use models at %s" % repr(good_models))
-        for min_addr in sorted(list(good_models)):
-            mdl = pm[min_addr]['model']
+        l.info("Going to use models at %s" % repr(sorted(good_models)))
+        for min_addr in sorted(good_models):
+            mdl = good_models[min_addr]
             cur_size = mdl.min_addr() - cur_addr
             cur_size &= 0xfffff000
             if cur_size > 0:
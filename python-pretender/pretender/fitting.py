@@ -0,0 +1,300 @@
+"""
+Fitting models to read logs.
+
+A read log is fitted by trying candidate models in priority order and keeping
+the first one that accepts it.  The read log is summarized once (a ReadStats)
+and every candidate gets that summary, so most of them can turn the read log
+down (or train) without going through it again.  A FitScheduler collects these
+fits (e.g., from every state of every peripheral) and, given more than one
+job, fans every (read log, candidate) pair out over a pool of processes.  The
+model of each fit is still the first acceptable candidate in priority order,
+so the result does not depend on the number of jobs, or on which fit finishes
+first.
+
+Fits can also be remembered on disk (G.FIT_CACHE, a FitCache), since many
+states (configuration registers, constant status bits, ...) see exactly the
+same reads in every run, and every build of a firmware.
+"""
+import errno
+import hashlib
+import logging
+import multiprocessing
+import os
+import pickle
+import tempfile
+
+import numpy
+
+import pretender.globals as G
+from pretender.readlog import ReadStats, log_columns
+
+logger = logging.getLogger(__name__)
+
+# The fits being run by a pool.  The workers are forked once this is set, so
+# they get the read logs without them being pickled for every candidate.
+_pending = None
+
+
+def fit_model(candidates, read_log, stats=None):
+    """
+    The first candidate that accepts the read log
+
+    :param candidates: Model classes, in priority order
+    :param read_log:
+    :param stats: ReadStats of the read log (if we have them already)
+    :return: The trained model, or None
+    """
+    if stats is None:
+        stats = ReadStats(read_log)
+    cache = G.FIT_CACHE
+    if cache is not None:
+        hit, m = cache.get(candidates, read_log, stats)
+        if hit:
+            return m
+    m = _fit(candidates, read_log, stats)
+    if cache is not None:
+        cache.put(candidates, read_log, m, stats)
+    return m
+
+
+def _fit(candidates, read_log, stats):
+    for model in candidates:
+        m = model()
+        logger.debug("Trying model %s" % repr(m))
+        if m.train(read_log, stats):
+            return m
+    return None
+
+
+class FitCache(object):
+    """
+    Fitted models on disk, keyed by a digest of the candidate models and of
+    the read log.
+
+    Most models only look at the read values (and how many times in a row
+    they were read), so that is what the key is made of.  Models that also
+    look at the timestamps (uses_timestamps) are kept under a key that also
+    has the timestamps, and the first key just says so.
+    """
+    # Bump this when a model changes how it trains
+    # 3: IncreasingModel fits every read (not the first 1000), and takes
+    #    outliers out in batches
+    VERSION = 3
+
+    def __init__(self, directory, min_reads=64):
+        """
+        :param directory:
+        :param min_reads: Don't bother with read logs shorter than this
+        (fitting them is cheaper than looking them up)
+        """
+        self.directory = directory
+        self.min_reads = min_reads
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "<FitCache %s (%d hits, %d misses)>" % (self.directory,
+                                                       self.hits, self.misses)
+
+    def _value_digest(self, candidates, stats):
+        digest = hashlib.sha1("%d:%s:%d" % (
+            self.VERSION,
+            ",".join("%s.%s" % (c.__module__, c.__name__) for c in
+                     candidates),
+            len(stats.runs)))
+        digest.update(numpy.column_stack(stats.run_columns()).astype(
+            numpy.uint64).tobytes())
+        return digest
+
+    @staticmethod
+    def _time_key(digest, read_log):
+        digest = digest.copy()
+        # (The same bytes as (timestamp, last_timestamp) pairs of floats)
+        times = numpy.column_stack(log_columns(
+            read_log, 'timestamp', 'last_timestamp')).astype(numpy.float64)
+        digest.update(times.tobytes())
+        return digest.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key[:2], key + ".pickle")
+
+    def _load(self, key):
+        try:
+            with open(self._filename(key), 'rb') as f:
+                return pickle.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning("Could not read fit %s: %s" % (key, e))
+        except Exception as e:
+            logger.warning("Ignoring broken fit %s: %s" % (key, e))
+        return None
+
+    def _save(self, key, entry):
+        filename = self._filename(key)
+        directory = os.path.dirname(filename)
+        try:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Write it next to where it goes and rename it, so that nobody ever
+        # reads half of it
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, filename)
+
+    def get(self, candidates, read_log, stats):
+        """
+        :param candidates: Model classes, in priority order
+        :param read_log:
+        :param stats: ReadStats of the read log
+        :return: (True, model (or None if no candidate accepted the read
+        log)) if we've seen this fit before, else (False, None)
+        """
+        if len(read_log) < self.min_reads:
+            return False, None
+        digest = self._value_digest(candidates, stats)
+        entry = self._load(digest.hexdigest())
+        if entry is not None and entry[0] == 'timestamps':
+            entry = self._load(self._time_key(digest, read_log))
+        if entry is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, entry[1]
+
+    def put(self, candidates, read_log, m, stats):
+        """
+        Remember a fit
+
+        :param candidates: Model classes, in priority order
+        :param read_log:
+        :param m: The model that was fitted (or None)
+        :param stats: ReadStats of the read log
+        :return:
+        """
+        if len(read_log) < self.min_reads:
+            return
+        digest = self._value_digest(candidates, stats)
+        if getattr(m, 'uses_timestamps', False):
+            self._save(digest.hexdigest(), ('timestamps', None))
+            self._save(self._time_key(digest, read_log), ('model', m))
+        else:
+            self._save(digest.hexdigest(), ('model', m))
+
+
+class FitScheduler(object):
+    """
+    Collects fits, and runs them all at once
+    """
+
+    def __init__(self, jobs=1):
+        """
+        :param jobs: Number of processes (None: one per core, 1: fit them
+        here, one after the other)
+        """
+        self.jobs = jobs
+        self.pending = []
+
+    def __len__(self):
+        return len(self.pending)
+
+    def submit(self, read_log, candidates, callback, stats=None):
+        """
+        Schedule a fit
+
+        :param read_log:
+        :param candidates: Model classes, in priority order
+        :param callback: Called (by run()) with the model, or None if no
+        candidate accepted the read log
+        :param stats: ReadStats of the read log (if we have them already)
+        :return:
+        """
+        if stats is None:
+            stats = ReadStats(read_log)
+        self.pending.append((read_log, candidates, callback, stats))
+
+    def run(self):
+        """ Run every scheduled fit, and hand the models to the callbacks """
+        pending, self.pending = self.pending, []
+        cache = G.FIT_CACHE
+        if cache is not None:
+            misses = []
+            for fit in pending:
+                read_log, candidates, callback, stats = fit
+                hit, m = cache.get(candidates, read_log, stats)
+                if hit:
+                    callback(m)
+                else:
+                    misses.append(fit)
+            pending = misses
+        jobs = self.jobs
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+        tasks = [(i, c) for i, (read_log, candidates, callback, stats) in
+                 enumerate(pending) for c in xrange(len(candidates))]
+        jobs = max(1, min(jobs, len(tasks)))
+
+        if jobs == 1:
+            for read_log, candidates, callback, stats in pending:
+                m = _fit(candidates, read_log, stats)
+                if cache is not None:
+                    cache.put(candidates, read_log, m, stats)
+                callback(m)
+            return
+
+        # The biggest read logs first, so that a big one isn't left for last
+        tasks.sort(key=lambda task: -len(pending[task[0]][0]))
+        logger.info("Fitting %d models (%d candidates, %d jobs)" % (
+            len(pending), len(tasks), jobs))
+        global _pending
+        _pending = pending
+        try:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                # (map_async() so that a KeyboardInterrupt gets through)
+                results = pool.map_async(
+                    _fit_candidate, tasks,
+                    chunksize=max(1, len(tasks) // (jobs * 16))).get(2 ** 31)
+            finally:
+                pool.terminate()
+                pool.join()
+        finally:
+            _pending = None
+
+        fitted = dict(zip(tasks, results))
+        for i, (read_log, candidates, callback, stats) in enumerate(pending):
+            m = None
+            for c in xrange(len(candidates)):
+                error, m = fitted[(i, c)]
+                if error is not None:
+                    # Only if we would have gotten to this candidate
+                    raise error
+                if m is not None:
+                    break
+            if cache is not None:
+                cache.put(candidates, read_log, m, stats)
+            callback(m)
+
+
+def _fit_candidate(task):
+    """
+    Train one candidate model on one read log (in a worker process)
+
+    :return: (exception, None) if it failed, else (None, the model if it
+    accepted the read log or None)
+    """
+    i, c = task
+    read_log, candidates, callback, stats = _pending[i]
+    m = candidates[c]()
+    logger.debug("Trying model %s" % repr(m))
+    try:
+        if m.train(read_log, stats):
+            return None, m
+    except Exception as e:
+        # Candidates that come after the accepted one are trained too, their
+        # errors must not fail the fit
+        return e, None
+    return None, None
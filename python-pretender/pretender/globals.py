@@ -1,5 +1,15 @@
 RECORDING_EXTENSION = "tsv"
+BINARY_RECORDING_EXTENSION = "trace"
+COMPRESSED_RECORDING_EXTENSION = "tracez"
+TRACE_COMPRESSION = "zlib"
+TRACE_BLOCK_RECORDS = 4096
 MODEL_FILE = "model.pickle"
+RECORDING_SET_FILE = "recordings.json"
+FIT_CACHE_DIR = "fit_cache"
+FIT_CACHE = None
+CLOCK = None
+READ_LOG_SPILL_DIR = None
+READ_LOG_SPILL_ENTRIES = 1 << 20
 COVERAGE_LOG = None
 MEM_LOG = None
 MODEL = None
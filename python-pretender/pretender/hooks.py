@@ -4,36 +4,87 @@ import os
 import pretender.globals as G
 import logging
 from pretender.logger import LogWriter
+from pretender.clock import emulation_clock, monotonic_ns
 import time
 
 l = logging.getLogger("pretender.hooks")
 logger = l
 seq = 0
+# Timestamps are recorded in nanoseconds (on the monotonic clock) relative to
+# this, see start_clock()
+time_start = 0
+# Coalesce consecutive identical reads (e.g., polling a status register) into
+# a READ row followed by a RUN row, see flush_reads()
+coalesce_reads = True
+# The run of reads that we are in: [(address, value, pc, size), seq of the
+# last read, timestamp of the last read, number of reads]
+read_run = None
 
 ignored_ranges = []
 
 
+def start_clock():
+    """ Start counting timestamps from now """
+    global time_start
+    time_start = monotonic_ns()
+
+
+def now():
+    """ Nanoseconds since start_clock() """
+    return monotonic_ns() - time_start
+
+
 def record_read_after(avatar, message, **kwargs):
     """
     prints our read message
     see avatar.ui.message.py
+
+    NOTE: This is on the path of every forwarded access, so keep it cheap.
+    The row is just queued if G.MEM_LOG is an AsyncLogWriter, and we don't
+    format log messages unless they will be shown.
     """
-    global seq
+    global seq, read_run
     _, val, success = kwargs['watched_return']
 
     if not message.dst or 'model' in message.dst.name:
-        l.debug("IGNR:  %s (%s, %s) @ %s" % (message, hex(message.address), val,
-                                             hex(message.pc)))
+        l.debug("IGNR:  %s (%#x, %s) @ %#x", message, message.address, val,
+                message.pc)
     else:
-        l.debug("READ:  %s (%s, %s) @ %s" % (message, hex(message.address), val,
-                                             hex(message.pc)))
-        G.MEM_LOG.write_row(
-            ['READ',seq, message.address, val, message.pc, message.size,
-             time.time()])
+        l.debug("READ:  %s (%#x, %s) @ %#x", message, message.address, val,
+                message.pc)
+        timestamp = now()
+        key = (message.address, val, message.pc, message.size)
+        if read_run is not None and read_run[0] == key:
+            # Same read again, just extend the run
+            read_run[1] = seq
+            read_run[2] = timestamp
+            read_run[3] += 1
+        else:
+            flush_reads()
+            G.MEM_LOG.write_row(
+                ['READ',seq, message.address, val, message.pc, message.size,
+                 timestamp])
+            if coalesce_reads:
+                read_run = [key, seq, timestamp, 1]
         # pprint.pprint(kwargs)
         seq += 1
 
 
+def flush_reads():
+    """
+    Write out the run of identical reads that we are in, if any.  This must
+    be called before anything else is logged, and before closing the log.
+    """
+    global read_run
+    if read_run is None:
+        return
+    (address, val, pc, size), last_seq, timestamp, count = read_run
+    read_run = None
+    if count > 1:
+        G.MEM_LOG.write_row(['RUN', last_seq, address, val, pc, size,
+                             timestamp])
+
+
 def record_write_after(avatar, message, **kwargs):
     """
     prints our write message
@@ -42,14 +93,15 @@ def record_write_after(avatar, message, **kwargs):
     global seq
     _, val, success = kwargs['watched_return']
     if not message.dst or "model" in message.dst.name:
-        l.debug("IGNW %s (%s,%s) @ %s" % (message, hex(message.address),
-                                           message.value, hex(message.pc)))
+        l.debug("IGNW %s (%#x,%s) @ %#x", message, message.address,
+                message.value, message.pc)
     else:
-        l.debug("WRITE %s (%s,%s) @ %s" % (message, hex(message.address),
-                                         message.value, hex(message.pc)))
+        l.debug("WRITE %s (%#x,%s) @ %#x", message, message.address,
+                message.value, message.pc)
+        flush_reads()
         G.MEM_LOG.write_row(
             ['WRITE', seq, message.address, message.value, message.pc,
-             message.size, time.time()])
+             message.size, now()])
         # pprint.pprint(kwargs)
         seq += 1
 
@@ -60,7 +112,8 @@ def record_interrupt_enter(avatar, message, **kwargs):
     #isr = message.origin.protocols.interrupts.get_current_isr_num()
     isr = message.interrupt_num
     # TODO: Fill this out with something more intelligent
-    G.MEM_LOG.write_row(['ENTER', seq, isr, 0, 0, 0, time.time()])
+    flush_reads()
+    G.MEM_LOG.write_row(['ENTER', seq, isr, 0, 0, 0, now()])
     l.warning\
         ("ENTER %s %s" % (hex(isr), message))
     seq += 1
@@ -71,7 +124,8 @@ def record_interrupt_exit(avatar, message, **kwargs):
     # TODO: Fill this out with something more intelligent
 
     isr = message.interrupt_num
-    G.MEM_LOG.write_row(['EXIT', seq, isr, 0, 0, 0, time.time()])
+    flush_reads()
+    G.MEM_LOG.write_row(['EXIT', seq, isr, 0, 0, 0, now()])
     l.warning("EXIT %s %s" % (hex(isr), message))
     seq += 1
 
@@ -79,7 +133,7 @@ def record_interrupt_exit(avatar, message, **kwargs):
 def record_interrupt_return(avatar, message, **kwargs):
     # TODO: Actually make this work, return is different from exit
     # TODO: Fill this out with something more intelligent
-    G.MEM_LOG.write_row(['EXIT', message.id, isr, 0, 0, 0, time.time()])
+    G.MEM_LOG.write_row(['EXIT', message.id, isr, 0, 0, 0, now()])
     l.debug("RETURN %s %s" % (hex(isr), message))
 
 
@@ -93,7 +147,7 @@ def emulate_interrupt_enter(avatar, message, **kwargs):
     print message
     # isr = message.origin.protocols.interrupts.get_current_isr_num()
     # TODO: Fill this out with something more intelligent
-    G.OUTPUT_TSV.write_row(['ENTER', message.id, message.interrupt_num, 0, 0, 0, time.time()])
+    G.OUTPUT_TSV.write_row(['ENTER', message.id, message.interrupt_num, 0, 0, 0, now()])
     # l.warning("ENTER %s %s" % (hex(isr), message))
     # seq += 1
 
@@ -111,7 +165,7 @@ def emulate_interrupt_enter_alt(irq_num, **kwargs):
 def emulate_interrupt_exit(avatar, message, **kwargs):
     print message
     # TODO: Fill this out with something more intelligent
-    G.OUTPUT_TSV.write_row(['EXIT', message.id, message.interrupt_num, 0, 0, 0, time.time()])
+    G.OUTPUT_TSV.write_row(['EXIT', message.id, message.interrupt_num, 0, 0, 0, now()])
     l.warning("EXIT %s %s" % (hex(message.interrupt_num), message))
 
 
@@ -145,6 +199,8 @@ def emulate_read_after(avatar, message, **kwargs):
     see avatar.ui.message.py
     """
     _, val, success = kwargs['watched_return']
+    # (Here rather than in a model, so that time goes by whatever the model)
+    emulation_clock().tick()
     # logger.info("READ:  %s (%s, %s)" % (message, hex(message.address), val))
 
     # print "REAL: %s, %s" % (hex(message.address), val)
@@ -178,6 +234,7 @@ def emulate_write_after(avatar, message, **kwargs):
     _, val, success = kwargs['watched_return']
     if message.address > 0xe0000000:
         return
+    emulation_clock().tick()
     try:
         mdl_name = message.dst.python_peripheral.get_model(message.address)
     except:
@@ -3,11 +3,12 @@ import logging
 logger = logging.getLogger(__name__)
 from threading import Thread, Event
 from avatar2 import TargetStates
-import time
+from pretender.clock import emulation_clock
 from pretender.hooks import emulate_interrupt_enter_alt
 
 class StatefulInterrupter(Thread):
     host = None
+    clock = None  # What time it is (None: emulation_clock())
 
     def __init__(self, irq_num, trigger, timings):
         self.irq_num = irq_num
@@ -17,6 +18,7 @@ class StatefulInterrupter(Thread):
         self.interrupt_now = Event()
         self.started = Event()
         self._shutdown = Event()
+        self.last_sent = None
         logger.debug("Creating Interrupter for IRQ %d" % self.irq_num)
         Thread.__init__(self)
 
@@ -30,6 +32,7 @@ class StatefulInterrupter(Thread):
         self.started.set()
         if not self.host:
             raise RuntimeError("Must set host first")
+        clock = self.clock or emulation_clock()
         ignored = False
         while not self._shutdown.is_set():
             self.interrupt_now.wait()
@@ -39,7 +42,11 @@ class StatefulInterrupter(Thread):
                 self.host.protocols.interrupts.ignore_interrupt_return(
                     self.irq_num)
                 ignored = True
-            logger.info("Sending IRQ %d" % self.irq_num)
+            # (The trace says when, so there's no waiting, but keep track of
+            # when it was on the same clock as everything else)
+            self.last_sent = clock.time()
+            logger.info("Sending IRQ %d (at %f)" % (self.irq_num,
+                                                    self.last_sent))
             self.host.protocols.interrupts.inject_interrupt(self.irq_num)
             self.interrupt_now.clear()
             """
@@ -58,6 +65,7 @@ class StatefulInterrupter(Thread):
 
 class Interrupter(Thread):
     host = None  # The host to be interrupted. MUST SET AT RUNTIME
+    clock = None  # What time it is (None: emulation_clock())
 
     # This is probably a QemuTarget
 
@@ -78,6 +86,7 @@ class Interrupter(Thread):
         self.started.set()
         if not self.host:
             raise RuntimeError("Must set host first")
+        clock = self.clock or emulation_clock()
         ignored = False
         while not self._shutdown.is_set():
             t = 0
@@ -88,7 +97,7 @@ class Interrupter(Thread):
                 #    ignored = True
                 next_time = self.timings[t]
                 logger.info("[%d] Sleeping for %f" % (self.irq_num, next_time))
-                time.sleep(next_time)
+                clock.sleep(next_time)
                 # DO IT
                 logger.info("Sending IRQ %d" % self.irq_num)
                 self.host.protocols.interrupts.inject_interrupt(self.irq_num)
@@ -1,11 +1,926 @@
+import collections
 import csv
+import logging
+import os
+import pickle
+import struct
+import time
+import zlib
+from array import array
+from bisect import bisect_right
+from threading import Thread, Event, Condition, Lock
+
+import numpy
+
+import pretender.globals as G
+from pretender.clock import from_seconds, to_seconds
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+logger = logging.getLogger(__name__)
+
+#
+# Binary trace format
+#
+# A binary trace is a small fixed-size header followed by one fixed-width
+# record per MMIO event.  Records hold the same fields as a row of our
+# tab-separated logs (op, seq, addr, val, pc, size, timestamp), but already
+# typed, so they can be read back with a single numpy.fromfile() (or mapped
+# with numpy.memmap) instead of being parsed line by line.
+#
+# Timestamps are integer nanoseconds since the recording started (the time
+# base in the header says when that was, on the wall clock).  Version 1
+# traces had float seconds instead, and are converted when they are read.
+#
+BINARY_MAGIC = "PTRC"
+BINARY_VERSION = 2
+
+# magic, version, record size, flags, time base
+HEADER_FORMAT = "<4sHHId12x"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# op, size, (pad), addr, val, pc, seq, timestamp
+RECORD_FORMAT = "<BBxxIIIQq"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+RECORD_DTYPE = numpy.dtype([('op', '<u1'),
+                            ('size', '<u1'),
+                            ('pad', '<u2'),
+                            ('addr', '<u4'),
+                            ('val', '<u4'),
+                            ('pc', '<u4'),
+                            ('seq', '<u8'),
+                            ('timestamp', '<i8')])
+assert RECORD_DTYPE.itemsize == RECORD_SIZE
+
+# Version 1 (float seconds)
+RECORD_FORMAT_V1 = "<BBxxIIIQd"
+RECORD_DTYPE_V1 = numpy.dtype([(name, 'f8' if name == 'timestamp' else t)
+                               for name, t in RECORD_DTYPE.descr])
+assert RECORD_DTYPE_V1.itemsize == RECORD_SIZE
+
+OP_READ = 0
+OP_WRITE = 1
+OP_ENTER = 2
+OP_EXIT = 3
+# A run of identical reads: the READ row just before it was repeated, at the
+# same address, value and pc, up to this row's seq and timestamp
+OP_RUN = 4
+OP_NAMES = ['READ', 'WRITE', 'ENTER', 'EXIT', 'RUN']
+OP_CODES = {name: code for code, name in enumerate(OP_NAMES)}
+
+
+#
+# Block-compressed traces
+#
+# The same records, grouped into blocks of a few thousand events that are
+# compressed independently.  Every block starts with a small header saying
+# which sequence numbers and timestamps it covers, and a block index at the
+# end of the file (rebuilt by scanning the block headers if the recording
+# was cut short) lets a reader seek to any block without decompressing the
+# ones before it.
+#
+# Inside a block the records are stored column by column, with the sequence
+# numbers and timestamps delta-encoded and the bytes of every column
+# shuffled (all the first bytes, then all the second bytes, ...), which is
+# what makes them compress well.
+#
+# Version 1 traces had float seconds timestamps (not delta-encoded).
+#
+COMPRESSED_MAGIC = "PTRZ"
+COMPRESSED_VERSION = 2
+
+# magic, version, record size, codec, (pad), records per block, time base
+COMPRESSED_HEADER_FORMAT = "<4sHHHxxId8x"
+COMPRESSED_HEADER_SIZE = struct.calcsize(COMPRESSED_HEADER_FORMAT)
+
+# records, compressed size, first seq, last seq, first timestamp,
+# last timestamp
+BLOCK_HEADER_FORMAT = "<IIQQqq"
+BLOCK_HEADER_FORMAT_V1 = "<IIQQdd"
+BLOCK_HEADER_SIZE = struct.calcsize(BLOCK_HEADER_FORMAT)
+
+# offset, records, first seq, last seq, first timestamp, last timestamp
+BLOCK_INDEX_FORMAT = "<QIQQqq"
+BLOCK_INDEX_FORMAT_V1 = "<QIQQdd"
+BLOCK_INDEX_SIZE = struct.calcsize(BLOCK_INDEX_FORMAT)
+
+# index offset, blocks, magic
+BLOCK_TRAILER_FORMAT = "<QI4s"
+BLOCK_TRAILER_SIZE = struct.calcsize(BLOCK_TRAILER_FORMAT)
+BLOCK_TRAILER_MAGIC = "PTRI"
+
+BLOCK_COLUMNS = ['op', 'size', 'addr', 'val', 'pc', 'seq', 'timestamp']
+
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODECS = {'zlib': CODEC_ZLIB, 'lzma': CODEC_LZMA}
+CODEC_NAMES = {code: name for name, code in CODECS.items()}
+
+
+def available_codecs():
+    """ Compression codecs that can be used here """
+    return [name for name in sorted(CODECS)
+            if name != 'lzma' or lzma is not None]
+
+
+def is_binary_filename(filename):
+    """ Does this filename look like a binary trace? """
+    return filename.endswith("." + G.BINARY_RECORDING_EXTENSION) or \
+        is_compressed_filename(filename)
+
+
+def is_compressed_filename(filename):
+    """ Does this filename look like a block-compressed trace? """
+    return filename.endswith("." + G.COMPRESSED_RECORDING_EXTENSION)
+
+
+def pack_header(time_base=0.0, flags=0):
+    return struct.pack(HEADER_FORMAT, BINARY_MAGIC, BINARY_VERSION,
+                       RECORD_SIZE, flags, time_base)
+
+
+def unpack_header(data):
+    magic, version, record_size, flags, time_base = struct.unpack(
+        HEADER_FORMAT, data)
+    if magic != BINARY_MAGIC:
+        raise ValueError("Not a binary trace (magic %r)" % magic)
+    if version not in (1, BINARY_VERSION) or record_size != RECORD_SIZE:
+        raise ValueError("Unsupported binary trace (version %d, record size "
+                         "%d)" % (version, record_size))
+    return {'version': version,
+            'record_size': record_size,
+            'flags': flags,
+            'time_base': time_base}
+
+
+def pack_record(row):
+    """
+    Pack a log row (op, seq, addr, val, pc, size, timestamp) into a binary
+    record
+
+    :param row:
+    :return:
+    """
+    op, seq, addr, val, pc, size, timestamp = row
+    return struct.pack(RECORD_FORMAT, OP_CODES[op], int(size), int(addr),
+                       int(val), int(pc), int(seq), int(timestamp))
+
+
+def unpack_record(data, version=BINARY_VERSION):
+    """
+    Unpack a binary record into a typed log row
+
+    :param data:
+    :param version: Version of the trace that it came from
+    :return:
+    """
+    if version == 1:
+        op, size, addr, val, pc, seq, timestamp = struct.unpack(
+            RECORD_FORMAT_V1, data)
+        timestamp = from_seconds(timestamp)
+    else:
+        op, size, addr, val, pc, seq, timestamp = struct.unpack(
+            RECORD_FORMAT, data)
+    return [OP_NAMES[op], seq, addr, val, pc, size, timestamp]
+
+
+def records_to_rows(records, count=None, last_timestamp=None):
+    """
+    Convert records into log rows (op, seq, addr, val, pc, size, timestamp)
+    with native Python values
+
+    :param records: numpy array of RECORD_DTYPE
+    :param count: Number of reads per record, to also have them (and
+    last_timestamp) in the rows, i.e., (op, ..., timestamp, count,
+    last_timestamp)
+    :param last_timestamp: Timestamp of the last of those reads
+    :return: List of tuples
+    """
+    ops = [OP_NAMES[o] for o in records['op'].tolist()]
+    # (int64 so that we get ints rather than longs back)
+    columns = [ops] + [records[name].astype(numpy.int64).tolist()
+                       for name in ['seq', 'addr', 'val', 'pc', 'size',
+                                    'timestamp']]
+    if count is not None:
+        columns += [count.astype(numpy.int64).tolist(),
+                    last_timestamp.tolist()]
+    return zip(*columns)
+
+
+def expand_run(read, run):
+    """
+    The READ rows that a RUN row stands for, after the READ that started it.
+    We only know when the first and last read happened, so the timestamps in
+    between are interpolated.
+
+    :param read: The READ row just before the RUN row
+    :param run: The RUN row
+    :return:
+    """
+    op, seq, addr, val, pc, size, timestamp = read
+    last_seq, last_timestamp = int(run[1]), int(run[6])
+    seq, timestamp = int(seq), int(timestamp)
+    count = last_seq - seq
+    if count <= 0:
+        return []
+    elapsed = last_timestamp - timestamp
+    return [['READ', seq + i, addr, val, pc, size,
+             timestamp + elapsed * i // count]
+            for i in xrange(1, count + 1)]
+
+
+def row_to_record(row):
+    """
+    Convert a log row (op, seq, addr, val, pc, size, timestamp) into a tuple
+    of RECORD_DTYPE
+
+    :param row:
+    :return:
+    """
+    op, seq, addr, val, pc, size, timestamp = row
+    return (OP_CODES[op], int(size), 0, int(addr), int(val), int(pc),
+            int(seq), int(timestamp))
+
+
+def pack_compressed_header(codec, block_records, time_base=0.0):
+    return struct.pack(COMPRESSED_HEADER_FORMAT, COMPRESSED_MAGIC,
+                       COMPRESSED_VERSION, RECORD_SIZE, codec, block_records,
+                       time_base)
+
+
+def unpack_compressed_header(data):
+    magic, version, record_size, codec, block_records, time_base = \
+        struct.unpack(COMPRESSED_HEADER_FORMAT, data)
+    if magic != COMPRESSED_MAGIC:
+        raise ValueError("Not a compressed trace (magic %r)" % magic)
+    if version not in (1, COMPRESSED_VERSION) or record_size != RECORD_SIZE:
+        raise ValueError("Unsupported compressed trace (version %d, record "
+                         "size %d)" % (version, record_size))
+    if codec not in CODEC_NAMES:
+        raise ValueError("Unknown trace codec %d" % codec)
+    return {'version': version,
+            'record_size': record_size,
+            'codec': CODEC_NAMES[codec],
+            'block_records': block_records,
+            'time_base': time_base}
+
+
+def _compress(codec, data):
+    if codec == CODEC_LZMA:
+        if lzma is None:
+            raise ValueError("lzma is not available")
+        return lzma.compress(data)
+    return zlib.compress(data, 6)
+
+
+def _decompress(codec, data):
+    if codec == CODEC_LZMA:
+        if lzma is None:
+            raise ValueError("lzma is not available")
+        return lzma.decompress(data)
+    return zlib.decompress(data)
+
+
+def encode_block(records, codec=CODEC_ZLIB):
+    """
+    Compress a numpy array of RECORD_DTYPE into a block (header + payload)
+
+    :param records:
+    :param codec:
+    :return:
+    """
+    count = len(records)
+    columns = []
+    for name in BLOCK_COLUMNS:
+        column = records[name]
+        if name == 'seq' or name == 'timestamp':
+            column = numpy.concatenate([column[:1], numpy.diff(column)])
+        column = numpy.ascontiguousarray(column, dtype=RECORD_DTYPE[name])
+        columns.append(column.view(numpy.uint8).reshape(
+            count, column.itemsize).T.tobytes())
+    payload = _compress(codec, "".join(columns))
+    header = struct.pack(BLOCK_HEADER_FORMAT, count, len(payload),
+                         records['seq'][0], records['seq'][-1],
+                         records['timestamp'][0], records['timestamp'][-1])
+    return header + payload
+
+
+def decode_block(payload, count, codec=CODEC_ZLIB, version=COMPRESSED_VERSION):
+    """
+    Decompress the payload of a block back into a numpy array of
+    RECORD_DTYPE
+
+    :param payload:
+    :param count: Number of records in the block
+    :param codec:
+    :param version: Version of the trace that it came from
+    :return:
+    """
+    data = _decompress(codec, payload)
+    records = numpy.zeros(count, dtype=RECORD_DTYPE)
+    pos = 0
+    for name in BLOCK_COLUMNS:
+        if version == 1 and name == 'timestamp':
+            dtype = RECORD_DTYPE_V1[name]
+        else:
+            dtype = RECORD_DTYPE[name]
+        n = count * dtype.itemsize
+        column = numpy.frombuffer(data, dtype=numpy.uint8, count=n,
+                                  offset=pos).reshape(dtype.itemsize, count)
+        column = numpy.ascontiguousarray(column.T).view(dtype)[:, 0]
+        if version == 1 and name == 'timestamp':
+            column = seconds_to_ns(column)
+        elif name == 'timestamp':
+            column = numpy.cumsum(column, dtype=numpy.int64)
+        records[name] = column
+        pos += n
+    records['seq'] = numpy.cumsum(records['seq'], dtype=numpy.uint64)
+    return records
+
+
+def seconds_to_ns(seconds):
+    """
+    Convert a numpy array of float seconds into integer nanoseconds (rounded
+    like clock.from_seconds())
+
+    :param seconds:
+    :return:
+    """
+    ns = numpy.asarray(seconds, dtype=numpy.float64) * 1e9
+    return (numpy.sign(ns) * numpy.floor(numpy.abs(ns) + 0.5)).astype(
+        numpy.int64)
+
+
+#
+# Bulk parsing of tab-separated logs
+#
+# Rather than going through csv.reader and int() one field at a time, a chunk
+# of the file is parsed with numpy: the lines and tabs are found with a
+# couple of vectorized comparisons, the integer fields are accumulated digit
+# by digit over all of the lines at once (and so are the timestamps, unless
+# they are the float seconds of an old log, which are converted as one
+# fixed-width string array).  The (rare) lines that don't look like
+# plain numbers go through the csv module, like before, so the result is the
+# same as reading the log row by row.
+#
+TSV_FIELDS = 7
+TSV_CHUNK_SIZE = 64 * 1024 * 1024
+TSV_VERSION = 2
+
+# First line of a tab-separated log, older logs (with float seconds
+# timestamps) don't have one
+TSV_HEADER = "#PRETENDER"
+
+# field, column, largest value, most digits
+_TSV_INT_FIELDS = [(1, 'seq', 2 ** 64 - 1, 19),
+                   (2, 'addr', 2 ** 32 - 1, 10),
+                   (3, 'val', 2 ** 32 - 1, 10),
+                   (4, 'pc', 2 ** 32 - 1, 10),
+                   (5, 'size', 2 ** 8 - 1, 3)]
+_TSV_MAX_OP = max(len(op) for op in OP_NAMES)
+_TSV_MAX_TIMESTAMP = 32
+_TSV_TIMESTAMP_DIGITS = 19
+_TSV_OPS = numpy.array(OP_NAMES, dtype='S%d' % _TSV_MAX_OP)
+_TSV_OPS_ORDER = numpy.argsort(_TSV_OPS)
+
+
+def _gather_strings(buf, starts, lengths, width):
+    """ Fixed-width byte strings of the given fields """
+    chars = numpy.zeros((len(starts), width), dtype=numpy.uint8)
+    for j in xrange(width):
+        has = lengths > j
+        chars[has, j] = buf[starts[has] + j]
+    return chars.view('S%d' % width).ravel()
+
+
+def _parse_uints(buf, starts, lengths, digits):
+    """
+    Parse unsigned decimal fields
+
+    :return: (values as uint64, which fields are not plain numbers)
+    """
+    bad = (lengths <= 0) | (lengths > digits)
+    values = numpy.zeros(len(starts), dtype=numpy.uint64)
+    last = len(buf) - 1
+    for j in xrange(min(digits, lengths.max() if len(lengths) else 0)):
+        d = buf[numpy.minimum(starts + j, last)].astype(numpy.int16) - \
+            ord('0')
+        has = lengths > j
+        bad |= has & ((d < 0) | (d > 9))
+        values = numpy.where(has, values * numpy.uint64(10) +
+                             d.astype(numpy.uint64), values)
+    return values, bad
+
+
+def pack_tsv_header(time_base=0.0):
+    """
+    The header line of a tab-separated log
+
+    :param time_base: Wall clock time (seconds) when the recording started
+    :return:
+    """
+    # (Ends in \r\n like the rows that csv writes after it)
+    return "%s\tversion=%d\ttime_unit=ns\ttime_base=%r\r\n" % (
+        TSV_HEADER, TSV_VERSION, float(time_base))
+
+
+def unpack_tsv_header(line):
+    """
+    Parse the header line of a tab-separated log
+
+    :param line:
+    :return: dict of the header fields, or None if this isn't a header
+    """
+    fields = line.rstrip('\r\n').split('\t')
+    if fields[0] != TSV_HEADER:
+        return None
+    header = {'version': 0, 'time_unit': 'ns', 'time_base': 0.0}
+    for field in fields[1:]:
+        key, _, value = field.partition('=')
+        header[key] = value
+    header['version'] = int(header['version'])
+    header['time_base'] = float(header['time_base'])
+    if header['time_unit'] != 'ns':
+        raise ValueError("Unsupported time unit in log header (%s)" %
+                         header['time_unit'])
+    return header
+
+
+def parse_tsv(data, seconds=False):
+    """
+    Parse a chunk of a tab-separated log (complete lines) into a numpy
+    structured array of RECORD_DTYPE.
+
+    Empty lines and lines starting with '#' are ignored, malformed lines are
+    counted and skipped.
+
+    :param data: The lines, as a string
+    :param seconds: The timestamps are (old) float seconds rather than
+    integer nanoseconds
+    :return: (records, number of malformed lines)
+    """
+    buf = numpy.frombuffer(data, dtype=numpy.uint8)
+    ends = numpy.flatnonzero(buf == ord('\n'))
+    if len(buf) and buf[-1] != ord('\n'):
+        ends = numpy.append(ends, len(buf))
+    starts = numpy.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+    # (csv writes \r\n)
+    ends = ends - ((ends > starts) &
+                   (buf[numpy.maximum(ends - 1, 0)] == ord('\r')))
+
+    # Which lines have the right number of fields?
+    lines = ends > starts
+    lines[lines] = buf[starts[lines]] != ord('#')
+    tabs = numpy.flatnonzero(buf == ord('\t'))
+    tab_lines = numpy.searchsorted(ends, tabs)
+    fields = numpy.bincount(tab_lines, minlength=len(ends)) + 1
+    fast = lines & (fields == TSV_FIELDS)
+    slow = lines & ~fast
+
+    # Where each field is, for every line that might be well-formed
+    field_ends = tabs[fast[tab_lines]].reshape(-1, TSV_FIELDS - 1)
+    line_starts = starts[fast]
+    line_ends = ends[fast]
+    field_starts = numpy.column_stack([line_starts, field_ends + 1])
+    field_ends = numpy.column_stack([field_ends, line_ends])
+    field_lengths = field_ends - field_starts
+
+    records = numpy.zeros(len(line_starts), dtype=RECORD_DTYPE)
+    bad = numpy.zeros(len(line_starts), dtype=bool)
+
+    # op
+    lengths = field_lengths[:, 0]
+    bad |= lengths > _TSV_MAX_OP
+    ops = _gather_strings(buf, field_starts[:, 0],
+                          numpy.minimum(lengths, _TSV_MAX_OP), _TSV_MAX_OP)
+    found = numpy.searchsorted(_TSV_OPS[_TSV_OPS_ORDER], ops)
+    found = _TSV_OPS_ORDER[numpy.minimum(found, len(OP_NAMES) - 1)]
+    bad |= _TSV_OPS[found] != ops
+    records['op'] = found
+
+    # seq, addr, val, pc, size
+    for field, name, largest, digits in _TSV_INT_FIELDS:
+        values, not_numbers = _parse_uints(buf, field_starts[:, field],
+                                           field_lengths[:, field], digits)
+        bad |= not_numbers | (values > numpy.uint64(largest))
+        records[name] = values
+
+    # timestamp
+    if not seconds:
+        values, not_numbers = _parse_uints(buf, field_starts[:, 6],
+                                           field_lengths[:, 6],
+                                           _TSV_TIMESTAMP_DIGITS)
+        bad |= not_numbers | (values > numpy.uint64(2 ** 63 - 1))
+        records['timestamp'] = values
+    else:
+        lengths = field_lengths[:, 6]
+        bad |= (lengths <= 0) | (lengths > _TSV_MAX_TIMESTAMP)
+        width = max(1, min(_TSV_MAX_TIMESTAMP, lengths.max() if len(lengths)
+                           else 1))
+        timestamps = _gather_strings(buf, field_starts[:, 6],
+                                     numpy.minimum(lengths, width), width)
+        try:
+            records['timestamp'] = seconds_to_ns(
+                timestamps.astype(numpy.float64))
+        except ValueError:
+            for i, timestamp in enumerate(timestamps.tolist()):
+                try:
+                    records['timestamp'][i] = from_seconds(timestamp)
+                except ValueError:
+                    bad[i] = True
+
+    # Everything that didn't look like plain numbers goes the slow way
+    slow[numpy.flatnonzero(fast)[bad]] = True
+    records = records[~bad]
+    order = numpy.flatnonzero(fast)[~bad]
+    skipped = 0
+    if slow.any():
+        others = []
+        other_order = []
+        for line in numpy.flatnonzero(slow).tolist():
+            text = data[starts[line]:ends[line]]
+            try:
+                row = csv.reader([text], delimiter='\t', quotechar='|',
+                                 quoting=csv.QUOTE_MINIMAL).next()
+                if len(row) == TSV_FIELDS:
+                    row[6] = from_seconds(row[6]) if seconds else int(row[6])
+                pack_record(row)
+                others.append(row_to_record(row))
+                other_order.append(line)
+            except (ValueError, KeyError, struct.error, csv.Error):
+                skipped += 1
+        if others:
+            records = numpy.concatenate([records, numpy.array(
+                others, dtype=RECORD_DTYPE)])
+            order = numpy.concatenate([order, other_order])
+            records = records[numpy.argsort(order, kind='mergesort')]
+    return records, skipped
+
+
+def iter_tsv(f, chunk_size=TSV_CHUNK_SIZE, seconds=False):
+    """
+    Parse the rest of a tab-separated log with parse_tsv(), a chunk of lines
+    at a time
+
+    :param f: File object
+    :param chunk_size: Bytes parsed at a time
+    :param seconds: The timestamps are (old) float seconds
+    :return: Iterator of (records, number of malformed lines), per chunk
+    """
+    leftover = ""
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        data = leftover + data
+        end = data.rfind('\n') + 1
+        leftover = data[end:]
+        if end:
+            yield parse_tsv(data[:end], seconds)
+    if leftover:
+        yield parse_tsv(leftover, seconds)
+
+
+def read_tsv(f, chunk_size=TSV_CHUNK_SIZE, seconds=False):
+    """
+    Parse the rest of a tab-separated log (see iter_tsv())
+
+    :param f: File object
+    :param chunk_size: Bytes parsed at a time
+    :param seconds: The timestamps are (old) float seconds
+    :return: (records, number of malformed lines)
+    """
+    parts = []
+    skipped = 0
+    for records, bad in iter_tsv(f, chunk_size, seconds):
+        parts.append(records)
+        skipped += bad
+    if not parts:
+        return numpy.zeros(0, dtype=RECORD_DTYPE), skipped
+    return numpy.concatenate(parts), skipped
+
+
+def index_filename(filename):
+    """ Name of the sidecar index for a recording """
+    return filename + ".idx"
+
+
+class TraceIndex(object):
+    """
+    Sidecar index of a recording, built while it is written.
+
+    It maps each MMIO address (READ/WRITE/RUN) and each IRQ number
+    (ENTER/EXIT) to the row numbers where it appears, and for tab-separated
+    logs also to the byte offsets of those rows, so that a reader can seek
+    straight to the rows it cares about instead of scanning the entire
+    recording.
+    """
+    VERSION = 1
+
+    def __init__(self, binary=False):
+        self.binary = binary
+        self.rows = 0
+        self.addresses = {}
+        self.irqs = {}
+        self.address_offsets = {}
+        self.irq_offsets = {}
+
+    def add(self, op, key, offset=None):
+        """
+        Record that the next row is an op on the given address (or IRQ)
+
+        :param op:
+        :param key: Address, or IRQ number for ENTER/EXIT
+        :param offset: Byte offset of the row (tab-separated logs only)
+        :return:
+        """
+        if op == "READ" or op == "WRITE" or op == "RUN":
+            rows, offsets = self.addresses, self.address_offsets
+        elif op == "ENTER" or op == "EXIT":
+            rows, offsets = self.irqs, self.irq_offsets
+        else:
+            rows = offsets = None
+
+        if rows is not None:
+            key = int(key)
+            if key not in rows:
+                rows[key] = array('l')
+                offsets[key] = array('l')
+            rows[key].append(self.rows)
+            if offset is not None:
+                offsets[key].append(offset)
+        self.rows += 1
+
+    def row_offset(self, row):
+        """ Byte offset of a row in a binary trace """
+        return HEADER_SIZE + row * RECORD_SIZE
+
+    def save(self, filename):
+        def to_numpy(d):
+            return {k: numpy.frombuffer(v, dtype=numpy.int_).copy()
+                    for k, v in d.items()}
+
+        with open(filename, 'wb') as f:
+            pickle.dump({'version': self.VERSION,
+                         'binary': self.binary,
+                         'rows': self.rows,
+                         'addresses': to_numpy(self.addresses),
+                         'irqs': to_numpy(self.irqs),
+                         'address_offsets': to_numpy(self.address_offsets),
+                         'irq_offsets': to_numpy(self.irq_offsets)},
+                        f, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a sidecar index, the values are numpy arrays once loaded
+
+        :param filename:
+        :return: TraceIndex, or None if there is no (usable) index
+        """
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'rb') as f:
+            data = pickle.load(f)
+        if data.get('version') != cls.VERSION:
+            logger.warning("Ignoring index %s (version %s)" % (
+                filename, data.get('version')))
+            return None
+        index = cls(binary=data['binary'])
+        index.rows = data['rows']
+        index.addresses = data['addresses']
+        index.irqs = data['irqs']
+        index.address_offsets = data['address_offsets']
+        index.irq_offsets = data['irq_offsets']
+        return index
+
+    def rows_for(self, addresses=(), irqs=()):
+        """
+        Sorted row numbers of every event at these addresses or IRQs
+
+        :param addresses:
+        :param irqs:
+        :return:
+        """
+        rows = [numpy.asarray(self.addresses[a]) for a in addresses
+                if a in self.addresses]
+        rows += [numpy.asarray(self.irqs[i]) for i in irqs if i in self.irqs]
+        if not rows:
+            return numpy.zeros(0, dtype=numpy.int_)
+        return numpy.sort(numpy.concatenate(rows))
+
+    def offsets_for(self, addresses=(), irqs=()):
+        """
+        Sorted byte offsets of every event at these addresses or IRQs
+
+        :param addresses:
+        :param irqs:
+        :return:
+        """
+        if self.binary:
+            return self.row_offset(self.rows_for(addresses, irqs))
+        offsets = [numpy.asarray(self.address_offsets[a]) for a in addresses
+                   if a in self.address_offsets]
+        offsets += [numpy.asarray(self.irq_offsets[i]) for i in irqs
+                    if i in self.irq_offsets]
+        if not offsets:
+            return numpy.zeros(0, dtype=numpy.int_)
+        return numpy.sort(numpy.concatenate(offsets))
+
+
+class _CountingFile(object):
+    """ Keep track of our offset in a file without asking the OS """
+
+    def __init__(self, f):
+        self.file = f
+        self.offset = f.tell()
+
+    def write(self, data):
+        self.file.write(data)
+        self.offset += len(data)
+
+
+class BlockIndex(object):
+    """
+    Where each block of a compressed trace starts, and which rows, sequence
+    numbers and timestamps it covers
+    """
+
+    def __init__(self):
+        self.offsets = []
+        self.counts = []
+        self.starts = []
+        self.first_seqs = []
+        self.last_seqs = []
+        self.first_timestamps = []
+        self.last_timestamps = []
+        self.rows = 0
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def add(self, offset, count, first_seq, last_seq, first_timestamp,
+            last_timestamp):
+        self.offsets.append(offset)
+        self.counts.append(count)
+        self.starts.append(self.rows)
+        self.first_seqs.append(first_seq)
+        self.last_seqs.append(last_seq)
+        self.first_timestamps.append(first_timestamp)
+        self.last_timestamps.append(last_timestamp)
+        self.rows += count
+
+    def pack(self, offset):
+        """
+        Pack the index and the trailer that points at it
+
+        :param offset: Where in the file the index is written
+        :return:
+        """
+        entries = [struct.pack(BLOCK_INDEX_FORMAT, *entry) for entry in
+                   zip(self.offsets, self.counts, self.first_seqs,
+                       self.last_seqs, self.first_timestamps,
+                       self.last_timestamps)]
+        return "".join(entries) + struct.pack(BLOCK_TRAILER_FORMAT, offset,
+                                              len(self),
+                                              BLOCK_TRAILER_MAGIC)
+
+    @classmethod
+    def read(cls, f, version=COMPRESSED_VERSION):
+        """
+        Read the block index at the end of a compressed trace, or rebuild it
+        from the block headers if it isn't there (e.g., the recorder died)
+
+        :param f: The trace, opened for reading
+        :param version: Version of the trace
+        :return:
+        """
+        index_format, header_format = BLOCK_INDEX_FORMAT, BLOCK_HEADER_FORMAT
+        if version == 1:
+            index_format = BLOCK_INDEX_FORMAT_V1
+            header_format = BLOCK_HEADER_FORMAT_V1
+        index = cls()
+        size = os.fstat(f.fileno()).st_size
+        if size >= COMPRESSED_HEADER_SIZE + BLOCK_TRAILER_SIZE:
+            f.seek(size - BLOCK_TRAILER_SIZE)
+            offset, blocks, magic = struct.unpack(
+                BLOCK_TRAILER_FORMAT, f.read(BLOCK_TRAILER_SIZE))
+            if magic == BLOCK_TRAILER_MAGIC and \
+                    offset + blocks * BLOCK_INDEX_SIZE + \
+                    BLOCK_TRAILER_SIZE == size:
+                f.seek(offset)
+                data = f.read(blocks * BLOCK_INDEX_SIZE)
+                for i in xrange(blocks):
+                    entry = list(struct.unpack_from(index_format, data,
+                                                    i * BLOCK_INDEX_SIZE))
+                    if version == 1:
+                        entry[4:] = [from_seconds(t) for t in entry[4:]]
+                    index.add(*entry)
+                return index
+
+        logger.warning("%s has no block index, scanning it" % f.name)
+        offset = COMPRESSED_HEADER_SIZE
+        while offset + BLOCK_HEADER_SIZE <= size:
+            f.seek(offset)
+            count, length, first_seq, last_seq, first_ts, last_ts = \
+                struct.unpack(header_format, f.read(BLOCK_HEADER_SIZE))
+            if offset + BLOCK_HEADER_SIZE + length > size:
+                logger.warning("%s ends with a truncated block" % f.name)
+                break
+            if version == 1:
+                first_ts, last_ts = from_seconds(first_ts), \
+                    from_seconds(last_ts)
+            index.add(offset, count, first_seq, last_seq, first_ts, last_ts)
+            offset += BLOCK_HEADER_SIZE + length
+        return index
+
+    def block_for_seq(self, seq):
+        """ The block that holds (or would hold) this sequence number """
+        return max(bisect_right(self.first_seqs, seq) - 1, 0)
+
+    def block_for_timestamp(self, timestamp):
+        """ The block that holds (or would hold) this timestamp """
+        return max(bisect_right(self.first_timestamps, timestamp) - 1, 0)
+
+    def block_for_row(self, row):
+        """ The block that holds this row number """
+        return max(bisect_right(self.starts, row) - 1, 0)
 
 
 class LogWriter:
-    def __init__(self, filename):
-        self.csvfile = open(filename, 'wb')
-        self.writer = csv.writer(self.csvfile, delimiter='\t',
-                                 quotechar='|', quoting=csv.QUOTE_MINIMAL)
+    def __init__(self, filename, binary=None, index=False, compression=None,
+                 block_records=None, time_base=None):
+        """
+        :param filename:
+        :param binary: Write fixed-width binary records instead of
+        tab-separated values.  By default this is decided by the extension.
+        :param index: Also maintain a sidecar index (see TraceIndex)
+        :param compression: Write a block-compressed trace with this codec
+        ("zlib" or "lzma").  By default this is decided by the extension.
+        :param block_records: Number of records per compressed block
+        :param time_base: Wall clock time (seconds) when the recording
+        started, i.e., what the (relative, nanosecond) timestamps count from.
+        Defaults to now.
+        """
+        if time_base is None:
+            time_base = time.time()
+        if compression is None and is_compressed_filename(filename):
+            compression = G.TRACE_COMPRESSION
+        if compression is not None:
+            if compression not in available_codecs():
+                raise ValueError("Unsupported trace compression %r" %
+                                 compression)
+            binary = True
+        if binary is None:
+            binary = is_binary_filename(filename)
+        self.filename = filename
+        self.binary = binary
+        self.compression = compression
+        self.time_base = time_base
+        self.file = open(filename, 'wb')
+        self.index = TraceIndex(binary=binary) if index else None
+        if self.compression is not None:
+            self.codec = CODECS[compression]
+            self.block_records = block_records or G.TRACE_BLOCK_RECORDS
+            self.blocks = BlockIndex()
+            self.pending = []
+            self.file.write(pack_compressed_header(self.codec,
+                                                   self.block_records,
+                                                   time_base))
+            self.writer = None
+        elif self.binary:
+            self.file.write(pack_header(time_base))
+            self.writer = None
+        else:
+            self.file.write(pack_tsv_header(time_base))
+            self.counter = _CountingFile(self.file)
+            self.writer = csv.writer(self.counter, delimiter='\t',
+                                     quotechar='|', quoting=csv.QUOTE_MINIMAL)
+
+    def _index_row(self, row, offset=None):
+        try:
+            self.index.add(row[0], row[2], offset)
+        except (IndexError, ValueError, TypeError):
+            self.index.add(None, None)
+
+    def _flush_block(self):
+        if not self.pending:
+            return
+        records = numpy.array(self.pending, dtype=RECORD_DTYPE)
+        offset = self.file.tell()
+        self.file.write(encode_block(records, self.codec))
+        self.blocks.add(offset, len(records), records['seq'][0],
+                        records['seq'][-1], records['timestamp'][0],
+                        records['timestamp'][-1])
+        self.pending = []
 
     def write_row(self, row):
         """
@@ -13,18 +928,252 @@ class LogWriter:
         :param row:
         :return:
         """
-        self.writer.writerow(row)
+        if self.compression is not None:
+            self.pending.append(row_to_record(row))
+            if self.index is not None:
+                self._index_row(row)
+            if len(self.pending) >= self.block_records:
+                self._flush_block()
+        elif self.binary:
+            self.file.write(pack_record(row))
+            if self.index is not None:
+                self._index_row(row)
+        else:
+            offset = self.counter.offset
+            self.writer.writerow(row)
+            if self.index is not None:
+                self._index_row(row, offset)
+
+    def write_rows(self, rows):
+        """
+        Write a batch of rows to our log file
+        :param rows:
+        :return:
+        """
+        if self.compression is not None:
+            for row in rows:
+                self.write_row(row)
+        elif self.binary:
+            self.file.write("".join(pack_record(row) for row in rows))
+            if self.index is not None:
+                for row in rows:
+                    self._index_row(row)
+        elif self.index is not None:
+            # We need the offset of every row
+            for row in rows:
+                self.write_row(row)
+        else:
+            self.writer.writerows(rows)
+
+    def close(self):
+        if self.compression is not None:
+            self._flush_block()
+            self.file.write(self.blocks.pack(self.file.tell()))
+        self.file.close()
+        if self.index is not None:
+            self.index.save(index_filename(self.filename))
+
+
+class AsyncLogWriter(object):
+    """
+    Hand rows to a background thread that writes them in batches, so that
+    whoever produces the rows (e.g., the recorder's watchmen, which sit on the
+    path of every forwarded hardware access) only pays for a queue append.
+
+    The queue is bounded.  When it is full we either block the producer until
+    the writer catches up, or drop the row, and count either case.  Rows that
+    the writer fails to write are counted too (failed), they are not written.
+    """
+
+    def __init__(self, writer, max_queue=65536, batch_size=1024, block=True,
+                 flush_interval=0.1):
+        """
+        :param writer: The LogWriter that actually writes the rows
+        :param max_queue: Maximum number of rows waiting to be written
+        :param batch_size: Number of rows handed to the writer at a time
+        :param block: Block when the queue is full (otherwise drop rows)
+        :param flush_interval: Seconds between flushes of a partial batch
+        """
+        self.writer = writer
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.block = block
+        self.flush_interval = flush_interval
+
+        self.queue = collections.deque()
+        self.not_full = Condition()
+        self.wakeup = Event()
+        self._closed = False
+        self._closing = Lock()
+
+        # Counters
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.blocked = 0
+        self.max_depth = 0
+
+        self.thread = Thread(target=self._run,
+                             name="AsyncLogWriter(%s)" % writer.filename)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def filename(self):
+        return self.writer.filename
+
+    def write_row(self, row):
+        """
+        Queue a row to be written
+        :param row:
+        :return:
+        """
+        if self._closed:
+            raise ValueError("Write to closed log %s" % self.filename)
+        if len(self.queue) >= self.max_queue:
+            if not self.block:
+                self.dropped += 1
+                return
+            self.blocked += 1
+            with self.not_full:
+                while len(self.queue) >= self.max_queue and not self._closed:
+                    self.wakeup.set()
+                    self.not_full.wait(self.flush_interval)
+
+        with self._closing:
+            # (The writer only drains the queue once more after close())
+            if self._closed:
+                raise ValueError("Write to closed log %s" % self.filename)
+            self.queue.append(row)
+        self.queued += 1
+        depth = len(self.queue)
+        if depth > self.max_depth:
+            self.max_depth = depth
+        if depth >= self.batch_size:
+            self.wakeup.set()
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def stats(self):
+        """
+        Return our counters
+        :return:
+        """
+        return {'depth': len(self.queue),
+                'max_depth': self.max_depth,
+                'queued': self.queued,
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'blocked': self.blocked}
+
+    def _drain(self):
+        while self.queue:
+            batch = []
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.popleft())
+            except IndexError:
+                pass
+            try:
+                self.writer.write_rows(batch)
+                self.written += len(batch)
+            except Exception:
+                logger.exception("Error writing %d rows to %s" % (
+                    len(batch), self.filename))
+                self.failed += len(batch)
+            with self.not_full:
+                self.not_full.notify_all()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self._drain()
+            if self._closed:
+                self._drain()
+                break
 
     def close(self):
-        # self.file.close()
-        self.csvfile.close()
+        """
+        Write out anything still queued and close our writer
+        :return:
+        """
+        with self._closing:
+            self._closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.writer.close()
+        logger.info("Closed %s (%s)" % (self.filename, self.stats()))
+        if self.failed:
+            logger.error("Failed to write %d rows to %s, it is incomplete!" % (
+                self.failed, self.filename))
 
 
 class LogReader:
-    def __init__(self, filename):
-        self.csvfile = open(filename, 'rb')
-        self.reader = csv.reader(self.csvfile, delimiter='\t',
-                                 quotechar='|', quoting=csv.QUOTE_MINIMAL)
+    def __init__(self, filename, expand_runs=False, seconds=False):
+        """
+        Timestamps are returned as integer nanoseconds since the start of the
+        recording, whatever the format (and age) of the log.
+
+        :param filename:
+        :param expand_runs: Replace each RUN row with the READ rows that it
+        stands for (timestamps are interpolated), for code that doesn't know
+        about runs
+        :param seconds: Return the timestamps as float seconds instead, for
+        code that doesn't know about nanoseconds
+        """
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.header = None
+        self.reader = None
+        self.expand_runs = expand_runs
+        self.seconds = seconds
+        self.version = None
+        self.time_base = 0.0
+        self._last_read = None
+        self._expanded = collections.deque()
+        self.blocks = None
+        self._block = None
+        self._block_rows = []
+        self._block_pos = 0
+        self._next_block = 0
+
+        magic = self.file.read(len(BINARY_MAGIC))
+        self.file.seek(0)
+        if magic == BINARY_MAGIC:
+            self.header = unpack_header(self.file.read(HEADER_SIZE))
+        elif magic == COMPRESSED_MAGIC:
+            self.header = unpack_compressed_header(
+                self.file.read(COMPRESSED_HEADER_SIZE))
+            self.codec = CODECS[self.header['codec']]
+            self.blocks = BlockIndex.read(self.file, self.header['version'])
+        else:
+            tsv_header = unpack_tsv_header(self.file.readline())
+            if tsv_header is None:
+                # An old log, with float seconds and no header
+                self.file.seek(0)
+                self.version = 1
+            else:
+                self.version = tsv_header['version']
+                self.time_base = tsv_header['time_base']
+            self.reader = csv.reader(self.file, delimiter='\t',
+                                     quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        if self.header is not None:
+            self.version = self.header['version']
+            self.time_base = self.header['time_base']
+
+    @property
+    def binary(self):
+        """ Are the records typed (binary or compressed trace)? """
+        return self.header is not None
+
+    @property
+    def compressed(self):
+        return self.blocks is not None
 
     def __iter__(self):
         return self
@@ -33,8 +1182,288 @@ class LogReader:
         return self.read_row()
 
     def close(self):
-        # self.file.close()
-        self.csvfile.close()
+        self.file.close()
+
+    @staticmethod
+    def _record_row(record):
+        op, size, _, addr, val, pc, seq, timestamp = record
+        return [OP_NAMES[op], int(seq), int(addr), int(val), int(pc),
+                int(size), timestamp]
+
+    def _tsv_row(self, row):
+        """ Convert the timestamp of a tab-separated row to nanoseconds """
+        if len(row) == TSV_FIELDS:
+            try:
+                if self.version == 1:
+                    row[6] = from_seconds(row[6])
+                else:
+                    row[6] = int(row[6])
+            except ValueError:
+                pass
+        return row
+
+    def _seconds(self, row):
+        if self.seconds and len(row) == TSV_FIELDS and \
+                isinstance(row[6], (int, long)):
+            row[6] = to_seconds(row[6])
+        return row
 
     def read_row(self):
-        return self.reader.next()
+        return self._seconds(self._expand_row() if self.expand_runs
+                             else self._read_row())
+
+    def _expand_row(self):
+        if self._expanded:
+            return self._expanded.popleft()
+        row = self._read_row()
+        if len(row) != 7:
+            return row
+        if row[0] == 'READ':
+            self._last_read = row
+        elif row[0] == 'RUN' and self._last_read is not None:
+            self._expanded.extend(expand_run(self._last_read, row))
+            self._last_read = None
+            if self._expanded:
+                return self._expanded.popleft()
+            return self._read_row()
+        else:
+            self._last_read = None
+        return row
+
+    def _read_row(self):
+        if self.compressed:
+            while self._block_pos >= len(self._block_rows):
+                if self._next_block >= len(self.blocks):
+                    raise StopIteration
+                self.seek_block(self._next_block)
+            record = self._block_rows[self._block_pos]
+            self._block_pos += 1
+            return self._record_row(record)
+        if self.binary:
+            data = self.file.read(RECORD_SIZE)
+            if len(data) < RECORD_SIZE:
+                raise StopIteration
+            return unpack_record(data, self.version)
+        return self._tsv_row(self.reader.next())
+
+    def read_block(self, block):
+        """
+        Decompress one block of a compressed trace
+
+        :param block: Block number
+        :return: numpy array of RECORD_DTYPE
+        """
+        self.file.seek(self.blocks.offsets[block])
+        count, length = struct.unpack(BLOCK_HEADER_FORMAT, self.file.read(
+            BLOCK_HEADER_SIZE))[:2]
+        return decode_block(self.file.read(length), count, self.codec,
+                            self.version)
+
+    def seek_block(self, block, row=0):
+        """
+        Continue reading a compressed trace from the given block
+
+        :param block: Block number
+        :param row: Row within that block
+        :return:
+        """
+        if block >= len(self.blocks):
+            self._block = None
+            self._block_rows = []
+            self._block_pos = 0
+            self._next_block = len(self.blocks)
+            return
+        self._block = self.read_block(block)
+        self._block_rows = self._block.tolist()
+        self._block_pos = row
+        self._next_block = block + 1
+
+    def seek_seq(self, seq):
+        """
+        Continue reading a compressed trace from the first event with a
+        sequence number of at least seq, only decompressing its block
+
+        :param seq:
+        :return:
+        """
+        block = self.blocks.block_for_seq(seq)
+        self.seek_block(block)
+        if self._block is not None:
+            self._block_pos = int(numpy.searchsorted(self._block['seq'], seq))
+
+    def seek_timestamp(self, timestamp):
+        """
+        Continue reading a compressed trace from the first event at or after
+        this timestamp, only decompressing its block
+
+        :param timestamp: Nanoseconds since the start of the recording
+        :return:
+        """
+        block = self.blocks.block_for_timestamp(timestamp)
+        self.seek_block(block)
+        if self._block is not None:
+            self._block_pos = int(numpy.searchsorted(self._block['timestamp'],
+                                                     timestamp))
+
+    def read_rows(self, rows):
+        """
+        Read the given (sorted) row numbers, e.g., from a TraceIndex.
+
+        Binary traces seek straight to each row, compressed traces only
+        decompress the blocks that hold them, and tab-separated logs have to
+        be scanned.
+
+        :param rows:
+        :return:
+        """
+        if self.compressed:
+            block = None
+            for row in rows:
+                if block is None or not (
+                        self.blocks.starts[block] <= row <
+                        self.blocks.starts[block] + self.blocks.counts[block]):
+                    block = self.blocks.block_for_row(row)
+                    records = self.read_block(block).tolist()
+                if row - self.blocks.starts[block] < len(records):
+                    yield self._seconds(self._record_row(
+                        records[row - self.blocks.starts[block]]))
+        elif self.binary:
+            for row in rows:
+                self.file.seek(HEADER_SIZE + row * RECORD_SIZE)
+                data = self.file.read(RECORD_SIZE)
+                if len(data) < RECORD_SIZE:
+                    return
+                yield self._seconds(unpack_record(data, self.version))
+        else:
+            wanted = iter(rows)
+            target = next(wanted, None)
+            for i, row in enumerate(self):
+                if target is None:
+                    return
+                if i == target:
+                    yield row
+                    target = next(wanted, None)
+
+    def read_rows_at(self, offsets):
+        """
+        Read the rows starting at the given byte offsets (e.g., from a
+        TraceIndex), without scanning the rest of the log
+
+        :param offsets:
+        :return:
+        """
+        if self.compressed:
+            raise ValueError("Compressed traces can't be read at byte "
+                             "offsets, use read_rows()")
+        for offset in offsets:
+            self.file.seek(offset)
+            if self.binary:
+                data = self.file.read(RECORD_SIZE)
+                if len(data) < RECORD_SIZE:
+                    return
+                yield self._seconds(unpack_record(data, self.version))
+            else:
+                line = self.file.readline()
+                if not line:
+                    return
+                yield self._seconds(self._tsv_row(csv.reader(
+                    [line], delimiter='\t', quotechar='|',
+                    quoting=csv.QUOTE_MINIMAL).next()))
+
+    def read_array(self, mmap=False):
+        """
+        Read the rest of the log into a numpy structured array of
+        RECORD_DTYPE.
+
+        Binary traces are read (or memory-mapped) directly, compressed traces
+        are decompressed block by block, and tab-separated logs are parsed in
+        bulk (see parse_tsv()), skipping malformed lines.
+
+        :param mmap: Memory-map a binary trace instead of reading it
+        :return:
+        """
+        if self.compressed:
+            parts = []
+            if self._block is not None:
+                parts.append(self._block[self._block_pos:])
+            for block in xrange(self._next_block, len(self.blocks)):
+                parts.append(self.read_block(block))
+            self.seek_block(len(self.blocks))
+            if not parts:
+                return numpy.zeros(0, dtype=RECORD_DTYPE)
+            return numpy.concatenate(parts)
+
+        if self.binary:
+            offset = self.file.tell()
+            count = (os.fstat(self.file.fileno()).st_size - offset) \
+                / RECORD_SIZE
+            if self.version == 1:
+                records = numpy.fromfile(self.file, dtype=RECORD_DTYPE_V1,
+                                         count=count)
+                converted = records.astype(RECORD_DTYPE)
+                converted['timestamp'] = seconds_to_ns(records['timestamp'])
+                return converted
+            if mmap:
+                if count == 0:
+                    return numpy.zeros(0, dtype=RECORD_DTYPE)
+                return numpy.memmap(self.filename, dtype=RECORD_DTYPE,
+                                    mode='r', offset=offset, shape=(count,))
+            return numpy.fromfile(self.file, dtype=RECORD_DTYPE, count=count)
+
+        if self.reader.line_num == 0 and not self.expand_runs:
+            # Nothing was read yet, parse the whole thing in bulk
+            records, skipped = read_tsv(self.file,
+                                        seconds=self.version == 1)
+        else:
+            records = []
+            skipped = 0
+            for row in self:
+                try:
+                    records.append(row_to_record(row))
+                except (ValueError, KeyError):
+                    skipped += 1
+            records = numpy.array(records, dtype=RECORD_DTYPE)
+        if skipped:
+            logger.warning("Skipped %d malformed lines in %s" % (
+                skipped, self.filename))
+        return records
+
+
+def convert_log(src, dst, batch_size=4096, compression=None):
+    """
+    Convert an existing recording into another format (tab-separated,
+    binary or block-compressed), decided by the extension of dst
+
+    :param src: Input recording
+    :param dst: Output recording
+    :param batch_size: Number of rows to write at a time
+    :param compression: Codec for compressed traces (see LogWriter)
+    :return: (rows written, malformed rows skipped)
+    """
+    reader = LogReader(src)
+    writer = LogWriter(dst, compression=compression,
+                       time_base=reader.time_base)
+    written = 0
+    skipped = 0
+    batch = []
+    for row in reader:
+        if len(row) != 7 or row[0] not in OP_CODES:
+            skipped += 1
+            continue
+        try:
+            pack_record(row)
+        except (ValueError, struct.error):
+            skipped += 1
+            continue
+        batch.append(row)
+        if len(batch) >= batch_size:
+            writer.write_rows(batch)
+            written += len(batch)
+            batch = []
+    writer.write_rows(batch)
+    written += len(batch)
+    writer.close()
+    reader.close()
+    if skipped:
+        logger.warning("Skipped %d malformed lines in %s" % (skipped, src))
+    return written, skipped
@@ -18,7 +18,9 @@ class LoopSurvivability:
 
         rec_file_cnt = open(rec_file).read().split('\r\n')
 
-        self.pcs = [v.split('\t')[4] for v in rec_file_cnt if v]
+        # (Skipping the header line)
+        self.pcs = [v.split('\t')[4] for v in rec_file_cnt
+                    if v and not v.startswith('#')]
         self.tot_seen_blocks = []
         self.seen_loops = {}
         self.last_loop = []
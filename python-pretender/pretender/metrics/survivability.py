@@ -1,7 +1,15 @@
 from coverage import get_hit_blocks
 from collections import defaultdict
+import logging
 import os
 
+import numpy
+
+from pretender.logger import OP_READ, OP_WRITE
+from pretender.trace import TraceTable
+
+logger = logging.getLogger(__name__)
+
 def survivability(binary, old_recording_dir, new_recording_dir):
     """
     Return a "score" of the relative survivability of a model, given two traces
@@ -35,21 +43,16 @@ def compare_hit_blocks(qemu_trace_a, qemu_trace_b):
 
 
 def get_peripheral_accesses_count(trace_file):
-    l = LogReader(filename)
+    trace = TraceTable.load(trace_file)
     accesses = defaultdict(int)
-    for line in l:
-        try:
-            op, id, addr, val, pc, size, timestamp = line
-        except ValueError:
-            logger.warning("Weird line: " + repr(line))
-            continue
-        addr = int(addr)
-        val = int(val)
-        if op == 'ENTER' or op == 'EXIT':
-            continue
-        if op == "READ" or op == "WRITE":
-            accesses[addr] += 1
-    l.close()
+    mask = (trace.op == OP_READ) | (trace.op == OP_WRITE)
+    # (a run of reads counts as every read in it)
+    addrs, inverse = numpy.unique(trace.addr[mask], return_inverse=True)
+    counts = numpy.bincount(inverse, weights=trace.count[mask],
+                            minlength=len(addrs))
+    for addr, count in zip(addrs.astype(numpy.int64).tolist(),
+                           counts.astype(numpy.int64).tolist()):
+        accesses[addr] += count
     return accesses
 
 
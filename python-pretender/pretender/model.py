@@ -16,12 +16,17 @@ from avatar2.peripherals.nucleo_usart import NucleoUSART
 # Pretender
 import pretender.globals as G
 from pretender.logger import LogReader
+from pretender.trace import TraceTable
 from pretender.cluster_peripherals import cluster_peripherals
+from pretender.fitting import FitScheduler
 from pretender.mmiogroup import MMIOGroup
 from pretender.models.increasing import IncreasingModel
 from pretender.models.pattern import PatternModel
 from pretender.models.simple_storage import SimpleStorageModel
+from pretender.peripheral_map import PeripheralMap
 from pretender.peripheral_model import PeripheralModel
+from pretender.training import InterruptAccumulator, TrainingPass, \
+    train_peripherals
 
 logger = logging.getLogger(__name__)
 
@@ -83,198 +88,63 @@ class PretenderModel:
     #                                        'log': [],
     #                                        'model': None}
 
-    def infer_interrupt_association(self, l, peripheral_clusters):
+    def infer_interrupt_association(self, trace, peripheral_clusters):
         """
         Infer an interrupt association.
         This is the mapping between the peripheral grouping and its interrupt number.
         NInja-edit, this does a lot more than that now.
-        0: Get the full trace read in
+        0: Stream the trace in
         1: Take the MMIO during an ISR
         2: Figure out which peripheral the ISR's content belongs to.
         3: Figure out what caused the ISR, using the assumption that a write to a peripheral register enabled the interrupt.
         4: Figure out when / how often we should fire this interrupt
-        :param l: LogReader with the data in it
+        :param trace: TraceTable with the data in it
         :param peripheral_clusters: Previously-extracted peripheral map.
         :return:
         """
 
-        interrupt_mapping = {}
-        oneshots = []
-        # Step 0: Sloppily parse out the full trace.
-        full_trace = []
-        for line in l:
-            try:
-                op, id, addr, val, pc, size, timestamp = line
-            except ValueError:
-                continue
-            addr = int(addr)
-            val = int(val)
-            pc = int(pc)
-            timestamp = float(timestamp)
-            full_trace.append((op, id, addr, val, pc, size, timestamp))
-
-        isr_activity = {}
-        # Step 1: Cut out an interrupt handler's worth of stuff
-        # TODO: Support for nesting.
-        for x in range(len(full_trace)):
-            op, id, addr, val, pc, size, timestamp = full_trace[x]
-            if op == "ENTER":
-                isr_num = addr
-                isr_trace = []
-                isr_instance = {}
-                for y in range(x + 1, len(full_trace)):
-                    op2, id2, addr2, val2, pc2, size2, timestamp2 = full_trace[
-                        y]
-                    if op2 == 'EXIT':
-                        # we hit the end.  Write it out.
-                        isr_instance['time'] = timestamp2 - timestamp
-                        isr_instance['trace'] = isr_trace
-                        if not isr_activity.has_key(isr_num):
-                            isr_activity[isr_num] = []
-                        isr_activity[isr_num].append(isr_instance)
-                        break
-                    isr_trace.append(full_trace[y])
-                else:
-                    # Mismatched enter
-                    logger.warning(
-                        "Mismatched ISR enter %s" % repr(full_trace[x]))
-                    continue
-
-        # Step 2: Let's figure out what peripheral cluster it goes to
-        # We use a tiered voting thingy, each ISR invocation has a bunch of MMIO accesses in it.
-        # We vote based on the MMIO accesses that belong to a given cluster, and vote based on
-        # all ISR invocations as well
-        for isr_num, activity in isr_activity.items():
-            logger.debug("Associating ISR %d" % isr_num)
-            cluster_number = self.associate_with_cluster(activity,
-                                                         peripheral_clusters)
-            if cluster_number == -1:
-                logger.warning(
-                    "Could not associate IRQ %d to a peripheral" % isr_num)
-                continue
-            logger.info("I think IRQ %d belongs in cluster %d: %s" % (
-                isr_num, cluster_number,
-                repr(peripheral_clusters[cluster_number])))
-            interrupt_mapping[cluster_number] = isr_num
-        # Step 3: Can we find a trigger?
-        irq_triggers = {}
-        for cluster, irq_num in interrupt_mapping.items():
-            logger.info("Finding a trigger for interrupt %d" % irq_num)
-            # Find the first ENTER
-            trigger_addr = None
-            trigger_val = None
-            for state in range(0, len(full_trace)):
-                op, _, irq, val, _, _, timestamp = full_trace[state]
-                if op == 'ENTER' and irq == irq_num:
-                    # OK here we are.  Walk it back.
-                    prev_state = state - 1
-                    while prev_state > 0:
-                        prev_op, prev_id, prev_addr, prev_val, prev_pc, prev_size, prev_timestamp = \
-                            full_trace[prev_state]
-                        if prev_op == 'WRITE' and prev_addr in \
-                                peripheral_clusters[cluster]:
-                            # That's the guy
-                            trigger_addr = prev_addr
-                            trigger_val = prev_val
-                            break
-                        prev_state -= 1
-                    break
-            if not trigger_addr:
-                logger.info("Could not find a trigger for IRQ %d", irq_num)
-            else:
-                logger.info(
-                    "Found trigger for IRQ %d at address %#08x with value %#08x" % (
-                        irq_num, trigger_addr, trigger_val))
-                irq_triggers[irq_num] = (trigger_addr, trigger_val)
-                # Now refine the bitpattern
-                cur_trigger_val = None
-                trigger_vals = defaultdict(int)
-                for x in range(len(full_trace)):
-                    op, id, addr, val, pc, size, timestamp = full_trace[x]
-                    if op == "WRITE" and addr == trigger_addr:
-                        cur_trigger_val = val
-                    elif op == "READ" and addr == trigger_addr and val != cur_trigger_val:
-                        logger.warn("UH OH, one-shot detected for interrupt %d" % irq_num)
-                        oneshots.append[irq_num]
-                    if op == "ENTER" and addr == irq_num:
-                        trigger_vals[cur_trigger_val] += 1
-                print(repr(trigger_vals))
-                real_val = 0x00000000
-                for val, onoff in trigger_vals.items():
-                    if onoff > 0:
-                        real_val |= val
-                    else:
-                        real_val ^= val
-                print("Refined trigger value is %#08x" % real_val)
-                irq_triggers[irq_num] = (trigger_addr, real_val)
-
-        # Step 4: Timing-based stuff
-        interrupt_timings = {}  # Map of interrupt_number to inter-interrupt timings.
-        for peripheral_cluster, irq_num in interrupt_mapping.items():
-            timings = []
-            peripheral_addrs = peripheral_clusters[peripheral_cluster]
-            if not irq_triggers.has_key(irq_num):
-                continue
-            trigger_addr, trigger_val = irq_triggers[irq_num]
-            # here we go, collect the EXIT-to-ENTER timings, plus the initial trigger-to-enter timing.
-            # Stop if we see a disable.
-            trigger_state = None
-            trigger_time = None
-            for x in range(0, len(full_trace)):
-                op, id, addr, val, pc, size, timestamp = full_trace[x]
-                if op == "WRITE" and addr == trigger_addr and val == trigger_val:
-                    trigger_state = x
-                    trigger_time = timestamp
-                    break
-            else:
-                # Bug.
-                raise RuntimeError("Bug related to trigger-finding")
-            prev_time = trigger_time
-            disabled = False
-            for state in range(trigger_state + 1, len(full_trace)):
-                op, id, addr, val, pc, size, timestamp = full_trace[state]
-                addr = int(addr)
-                if op == "ENTER":
-                    print repr(addr), repr(irq_num)
-                    if addr == irq_num and not disabled:
-                        timing = timestamp - prev_time
-                        timings.append(timing)
-                        entered = True
-                elif op == 'EXIT':
-                    if addr == irq_num and entered:
-                        prev_time = timestamp
-                        entered = False
-                elif op == 'WRITE' and addr == trigger_addr and val != trigger_val:
-                    print "Interrupt disabled by write of %#08x" % val
-                    disabled = True
-                    # I think we just turned it off.
-                elif op == 'WRITE' and addr == trigger_addr and val == trigger_val:
-                    print "Turned on via write to trigger"
-                    disabled = False
-            logger.info("Got timings for interrupt %d" % (irq_num))
-            logger.info("Mean: %f" % numpy.mean(timings))
-            logger.info("Stdv: %f" % numpy.std(timings))
-            interrupt_timings[irq_num] = timings
-
-        return interrupt_mapping, irq_triggers, interrupt_timings, oneshots
+        # The steps are done by an InterruptAccumulator, which only needs to
+        # see the trace once (see TrainingPass)
+        interrupts = InterruptAccumulator(peripheral_clusters,
+                                          self.associate_with_cluster)
+        for row, event in enumerate(trace.rows(runs=True)):
+            op, id, addr, val, pc, size, timestamp, count, last_timestamp = \
+                event
+            interrupts.feed(row, op, addr, val, timestamp, event[:7], count)
+        return interrupts.finish()
 
     def associate_with_cluster(self, activity, peripheral_clusters):
+        """
+        Vote for the peripheral that the invocations of an ISR talked to
+
+        :param activity: The invocations of the ISR
+        :param peripheral_clusters: PeripheralMap (or the clusters to build
+        it from)
+        :return: Cluster number, or -1
+        """
+        if not isinstance(peripheral_clusters, PeripheralMap):
+            peripheral_clusters = PeripheralMap.from_clusters(
+                peripheral_clusters)
         votes = defaultdict(int)
         real_winner = -1
         for a in activity:
             act = a['trace']
+            # Runs of identical reads get as many votes as reads
+            counts = a.get('counts', [1] * len(act))
             my_votes = defaultdict(int)
             my_winner = -1
-            for event in act:
+            for event, count in zip(act, counts):
                 # Vote in every ISR invocation
                 try:
                     op, id, addr, val, pc, size, timestamp = event
                 except ValueError:
                     continue
-                for k, v in peripheral_clusters.items():
-                    if addr in v:
-                        my_votes[k] += 1
-                        break
+                # (ENTER/EXIT have an IRQ number rather than an address)
+                if op != 'READ' and op != 'WRITE':
+                    continue
+                k = peripheral_clusters.lookup(addr)
+                if k != -1:
+                    my_votes[k] += count
             for cluster, count in my_votes.items():
                 if 0 < count and count > my_votes[my_winner]:
                     my_winner = cluster
@@ -296,32 +166,30 @@ class PretenderModel:
         pickle.dump(self.__dict__, f)
         f.close()
 
-    def train(self, filename):
+    def train(self, trace, jobs=1):
         """
         Train our model, potentially using a specific training model
+
+        :param trace: TraceTable (or the filename of a recording to load)
+        :param jobs: Number of processes training the peripherals (None: one
+        per core, 1: train them here, in the same pass that infers the
+        interrupts)
         :return:
         """
-        logger.info("Training hardware pretender (%s)" % filename)
-
-        l = LogReader(filename)
+        if not isinstance(trace, TraceTable):
+            trace = TraceTable.load(trace)
+        logger.info("Training hardware pretender (%s)" % trace.filename)
 
         ##
         ## Step 0: Gather the set of addresses
         ##
-        for line in l:
-            try:
-                op, id, addr, val, pc, size, timestamp = line
-            except ValueError:
-                logger.warning("Weird line: " + repr(line))
-                continue
-            if op == "READ" or op == "WRITE":
-                self.accessed_addresses.add(int(addr))
-        l.close()
+        self.accessed_addresses |= trace.accessed_addresses()
 
         ##
         # Step 1: Divide the possible addresses into peripherals
         ##
-        self.peripheral_clusters = cluster_peripherals(list(self.accessed_addresses))
+        self.peripheral_clusters = cluster_peripherals(
+            sorted(self.accessed_addresses))
         for x in self.peripheral_clusters:
             print "%d:" % x
             for y in self.peripheral_clusters[x]:
@@ -329,14 +197,23 @@ class PretenderModel:
         #import IPython; IPython.embed()
         ##
         # Step 2: Associate interrupts, their triggers, and their timings with a
-        #  peripheral
+        #  peripheral.  When we train here, the states of every peripheral are
+        #  built in the same pass over the trace.
         ##
-        l = LogReader(filename)
-        interrupt_mappings, interrupt_triggers, interrupt_timings, oneshots = \
-            self.infer_interrupt_association(l, self.peripheral_clusters)
-        l.close()
+        peripherals = {}
+        for periph_id, periph_addrs in self.peripheral_clusters.items():
+            peripherals[periph_id] = PeripheralModel(periph_addrs)
+        if jobs == 1:
+            training = TrainingPass(peripherals, self.peripheral_clusters,
+                                    self.associate_with_cluster)
+            training.run(trace)
+            interrupt_mappings, interrupt_triggers, interrupt_timings, \
+                oneshots = training.interrupts.finish()
+        else:
+            interrupt_mappings, interrupt_triggers, interrupt_timings, \
+                oneshots = self.infer_interrupt_association(
+                    trace, self.peripheral_clusters)
         #import IPython; IPython.embed()
-        # Add our peripheral for each of its memory addresses
         for periph_id, periph_addrs in self.peripheral_clusters.items():
             irq_num = None
             interrupt_trigger = None
@@ -356,18 +233,32 @@ class PretenderModel:
                 one_shot = False
 
             #import IPython; IPython.embed()
-            peripheral = PeripheralModel(periph_addrs,
-                               irq_num=irq_num,
-                               interrupt_trigger=interrupt_trigger,
-                               interrupt_timings=interrupt_timing,
-                               interrupt_oneshot=one_shot)
+            peripheral = peripherals[periph_id]
+            peripheral.irq_num = irq_num
+            peripheral.interrupt_trigger = interrupt_trigger
+            peripheral.interrupt_timings = interrupt_timing
+            peripheral.interrupt_oneshot = one_shot
+
+        ##
+        # Step 3: Train our peripherals
+        ##
+        periph_ids = self.peripheral_clusters.keys()
+        if jobs == 1:
+            # (their states were built in the pass above)
+            for periph_id in periph_ids:
+                training.builders[periph_id].finish()
+        else:
+            trained = train_peripherals([peripherals[i] for i in periph_ids],
+                                        trace, jobs=jobs)
+            peripherals = dict(zip(periph_ids, trained))
+
+        # Add our peripheral for each of its memory addresses
+        for periph_id in periph_ids:
+            peripheral = peripherals[periph_id]
             self.peripherals.append(peripheral)
-            for addr in periph_addrs:
+            for addr in peripheral.addresses:
                 self.model_per_address[addr] = peripheral
 
-            # Train our peripheral
-            peripheral.train(filename)
-
         return True
 
         """
@@ -571,6 +462,99 @@ class PretenderModel:
                 periph.models[addr] = mdl
                 self.model_per_address[addr]['model'] = periph
 
+    def update(self, trace, jobs=1):
+        """
+        Fold a new recording into this (already trained) model: new addresses
+        extend our peripherals (or make new ones), and the states of the new
+        recording are trained on their own and merged into ours, as when
+        models trained on every recording are merged.  The models of the
+        recordings that we were trained on are not fitted again.
+
+        :param trace: TraceTable (or the filename of a recording to load)
+        :param jobs: Number of processes fitting the models (None: one per
+        core)
+        :return:
+        """
+        if not isinstance(trace, TraceTable):
+            trace = TraceTable.load(trace)
+        logger.info("Updating hardware pretender (%s)" % trace.filename)
+
+        addresses = trace.accessed_addresses()
+        new_addresses = addresses - self.accessed_addresses
+        if new_addresses:
+            logger.info("New addresses: %s" % repr(
+                [hex(x) for x in sorted(new_addresses)]))
+        self.accessed_addresses |= addresses
+        self.peripheral_clusters = cluster_peripherals(
+            sorted(self.accessed_addresses))
+
+        # Clusters only grow with more addresses, so each of our peripherals
+        # is in exactly one of them
+        peripheral_map = PeripheralMap.from_clusters(self.peripheral_clusters)
+        old_peripherals = defaultdict(list)
+        for peripheral in self.peripherals:
+            old_peripherals[peripheral_map.lookup(
+                min(peripheral.addresses))].append(peripheral)
+        peripherals = {}
+        for periph_id, periph_addrs in self.peripheral_clusters.items():
+            group = old_peripherals[periph_id]
+            if not group:
+                continue
+            peripheral = group[0]
+            if peripheral.addresses != periph_addrs:
+                logger.info("Peripheral %d grew to %s" % (
+                    periph_id, repr([hex(x) for x in sorted(periph_addrs)])))
+                peripheral.addresses = periph_addrs
+                for addr in periph_addrs:
+                    peripheral.models.setdefault(addr, None)
+            for other in group[1:]:
+                peripheral.merge(other)
+            peripherals[periph_id] = peripheral
+
+        # Build the states of the new recording on peripherals of their own,
+        # and look for interrupts
+        recorded = {}
+        for periph_id, periph_addrs in self.peripheral_clusters.items():
+            recorded[periph_id] = PeripheralModel(periph_addrs)
+        training = TrainingPass(recorded, self.peripheral_clusters,
+                                self.associate_with_cluster)
+        training.run(trace)
+
+        # Only fit the new recording, and merge it in (new peripherals are
+        # just what it has)
+        scheduler = FitScheduler(jobs)
+        for periph_id in recorded:
+            training.builders[periph_id].finish(scheduler)
+        logger.info("Fitting %d models" % len(scheduler))
+        scheduler.run()
+        for periph_id in self.peripheral_clusters:
+            if periph_id in peripherals:
+                peripherals[periph_id].merge_states(recorded[periph_id])
+            else:
+                logger.info("New peripheral %d" % periph_id)
+                peripherals[periph_id] = recorded[periph_id]
+
+        interrupt_mappings, interrupt_triggers, interrupt_timings, oneshots = \
+            training.interrupts.finish()
+        for periph_id, peripheral in peripherals.items():
+            # Keep the interrupts that we already knew about
+            if peripheral.irq_num is not None or \
+                    periph_id not in interrupt_mappings:
+                continue
+            irq_num = interrupt_mappings[periph_id]
+            logger.info("Peripheral %d has IRQ %d" % (periph_id, irq_num))
+            peripheral.irq_num = irq_num
+            peripheral.interrupt_trigger = interrupt_triggers.get(irq_num)
+            peripheral.interrupt_timings = interrupt_timings.get(irq_num)
+            peripheral.interrupt_oneshot = irq_num in oneshots
+
+        self.peripherals = [peripherals[periph_id] for periph_id in
+                            self.peripheral_clusters]
+        for peripheral in self.peripherals:
+            for addr in peripheral.addresses:
+                self.model_per_address[addr] = peripheral
+        return True
+
     def get_model(self, address):
         """
         return the name of the model that is controlling the address
@@ -707,7 +691,7 @@ class PretenderModel:
         # Generate new peripherals, based on *all* of the observed addresses
         pm = PretenderModel()
         all_addresses = self.accessed_addresses | other_model.accessed_addresses
-        pm.peripheral_clusters = cluster_peripherals(list(all_addresses))
+        pm.peripheral_clusters = cluster_peripherals(sorted(all_addresses))
 
         # we merge both of the peripherals into the new one
         new_peripherals = []
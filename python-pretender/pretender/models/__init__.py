@@ -4,9 +4,13 @@ import abc
 class MemoryModel(object):
     __metaclass__ = abc.ABCMeta
 
+    # Does training look at the timestamps of the reads (or just the values)?
+    uses_timestamps = False
+
     @abc.abstractmethod
-    def train(self, read_log):
-        """ train our model """
+    def train(self, read_log, stats=None):
+        """ train our model (stats: the ReadStats of the read log, if we
+        have them already) """
         return
 
     @abc.abstractmethod
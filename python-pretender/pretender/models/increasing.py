@@ -1,9 +1,12 @@
 import logging
 
-import time
+import numpy
 
 logger = logging.getLogger(__name__)
+from pretender.clock import emulation_clock, to_seconds
 from pretender.models import MemoryModel
+from pretender.readlog import ReadStats, log_columns
+from pretender.regression import LinearFit
 
 
 class IncreasingModel(MemoryModel):
@@ -19,6 +22,7 @@ class IncreasingModel(MemoryModel):
     In these cases we will return an exact replay of the recorded data,
     and only 'predict' new values when the recorded data has run out
     """
+    uses_timestamps = True
 
     def __init__(self):
         """
@@ -46,17 +50,32 @@ class IncreasingModel(MemoryModel):
     def __repr__(self):
         return "<IncreasingModel y = %f*X + %f>" % (self.slope, self.intercept)
 
-    def train(self, log):
+    def train(self, log, stats=None):
+        if stats is None:
+            stats = ReadStats(log)
 
-        read_times = []
-        read_values = []
-        for val, pc, size, timestamp in log:
-            read_times.append(float(timestamp))
-            read_values.append(int(val))
-
-        if not self.fits_model(read_values):
+        # Don't bother collecting the points if they don't go up anyway
+        if not self.fits_stats(stats):
             return False
 
+        values, timestamps, counts, last_timestamps = log_columns(
+            log, 'value', 'timestamp', 'count', 'last_timestamp')
+
+        # A run held the same value from its first to its last read, so it
+        # is two points
+        runs = counts > 1
+        first = numpy.arange(len(values)) + numpy.cumsum(runs) - runs
+        read_times = numpy.empty(stats.samples, dtype=numpy.float64)
+        read_values = numpy.empty(stats.samples, dtype=numpy.int64)
+        read_times[first] = timestamps
+        read_values[first] = values
+        read_times[first[runs] + 1] = last_timestamps[runs]
+        read_values[first[runs] + 1] = values[runs]
+        # The log has integer nanoseconds, read() goes by the clock,
+        # in seconds
+        read_times = to_seconds(read_times).tolist()
+        read_values = read_values.tolist()
+
         # Update our globals
         self.replay_reads = read_values
         self.model_trained = False
@@ -68,27 +87,30 @@ class IncreasingModel(MemoryModel):
 
         return True
 
-    def train_model(self, x, y, max_size=1000):
+    def train_model(self, x, y, max_size=None):
         """
         Train our model to a linear regression
-        :param max_size:
+
+        Reads at the start that are way off the line (e.g., before the timer
+        was set up) are outliers: they are left out of the line and replayed
+        verbatim instead.  All the outliers at the start are taken out at
+        once, and the rest of the points are tested again, until the first
+        one is fine.
+
+        :param max_size: Only use the first max_size points (None: all)
         :param x: timestamp values
         :param y:
         :return:
         """
-        # Imports
         logger.debug("Training LinearIncreasing model...")
 
-        from statsmodels.formula.api import ols
-        from scipy import stats
-
         # Adjust our X values
-        first_x = x[0]
-        fixed_x = [i - x[0] for i in x]
+        fixed_x = numpy.asarray(x, dtype=numpy.float64) - x[0]
+        values = numpy.asarray(y, dtype=numpy.float64)
 
-        if max_size > 0:
+        if max_size:
             fixed_x = fixed_x[:max_size]
-            y = y[:max_size]
+            values = values[:max_size]
 
         # Is it just a constant value?
         if len(fixed_x) == 1:
@@ -96,59 +118,32 @@ class IncreasingModel(MemoryModel):
             self.intercept = fixed_x[0]
             return
 
-        # self.slope, self.intercept, self.r_value, self.p_value, self.std_err = \
-        #     stats.linregress(fixed_x, y)
-        # from matplotlib import pyplot
-        # pyplot.scatter(fixed_x, y)
-        # linear_y = [i * self.slope + self.intercept for i in fixed_x]
-        # pyplot.plot(fixed_x, linear_y)
-        # pyplot.show()
-        #
-        # print "Removing outliers"
         # Let's remove our outliers
+        fit = LinearFit(fixed_x, values)
+        first = 0
         while True:
-            try:
-
-                # Make fit
-                logger.debug("Fitting model with %d points" % len(fixed_x))
-                regression = ols("data ~ x", data=dict(data=y, x=fixed_x)).fit()
-
-                # Find outliers
-                logger.debug("Testing outliers")
-                test = regression.outlier_test()
-                # print test
-                outliers = ((x[i], y[i], i) for i, t in enumerate(test.iloc[:,
-                                                                  2]) if t <
-                            self.outlier_threshold)
-                outliers = list(outliers)
-                logger.debug("Got %d outliers" % len(outliers))
-                if len(outliers) == 0:
-                    break
-
-                # Delete our outliers
-                removed = False
-                for i, j, idx in outliers:
-                    if idx == 0:
-                        self.outliers_replay.append(y[idx])
-                        del fixed_x[idx]
-                        del y[idx]
-                        removed = True
-
-                if not removed:
-                    break
-
-            except:
-                import traceback
-                logger.exception("Error training model")
+            logger.debug("Testing outliers (%d points)" % fit.n)
+            outliers = fit.outliers(fixed_x[first:], values[first:],
+                                    self.outlier_threshold)
+            logger.debug("Got %d outliers" % numpy.count_nonzero(outliers))
+
+            # Only the ones at the start (and leave at least a line)
+            leading = len(outliers) if outliers.all() else \
+                int(numpy.argmin(outliers))
+            leading = min(leading, fit.n - 2)
+            if leading <= 0:
                 break
+            self.outliers_replay.extend(y[first:first + leading])
+            fit.remove(fixed_x[first:first + leading],
+                       values[first:first + leading])
+            first += leading
 
         # Re-adjust X
-        fixed_x = [i - fixed_x[0] for i in fixed_x]
-
-        self.last_observed_time_adjusted = fixed_x[-1]
+        self.last_observed_time_adjusted = fixed_x[-1] - fixed_x[first]
 
         self.slope, self.intercept, self.r_value, self.p_value, self.std_err = \
-            stats.linregress(fixed_x, y)
+            fit.linregress(fixed_x[first:], values[first:],
+                          origin=fixed_x[first])
 
         # Sometimes initial values may be setup, let's see if our error goes
         # way down if we filter them, and create our function from that.
@@ -191,7 +186,7 @@ class IncreasingModel(MemoryModel):
             self.read_count += 1
             return self.outliers_replay[self.read_count - 1]
         elif self.read_count == len(self.outliers_replay):
-            self.first_guess_time = time.time()
+            self.first_guess_time = emulation_clock().time()
         self.read_count += 1
 
         if not self.model_trained:
@@ -199,7 +194,7 @@ class IncreasingModel(MemoryModel):
             self.model_trained = True
 
         # time*[calculated slope] + [intercept]
-        fixed_time = time.time() - self.first_guess_time
+        fixed_time = emulation_clock().time() - self.first_guess_time
         return int(fixed_time * self.slope + self.intercept)
 
     def merge(self, other_model):
@@ -233,10 +228,6 @@ class IncreasingModel(MemoryModel):
         :return:
         """
 
-        if len(reads) < 3:
-            return False
-
-        increasing_threshold = .5
         last_read = 0
         first = True
         idx = 0
@@ -253,11 +244,39 @@ class IncreasingModel(MemoryModel):
 
             idx += 1
 
+        return IncreasingModel._mostly_increasing(
+            len(reads), len(not_increasing),
+            not_increasing[-1] if not_increasing else None)
+
+    @staticmethod
+    def fits_stats(stats):
+        """
+        fits_model(), on the points that train() would fit
+
+        :param stats: ReadStats of the read log
+        :return:
+        """
+        return IncreasingModel._mostly_increasing(
+            stats.samples, stats.decreases, stats.last_decrease)
+
+    @staticmethod
+    def _mostly_increasing(n, decreases, last_decrease):
+        """
+        :param n: Number of reads
+        :param decreases: How many of them were lower than the one before
+        :param last_decrease: Index of the last one that was (or None)
+        :return:
+        """
+        if n < 3:
+            return False
+
+        increasing_threshold = .5
+
         # does the final half increase?
-        if len(not_increasing) == 0:
+        if decreases == 0:
             return True
-        elif len(not_increasing) < increasing_threshold * len(reads) and \
-                        not_increasing[-1] < increasing_threshold * len(reads):
+        elif decreases < increasing_threshold * n and \
+                        last_decrease < increasing_threshold * n:
             return True
         else:
             return False
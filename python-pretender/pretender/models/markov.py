@@ -37,7 +37,7 @@ class MarkovModel(MemoryModel):
         line_val = int(line[0])
         return val == line_val
 
-    def train(self, log):
+    def train(self, log, stats=None):
         """
         Train the model to find the best "window" of values given a test function.
         :return:
@@ -2,7 +2,8 @@ import collections
 import logging
 from pretender.models import MemoryModel
 from pretender.logger import LogReader
-import random
+from pretender.readlog import ReadStats
+from pretender.sampler import DiscreteSampler
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -18,30 +19,31 @@ class MarkovModel(MemoryModel):
     Models are trained to find, for each state, a set of data that satisfy a provided test function.
 
     """
+    # (Models pickled before we had samplers don't have one)
+    _sampler = None
 
     def __init__(self):
         self.storage_recall = {}
         self.value_distribution = collections.OrderedDict()
         self.total_reads = 0
         self.value = 0
+        self._sampler = None
 
     def __repr__(self):
         return "<MarkovModel: %s>" % str(self.value_distribution)
 
-    def train(self, read_log):
-        self.total_reads += len(read_log)
-        for val, pc, size, timestamp in read_log:
+    def train(self, read_log, stats=None):
+        if stats is None:
+            stats = ReadStats(read_log)
+
+        self.total_reads += stats.total
+        for val in stats.values:
             if val not in self.storage_recall:
                 self.storage_recall[val] = 0.0
 
-            self.storage_recall[val] += 1.0
+            self.storage_recall[val] += stats.histogram[val]
 
-        cumulative_probability = 0.0
-        for val in self.storage_recall:
-            probability = 1.0 * self.storage_recall[val] / (
-            1.0 * self.total_reads)
-            cumulative_probability += probability
-            self.value_distribution[cumulative_probability] = val
+        self._update_distribution()
 
         logger.debug("Trained MarkovModel (%s)" % repr(self.value_distribution))
         return True
@@ -49,16 +51,32 @@ class MarkovModel(MemoryModel):
     def write(self, value):
         return True
 
-    def read(self):
+    def _update_distribution(self):
+        """ Get the distribution of our values from their counts """
+        if isinstance(self.value_distribution, collections.OrderedDict):
+            self.value_distribution.clear()
+        else:
+            # (merge() used to make it a plain dict)
+            self.value_distribution = collections.OrderedDict()
+        cumulative_probability = 0.0
+        for val in self.storage_recall:
+            probability = 1.0 * self.storage_recall[val] / (
+            1.0 * self.total_reads)
+            cumulative_probability += probability
+            self.value_distribution[cumulative_probability] = val
 
-        # Pick a random index within the total number of reads
-        rand_idx = random.random()
+        if self.storage_recall:
+            self._sampler = DiscreteSampler(self.storage_recall.keys(),
+                                            self.storage_recall.values())
 
-        # Loop over all of our total observed reads until we sum to the index
-        for cumulative_probability in self.value_distribution:
+    def read(self):
+        if self._sampler is None:
+            self._update_distribution()
+            if self._sampler is None:
+                return None
 
-            if rand_idx < cumulative_probability:
-                return self.value_distribution[cumulative_probability]
+        # Pick a value, as likely as it was while training
+        return self._sampler.sample()
 
     def merge(self, other_model):
         if type(other_model) != type(self):
@@ -74,13 +92,7 @@ class MarkovModel(MemoryModel):
             else:
                 self.storage_recall[val] += other_model.storage_recall[val]
 
-        cumulative_probability = 0.0
-        self.value_distribution = {}
-        for val in self.storage_recall:
-            probability = 1.0 * self.storage_recall[val] / (
-            1.0 * self.total_reads)
-            cumulative_probability += probability
-            self.value_distribution[cumulative_probability] = val
+        self._update_distribution()
 
         return True
 
@@ -1,14 +1,20 @@
 import collections
 import logging
-import random
 
-import sys
+import numpy
 
 logger = logging.getLogger(__name__)
 from pretender.models import MemoryModel
+from pretender.period import segment_hashes
+from pretender.readlog import ReadStats
+from pretender.sampler import DiscreteSampler
 
 
 class MarkovPatternModel(MemoryModel):
+    # (Models pickled before we had samplers don't have them)
+    _static_sampler = None
+    _pattern_sampler = None
+
     def __init__(self):
         self.total_static_patterns = 0
         self.total_patterns = 0
@@ -26,6 +32,8 @@ class MarkovPatternModel(MemoryModel):
         self.replay_static = True
         self.replay_static_count_current = 0
         self.replay_static_count = 0
+        self._static_sampler = None
+        self._pattern_sampler = None
 
     def __str__(self):
         return "<MarkovPatternModel %s, %s>" % (self.static_value,
@@ -40,8 +48,8 @@ class MarkovPatternModel(MemoryModel):
         return True
 
     def read(self):
-        # Pick a random index within the total number of reads
-        rand_idx = random.random()
+        if self._static_sampler is None and self._pattern_sampler is None:
+            self._update_distributions()
 
         # Should we replay the static value?  Just pick how many times
         if self.replay_static:
@@ -57,11 +65,9 @@ class MarkovPatternModel(MemoryModel):
 
                 return self.static_value
 
-            # Loop over all of our total observed reads until we sum to the index
-            for cumulative_probability in self.static_distribution:
-                if rand_idx < cumulative_probability:
-                    self.replay_static_count = self.static_distribution[
-                        cumulative_probability]
+            # Pick how many times, as likely as it was while training
+            if self._static_sampler is not None:
+                self.replay_static_count = self._static_sampler.sample()
 
             self.replay_static_count_current = 1
             return self.static_value
@@ -81,13 +87,45 @@ class MarkovPatternModel(MemoryModel):
                     self.pattern_index += 1
                     return self.pattern_current[self.pattern_index]
 
-            # Loop over all of our total observed reads until we sum to the index
-            for cumulative_probability in self.pattern_distribution:
-                if rand_idx < cumulative_probability:
-                    self.pattern_current = self.pattern_distribution[
-                        cumulative_probability]
-                    self.pattern_index = 1
-                    return self.pattern_current[0]
+            # Pick a pattern, as likely as it was while training
+            if self._pattern_sampler is not None:
+                self.pattern_current = self._pattern_sampler.sample()
+                self.pattern_index = 1
+                return self.pattern_current[0]
+
+    def _update_distributions(self):
+        """
+        Get the distributions of the static value counts and of the sub
+        patterns from how many times we saw them
+        """
+        self.static_distribution.clear()
+        self.pattern_distribution.clear()
+
+        # Get the distribution for our static value
+        cumulative_probability = 0.0
+        for count in self.static_value_count:
+            probability = 1.0 * self.static_value_count[count] / (
+                1.0 * self.total_static_patterns)
+            cumulative_probability += probability
+            self.static_distribution[cumulative_probability] = count
+
+        # Get the distribution for our sub patterns
+        cumulative_probability = 0.0
+        for p in self.patterns:
+            probability = 1.0 * self.patterns[p] / (
+                1.0 * self.total_patterns)
+            cumulative_probability += probability
+            self.pattern_distribution[cumulative_probability] = p
+
+        self._static_sampler = None
+        if self.static_value_count:
+            self._static_sampler = DiscreteSampler(
+                self.static_value_count.keys(),
+                self.static_value_count.values())
+        self._pattern_sampler = None
+        if self.patterns:
+            self._pattern_sampler = DiscreteSampler(self.patterns.keys(),
+                                                    self.patterns.values())
 
     def merge(self, other_model):
         if type(other_model) != type(self):
@@ -115,21 +153,7 @@ class MarkovPatternModel(MemoryModel):
         self.total_static_patterns += other_model.total_static_patterns
         self.total_patterns += other_model.total_patterns
 
-        # Get the distribution for our static value
-        cumulative_probability = 0.0
-        for count in self.static_value_count:
-            probability = 1.0 * self.static_value_count[count] / (
-                1.0 * self.total_static_patterns)
-            cumulative_probability += probability
-            self.static_distribution[cumulative_probability] = count
-
-        # Get the distribution for our sub patterns
-        cumulative_probability = 0.0
-        for p in self.patterns:
-            probability = 1.0 * self.patterns[p] / (
-                1.0 * self.total_patterns)
-            cumulative_probability += probability
-            self.pattern_distribution[cumulative_probability] = p
+        self._update_distributions()
 
         logger.debug(
             "Merged MarkovPatternModel (%s, %s)" % (
@@ -138,90 +162,57 @@ class MarkovPatternModel(MemoryModel):
 
         return True
 
-    def train(self, log):
+    def train(self, log, stats=None):
         """
         Attempt to train as a pattern model that has probabilistic sub-patterns
 
+        The reads are cut into blocks of the static value and blocks of
+        anything else (the patterns): we count how many times every number of
+        static reads came before a pattern, and how many times every pattern
+        showed up.
+
         :param log:
+        :param stats: ReadStats of the log
         :return:
         """
-        # Only extract our read values
-        reads = [x[0] for x in log]
+        if stats is None:
+            stats = ReadStats(log)
 
         # Extract our static value
-        self.static_value = self._get_static_value(reads)
+        self.static_value = stats.majority_value
 
         # No value that shows up a majority of the time?
         if self.static_value is None:
             return False
 
+        # Only extract our read values (and how many times in a row we saw
+        # them)
+        values, counts = stats.run_columns()
+        static = values == self.static_value
+
         # Should we start with the static value or a pattern?
-        if reads[0] != self.static_value:
+        if not static[0]:
             self.replay_static = False
 
-        # Let's store all of our patterns and counts for static value
-        static_count = 0
-        pattern = []
-
-        # Extract all of our patterns and counts for our static value
-        first = True
-        for val in reads:
-
-            # See our static value, let's store our pattern, or update the count
-            if val == self.static_value:
-
-                # add our pattern to be replayed later
-                if len(pattern) > 0:
-                    pattern = tuple(pattern)
-                    if pattern not in self.patterns:
-                        self.patterns[pattern] = 0
-
-                    self.patterns[pattern] += 1
-                    self.total_patterns += 1
-                    pattern = []
-
-                static_count += 1
-            else:
-
-                # New pattern?
-                if len(pattern) == 0 and not first:
-                    # Save the count for static observations
-                    if static_count not in self.static_value_count:
-                        self.static_value_count[static_count] = 0
-                        self.static_value_count[static_count] += 1
-                    static_count = 0
+        # Where do the blocks start, and how many reads are in them?
+        starts = numpy.flatnonzero(static[1:] != static[:-1]) + 1
+        starts = numpy.concatenate(([0], starts))
+        block_static = static[starts]
+        block_reads = numpy.add.reduceat(counts, starts)
 
-                    self.total_static_patterns += 1
+        # Counts for our static value (only if a pattern came after them)
+        static_counts = block_reads[block_static]
+        if block_static[-1]:
+            static_counts = static_counts[:-1]
+        self._count_static(static_counts)
 
-                # Start recording our pattern
-                pattern.append(val)
+        # Our patterns, with the runs expanded
+        pattern_reads = numpy.repeat(values[~static], counts[~static])
+        ends = numpy.cumsum(block_reads[~block_static])
+        self._count_patterns(pattern_reads, ends - block_reads[~block_static],
+                             ends)
 
-            first = False
-
-        # add our pattern to be replayed later
-        if len(pattern) > 0:
-            pattern = tuple(pattern)
-            if pattern not in self.patterns:
-                self.patterns[pattern] = 0
-
-            self.patterns[pattern] += 1
-            self.total_patterns += 1
-
-        # Get the distribution for our static value
-        cumulative_probability = 0.0
-        for count in self.static_value_count:
-            probability = 1.0 * self.static_value_count[count] / (
-                1.0 * self.total_static_patterns)
-            cumulative_probability += probability
-            self.static_distribution[cumulative_probability] = count
-
-        # Get the distribution for our sub patterns
-        cumulative_probability = 0.0
-        for p in self.patterns:
-            probability = 1.0 * self.patterns[p] / (
-                1.0 * self.total_patterns)
-            cumulative_probability += probability
-            self.pattern_distribution[cumulative_probability] = p
+        self._update_distributions()
 
         logger.debug(
             "Trained MarkovPatternModel (%s, %s)" % (
@@ -230,27 +221,54 @@ class MarkovPatternModel(MemoryModel):
 
         return True
 
-    @staticmethod
-    def _get_static_value(reads):
+    def _count_static(self, static_counts):
         """
-        Return the value that is most frequent
-        :param reads:
+        :param static_counts: numpy array, number of static reads before every
+        pattern
         :return:
         """
-        # Count the frequency of all of the reads
-        read_count = {}
-        for val in reads:
-            if val not in read_count:
-                read_count[val] = 0
-
-            read_count[val] += 1
-
-        # Is a single value a majority of the read values?
-        for val in read_count:
-            if read_count[val] > 0.5 * len(read_count):
-                return val
-
-        return None
+        distinct, first, times = numpy.unique(static_counts, return_index=True,
+                                              return_counts=True)
+        # (In the order in which we first saw them, like we always did)
+        order = numpy.argsort(first, kind='mergesort')
+        for count, n in zip(distinct[order].tolist(), times[order].tolist()):
+            self.static_value_count[count] = \
+                self.static_value_count.get(count, 0) + n
+        self.total_static_patterns += len(static_counts)
+
+    def _count_patterns(self, reads, starts, ends):
+        """
+        :param reads: numpy array, the reads of all of the patterns
+        :param starts: numpy array, where every pattern starts in reads
+        :param ends: numpy array, where every pattern ends
+        :return:
+        """
+        if len(starts) == 0:
+            return
+        _, first, inverse, times = numpy.unique(
+            segment_hashes(reads, starts, ends), return_index=True,
+            return_inverse=True, return_counts=True)
+
+        # Make sure that the patterns that hash the same are the same
+        lengths = ends - starts
+        same = first[inverse]
+        offsets = numpy.arange(len(reads)) - numpy.repeat(starts, lengths)
+        if not numpy.array_equal(lengths, lengths[same]) or \
+                not numpy.array_equal(reads, reads[numpy.repeat(
+                    starts[same], lengths) + offsets]):
+            logger.warning("Hash collision between patterns, counting them "
+                           "one at a time")
+            first = range(len(starts))
+            times = [1] * len(starts)
+
+        order = numpy.argsort(first, kind='mergesort')
+        starts, ends = starts.tolist(), ends.tolist()
+        first, times = numpy.asarray(first).tolist(), \
+            numpy.asarray(times).tolist()
+        for i in order.tolist():
+            pattern = tuple(reads[starts[first[i]]:ends[first[i]]].tolist())
+            self.patterns[pattern] = self.patterns.get(pattern, 0) + times[i]
+        self.total_patterns += len(starts)
 
     @staticmethod
     def fits_model(log):
@@ -269,7 +287,4 @@ class MarkovPatternModel(MemoryModel):
         # if len(reads) < 2:
         #     return False
 
-        # Only extract our read values
-        reads = [x[0] for x in log]
-
-        return MarkovPatternModel._get_static_value(reads) is not None
+        return ReadStats(log).majority_value is not None
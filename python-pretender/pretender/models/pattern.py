@@ -2,6 +2,8 @@ import logging
 
 logger = logging.getLogger(__name__)
 from pretender.models import MemoryModel
+from pretender.period import smallest_period
+from pretender.readlog import ReadStats
 
 
 class PatternModel(MemoryModel):
@@ -38,19 +40,22 @@ class PatternModel(MemoryModel):
 
         return True
 
-    def train(self, log):
+    def train(self, log, stats=None):
         """
         Attempt to try a pattern model, or return False if no pattern is
         detected
 
         :param log:
+        :param stats: ReadStats of the log
         :return:
         """
+        if stats is None:
+            stats = ReadStats(log)
 
-        # Only extract our read values
-        reads = [x[0] for x in log]
-
-        self.read_pattern = self.get_pattern(reads)
+        # (The period comes from the runs, and only the reads of the pattern
+        # get expanded, so long polling runs never do)
+        self.read_pattern = stats.expanded(
+            self._pattern_length(stats.period, stats.total))
 
         if self.read_pattern is None:
             return False
@@ -60,46 +65,34 @@ class PatternModel(MemoryModel):
     @staticmethod
     def get_pattern(reads):
         """
-        Extract a pattern out of a stream of read values
+        Extract a pattern out of a stream of read values: the shortest
+        sequence that the reads repeat (ignoring an incomplete repetition at
+        the end), if they repeat it often enough, or else all of them
 
         NOTE: We assume that any stream is a pattern!  When merging we will
         find out if the pattern is the wrong thing to do.
 
-        :param reads:
+        :param reads: list (or numpy array) of read values
         :return:
         """
+        return reads[0:PatternModel._pattern_length(smallest_period(reads),
+                                                    len(reads))]
+
+    @staticmethod
+    def _pattern_length(period, total):
+        """
+        :param period: Shortest period of the reads
+        :param total: Number of reads
+        :return: How many reads make up the pattern
+        """
         # Are they all the same?
-        all_same = True
-        for x in reads:
-            if x != reads[0]:
-                all_same = False
-        if all_same:
-            return [reads[0]]
-
-        # Let's see if a repeating pattern exist
-        max_len = len(reads) / 2
-        for seqn_len in range(2, max_len):
-
-            # Do the first 2 at least match as a pattern?
-            if reads[0:seqn_len] == reads[seqn_len:2 * seqn_len]:
-
-                is_pattern = True
-
-                # Let's check all the others, ignoring any incomplete
-                # patterns at the end
-                last_complete_seqn = len(reads) - len(reads) % seqn_len
-                for y in range(2 * seqn_len, last_complete_seqn, seqn_len):
-                    if reads[0:seqn_len] != reads[y:y + seqn_len]:
-                        is_pattern = False
-                        break
-                remainder = reads[-(len(reads) % seqn_len):]
-                if not all(remainder[i] == reads[i] for i in
-                           range(len(remainder))):
-                    is_pattern = False
-                if is_pattern:
-                    return reads[0:seqn_len]
-
-        return reads
+        if period == 1:
+            return 1
+        # Patterns of 2 to len/2 - 1 reads, anything longer doesn't count as
+        # repeating
+        if period < total / 2:
+            return period
+        return total
 
     @staticmethod
     def fits_model(log):
@@ -37,7 +37,7 @@ class SimpleStorageModel(MemoryModel):
 
         return True
 
-    def train(self, log):
+    def train(self, log, stats=None):
         self.value = log[0][0]
         self.init_timestamp = log[0][3]
 
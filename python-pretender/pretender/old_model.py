@@ -16,6 +16,7 @@ from avatar2.peripherals.max32_usart import Max32UART
 from avatar2.targets import TargetStates
 from pretender.logger import LogReader
 from pretender.cluster_peripherals import cluster_peripherals
+from pretender.peripheral_map import PeripheralMap
 import pretender.globals as G
 from interrupts import Interrupter
 logger = logging.getLogger(__name__)
@@ -966,6 +967,9 @@ class OldPretenderModel:
         return interrupt_mapping, irq_triggers, interrupt_timings
 
     def associate_with_cluster(self, activity, peripheral_clusters):
+        if not isinstance(peripheral_clusters, PeripheralMap):
+            peripheral_clusters = PeripheralMap.from_clusters(
+                peripheral_clusters)
         votes = defaultdict(int)
         real_winner = -1
         for a in activity:
@@ -978,10 +982,12 @@ class OldPretenderModel:
                     op, id, addr, val, pc, size, timestamp = event
                 except ValueError:
                     continue
-                for k, v in peripheral_clusters.items():
-                    if addr in v:
-                        my_votes[k] += 1
-                        break
+                # (ENTER/EXIT have an IRQ number rather than an address)
+                if op != 'READ' and op != 'WRITE':
+                    continue
+                k = peripheral_clusters.lookup(addr)
+                if k != -1:
+                    my_votes[k] += 1
             for cluster, count in my_votes.items():
                 if 0 < count and count > my_votes[my_winner]:
                     my_winner = cluster
@@ -1011,7 +1017,7 @@ class OldPretenderModel:
         ## Step 0: Grab the trace and a bunch of the basic stats.  
         ## This includes the set of addresses
         ##
-        l = LogReader(filename)
+        l = LogReader(filename, expand_runs=True, seconds=True)
         addrs = []
         for line in l:
             try:
@@ -1050,7 +1056,7 @@ class OldPretenderModel:
         ##
         ## Step 2: Associate interrupts, their triggers, and their timings with a peripheral
         ##
-        l = LogReader(filename)
+        l = LogReader(filename, expand_runs=True, seconds=True)
         interrupt_mappings, interrupt_triggers, interrupt_timings = self.infer_interrupt_association(l, self.peripheral_clusters)
 
 
@@ -1061,7 +1067,8 @@ class OldPretenderModel:
         ##
         pc_cluster = {}
         trace_by_cluster = {cl: [] for cl in self.peripheral_clusters.keys()}
-        l = LogReader(filename)
+        peripheral_map = PeripheralMap.from_clusters(self.peripheral_clusters)
+        l = LogReader(filename, expand_runs=True, seconds=True)
         for line in l:
             try:
                 op, id, addr, val, pc, size, timestamp = line
@@ -1071,12 +1078,13 @@ class OldPretenderModel:
             addr = int(addr)
             val = int(val)
             pc = int(pc)
-            for cluster, addrs in self.peripheral_clusters.items():
-                if op == 'ENTER' or op == 'EXIT':
-                    if cluster in interrupt_mappings and addr == interrupt_mappings[cluster]:
+            if op == 'ENTER' or op == 'EXIT':
+                for cluster, irq_num in interrupt_mappings.items():
+                    if addr == irq_num:
                         trace_by_cluster[cluster].append((op, id, addr, val, pc, size, timestamp))
-
-                if addr in addrs:
+            else:
+                cluster = peripheral_map.lookup(addr)
+                if cluster != -1:
                     trace_by_cluster[cluster].append((op, id, addr, val, pc, size, timestamp))
             if pc not in pc_cluster:
                 pc_cluster[pc] = {'reads': {},
@@ -0,0 +1,193 @@
+"""
+Finding the shortest pattern that a stream of reads repeats.
+
+The shortest period of a sequence is its length minus the longest proper
+prefix that is also a suffix, which the prefix function (as in
+Knuth-Morris-Pratt) gives in linear time.  Long integer sequences are done
+with numpy instead: every shift p whose suffix hashes the same as the prefix
+of the same length is a candidate period, and the first candidate that
+checks out (values[p:] == values[:-p]) is the shortest period.
+
+Reads that come in runs (of the same value) get their period from the runs
+(smallest_run_period()), so that long polling runs need not be expanded.
+
+The same hashes tell segments of a sequence apart (segment_hashes()), e.g.,
+the patterns of a MarkovPatternModel.
+"""
+import logging
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+# Sequences at least this long (of integers) go through numpy
+VECTORIZE_MIN = 256
+
+# Polynomial hashes modulo two primes (products of two residues fit in an
+# int64)
+_HASHES = ((1000000007, 131), (998244353, 137))
+
+
+def smallest_period(values):
+    """
+    Length of the shortest prefix that the values repeat (the last
+    repetition may be incomplete), i.e., 1 if they are all the same, and
+    len(values) if they don't repeat at all
+
+    :param values: list or numpy array
+    :return:
+    """
+    n = len(values)
+    if n == 0:
+        return 0
+    if n >= VECTORIZE_MIN:
+        array = numpy.asarray(values)
+        if array.dtype.kind in 'iu':
+            return _smallest_period_numpy(array)
+    if isinstance(values, numpy.ndarray):
+        values = values.tolist()
+
+    prefix = [0] * n
+    k = 0
+    for i in xrange(1, n):
+        value = values[i]
+        while k > 0 and value != values[k]:
+            k = prefix[k - 1]
+        if value == values[k]:
+            k += 1
+        prefix[i] = k
+    return n - prefix[-1]
+
+
+def _powers(base, n, modulus):
+    """ base ** [0, n) % modulus (doubling the ones we have each time) """
+    result = numpy.empty(max(n, 1), dtype=numpy.int64)
+    result[0] = 1
+    done = 1
+    while done < n:
+        step = min(done, n - done)
+        result[done:done + step] = result[:step] * pow(base, done, modulus) \
+            % modulus
+        done += step
+    return result[:n]
+
+
+def _prefix_hashes(values):
+    """
+    Polynomial hashes of every prefix of the values, for each of _HASHES
+
+    :return: (modulus, base, hashes), with hashes[i] the hash of values[:i]
+    """
+    n = len(values)
+    for modulus, base in _HASHES:
+        x = values.astype(numpy.int64) % modulus
+        # hashes[i]: sum(x[j] * base ** j for j < i)
+        hashes = numpy.zeros(n + 1, dtype=numpy.int64)
+        numpy.cumsum(x * _powers(base, n, modulus) % modulus, out=hashes[1:])
+        hashes %= modulus
+        yield modulus, base, hashes
+
+
+def segment_hashes(values, starts, ends):
+    """
+    Hashes of segments of a numpy array of integers: equal segments hash the
+    same wherever they are (different ones almost never do)
+
+    :param values:
+    :param starts: numpy array, where every segment starts
+    :param ends: numpy array, where every segment ends (not included)
+    :return: numpy int64 array, the hash of every segment
+    """
+    n = len(values)
+    lengths = ends - starts
+    keys = numpy.zeros(len(starts), dtype=numpy.int64)
+    for modulus, base, hashes in _prefix_hashes(values):
+        # values[s:e] hashes to (hashes[e] - hashes[s]) / base ** s, and
+        # (e.g., for zeros) the length has to count too
+        inverse = pow(base, modulus - 2, modulus)
+        segment = (hashes[ends] - hashes[starts]) % modulus * \
+            _powers(inverse, n + 1, modulus)[starts] % modulus
+        keys = keys * modulus + (segment * base + lengths) % modulus
+    return keys
+
+
+def smallest_run_period(values, counts):
+    """
+    smallest_period() of the reads that runs of values make up, without
+    expanding the runs
+
+    :param values: numpy array, the value of every run
+    :param counts: numpy array, how many times in a row it was read
+    :return:
+    """
+    values = numpy.asarray(values)
+    counts = numpy.asarray(counts, dtype=numpy.int64)
+    if len(values) == 0:
+        return 0
+    # Merge runs of the same value
+    starts = numpy.flatnonzero(numpy.r_[True, values[1:] != values[:-1]])
+    values = values[starts]
+    counts = numpy.add.reduceat(counts, starts)
+    k = len(values)
+    n = int(counts.sum())
+    if k == 1:
+        return 1
+
+    # A period p lines the first run up with the end of some run d (the
+    # reads from p on start with a run as long as the first one), the runs
+    # in between with runs 1, 2, ... (exactly), and the last run with one of
+    # the same value that is at least as long
+    ends = numpy.cumsum(counts)
+    shifts = numpy.arange(1, k)
+    last = k - 1 - shifts
+    candidates = (values[shifts] == values[0]) & \
+        (counts[shifts] >= counts[0]) & \
+        ((last == 0) | ((values[last] == values[-1]) &
+                        (counts[last] >= counts[-1])))
+    inner = k - 2
+    if inner >= VECTORIZE_MIN and values.dtype.kind in 'iu':
+        # Runs 1 to k - 2 repeat every d runs if (value, count) pairs do so
+        # every 2 * d
+        pairs = numpy.column_stack((values[1:-1], counts[1:-1])).ravel()
+        candidates[:inner - 1] &= _shift_candidates(pairs)[1::2]
+
+    period = n
+    for d in (numpy.flatnonzero(candidates) + 1).tolist():
+        if numpy.array_equal(values[1 + d:-1], values[1:k - 1 - d]) and \
+                numpy.array_equal(counts[1 + d:-1], counts[1:k - 1 - d]):
+            period = int(ends[d] - counts[0])
+            break
+    # Or the reads from p on are all the first value, fewer of them than
+    # its first run
+    if values[-1] == values[0] and counts[-1] < counts[0]:
+        period = min(period, n - int(counts[-1]))
+    return period
+
+
+def _shift_candidates(values):
+    """
+    Shifts p (from 1) whose suffix values[p:] hashes the same as the prefix
+    of the same length
+
+    :return: numpy boolean array, for shifts 1 to len(values) - 1
+    """
+    n = len(values)
+    shifts = numpy.arange(1, n)
+    candidates = numpy.ones(n - 1, dtype=bool)
+    for modulus, base, hashes in _prefix_hashes(values):
+        # values[p:] hashes to (hashes[n] - hashes[p]) / base ** p
+        inverse = pow(base, modulus - 2, modulus)
+        suffix = (hashes[n] - hashes[shifts]) % modulus * \
+            _powers(inverse, n, modulus)[shifts] % modulus
+        candidates &= hashes[n - shifts] == suffix
+    return candidates
+
+
+def _smallest_period_numpy(values):
+    n = len(values)
+    candidates = _shift_candidates(values)
+    for p in (numpy.flatnonzero(candidates) + 1).tolist():
+        if numpy.array_equal(values[p:], values[:-p]):
+            return p
+        logger.debug("Hash collision at shift %d" % p)
+    return n
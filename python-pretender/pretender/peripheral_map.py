@@ -0,0 +1,117 @@
+"""
+Which peripheral does an address belong to?
+
+A PeripheralMap keeps the (non-overlapping) address ranges of the peripherals
+sorted by address, so that an address is looked up by bisecting them, and a
+whole column of addresses with a single numpy searchsorted().
+"""
+import bisect
+import logging
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+
+class PeripheralMap(object):
+    """
+    Sorted, non-overlapping [start, end] address ranges (end included), each
+    with a label (e.g., a cluster number, or a model)
+    """
+
+    def __init__(self, starts, ends, labels):
+        """
+        :param starts: First address of every range
+        :param ends: Last address of every range
+        :param labels: What every range maps to
+        """
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        ends = numpy.asarray(ends, dtype=numpy.int64)
+        labels = list(labels)
+        order = numpy.argsort(starts, kind='mergesort')
+        self.starts = starts[order]
+        self.ends = ends[order]
+        self.labels = [labels[i] for i in order.tolist()]
+        if numpy.any(self.starts[1:] <= self.ends[:-1]):
+            raise ValueError("Overlapping address ranges")
+        # (Plain lists are faster to bisect for one address at a time)
+        self._starts = self.starts.tolist()
+        self._ends = self.ends.tolist()
+
+    @classmethod
+    def from_clusters(cls, clusters):
+        """
+        :param clusters: {cluster number: addresses}, as returned by
+        cluster_peripherals()
+        :return: PeripheralMap from addresses to cluster numbers
+        """
+        labels = [k for k, v in clusters.items() if v]
+        return cls([min(clusters[k]) for k in labels],
+                   [max(clusters[k]) for k in labels], labels)
+
+    @classmethod
+    def from_intervals(cls, intervals):
+        """
+        :param intervals: (starts, ends, labels), as returned by
+        cluster_peripherals(..., return_intervals=True)
+        :return:
+        """
+        starts, ends, labels = intervals
+        return cls(starts, ends, numpy.asarray(labels).tolist())
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __repr__(self):
+        return "<PeripheralMap (%d ranges)>" % len(self)
+
+    def __contains__(self, address):
+        return self.index(address) != -1
+
+    def index(self, address):
+        """ Index (in address order) of the range with this address, or -1 """
+        i = bisect.bisect_right(self._starts, address) - 1
+        if i >= 0 and address <= self._ends[i]:
+            return i
+        return -1
+
+    def lookup(self, address, default=-1):
+        """
+        :param address:
+        :param default: What to return if no range has this address
+        :return: The label of the range with this address
+        """
+        i = self.index(address)
+        if i == -1:
+            return default
+        return self.labels[i]
+
+    def index_array(self, addresses):
+        """
+        Vectorized index()
+
+        :param addresses: numpy array of addresses
+        :return: numpy array of range indices (-1 where there are none)
+        """
+        addresses = numpy.asarray(addresses, dtype=numpy.int64)
+        i = numpy.searchsorted(self.starts, addresses, side='right') - 1
+        found = i >= 0
+        found[found] = addresses[found] <= self.ends[i[found]]
+        i[~found] = -1
+        return i
+
+    def lookup_array(self, addresses, default=-1):
+        """
+        Vectorized lookup()
+
+        :param addresses: numpy array of addresses
+        :param default: Label of addresses that no range has
+        :return: numpy array of labels
+        """
+        i = self.index_array(addresses)
+        labels = numpy.asarray(self.labels + [default])
+        return labels[i]
+
+    def ranges(self):
+        """ (start, end, label) of every range, in address order """
+        return zip(self._starts, self._ends, self.labels)
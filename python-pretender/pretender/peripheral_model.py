@@ -1,10 +1,15 @@
+import bisect
 import logging
 import pprint
 import random
+from functools import partial
 from threading import Event
 import sys
 
-from pretender.logger import LogReader
+from pretender.fitting import fit_model
+from pretender.trace import TraceTable
+from pretender.readlog import make_read, ReadLog, ReadStats, \
+    PositionedReads
 from pretender.models.increasing import IncreasingModel
 from pretender.models.markov2 import MarkovModel
 from pretender.models.markovpattern import MarkovPatternModel
@@ -33,48 +38,65 @@ class PeripheralModelState:
         self.model_per_address = {}
         self.is_collapsed = False
         self.merged_data = []
+        # Sorted keys of model_per_address_ordered (see _ordered_positions())
+        self._positions = {}
 
     def __str__(self):
         return "%s (reads: %s)" % (self.name, len(self.reads))
 
+    def __setstate__(self, state):
+        self._positions = {}
+        self.__dict__.update(state)
+        # Models pickled before the reads were PositionedReads have
+        # {position: [read]} dicts
+        for address, reads in self.reads.items():
+            if isinstance(reads, dict):
+                self.reads[address] = PositionedReads()
+                for position in sorted(reads):
+                    for read in reads[position]:
+                        self.reads[address].put(position, read)
+
     def __repr__(self):
         return self.name
 
-    def _train_model(self, read_log, use_time_domain=True):
+    def _train_model(self, read_log, callback, use_time_domain=True,
+                     scheduler=None):
         """
-        Return the model that best fits this data
+        Find the model that best fits this data, and hand it to the callback
 
         :param read_log:
+        :param callback: Called with the model (once the scheduler ran)
+        :param scheduler: FitScheduler to run the fit with (default: fit it
+        right away)
         :return:
         """
+        stats = ReadStats(read_log)
+
         # Is it just storage?
-        storage = True
-        for val, pc, size, timestamp in read_log:
-            if val != self.value:
-                storage = False
-        if storage:
+        if stats.values == [self.value]:
             m = SimpleStorageModel()
-            m.train(read_log)
+            m.train(read_log, stats)
             logger.info("Address %#08x is StorageModel" % self.address)
-            return m
+            callback(m)
+            return
 
         # Try our other models
         if use_time_domain:
-            for model in [PatternModel, MarkovPatternModel, IncreasingModel,
-                          MarkovModel]:
-                m = model()
-                logger.debug("Trying model %s" % repr(m))
-                if m.train(read_log):
-                    logger.info(
-                        "Address %#08x is %s" % (self.address, repr(model)))
-                    return m
+            candidates = [PatternModel, MarkovPatternModel, IncreasingModel,
+                          MarkovModel]
         else:
-            for model in [MarkovModel]:
-                m = model()
-                if m.train(read_log):
-                    logger.info(
-                        "Address %#08x is %s" % (self.address, repr(model)))
-                    return m
+            candidates = [MarkovModel]
+
+        def fitted(m):
+            if m is not None:
+                logger.info(
+                    "Address %#08x is %s" % (self.address, repr(m.__class__)))
+            callback(m)
+
+        if scheduler is None:
+            fitted(fit_model(candidates, read_log, stats))
+        else:
+            scheduler.submit(read_log, candidates, fitted, stats)
 
     def _get_model(self, address):
 
@@ -93,13 +115,32 @@ class PeripheralModelState:
                     return m
 
             if address in self.model_per_address_ordered:
-                # Looks like we are out of bounds on reads that we've seen,
-                # lets pick one
-                idx = max(self.model_per_address_ordered[address].keys())
+                # Either we are in the middle of a run of reads (only its
+                # first read has a model), or we are out of bounds on reads
+                # that we've seen, lets pick the closest one before us
+                positions = self._ordered_positions(address)
+                i = bisect.bisect_right(positions,
+                                        self.read_count.get(address, -1))
+                idx = positions[i - 1] if i else positions[-1]
                 m = self.model_per_address_ordered[address][idx]
 
         return m
 
+    def _ordered_positions(self, address):
+        """
+        The positions that have an ordered model for this address, sorted
+        (models are only ever added, so it is sorted again when there are
+        more of them)
+
+        :param address:
+        :return:
+        """
+        ordered = self.model_per_address_ordered[address]
+        positions = self._positions.get(address)
+        if positions is None or len(positions) != len(ordered):
+            positions = self._positions[address] = sorted(ordered)
+        return positions
+
     def address_observed(self, address):
         """ Will return True if this state has data for the given address """
         return address in self.read_count
@@ -123,59 +164,63 @@ class PeripheralModelState:
         for addr in self.read_count:
             self.read_count[addr] = 0
 
-    def append_read(self, address, value, pc, size, timestamp):
+    def append_read(self, address, value, pc, size, timestamp, count=1,
+                    last_timestamp=None):
         """
         Append an observed read to this state.  By default we are going to
         keep the order of each read, these can be merged later.
 
+        A run of identical reads is kept as a single ReadRun at the position
+        of its first read.  A read (or run) replaces whatever an earlier
+        visit to this state left at the positions that it covers, so that
+        runs train the same as the reads they stand for.
+
         :param pc:
         :param size:
         :param timestamp:
         :param address:
         :param value:
+        :param count: Number of identical reads in a row
+        :param last_timestamp: Timestamp of the last of those reads
         :return:
         """
 
         if address not in self.reads:
-            self.reads[address] = {}
+            self.reads[address] = PositionedReads()
 
         if address not in self.read_count:
             self.read_count[address] = 0
 
-        if self.read_count[address] not in self.reads:
-            self.reads[address][self.read_count[address]] = []
-
-        if self.read_count[address] not in self.reads[address]:
-            self.reads[self.read_count[address]] = []
+        self.reads[address].put(self.read_count[address], make_read(
+            value, pc, size, timestamp, count, last_timestamp))
 
-        self.reads[address][self.read_count[address]].append(
-            (value, pc, size, timestamp))
+        self.read_count[address] += count
 
-        self.read_count[address] += 1
-
-    def train(self):
+    def train(self, scheduler=None):
         """
         Go through all of our states and train a model for each.
+
+        :param scheduler: FitScheduler to run the fits with (default: fit them
+        right away)
         :return:
         """
         for address in self.reads:
             if address not in self.model_per_address_ordered:
                 self.model_per_address_ordered[address] = {}
+            ordered = self.model_per_address_ordered[address]
 
-            combined_reads = []
-            for read_count in self.reads[address]:
-                # Create an aggregate version
-                combined_reads += self.reads[address][read_count]
-
-                reads = self.reads[address][read_count]
-
+            for read_count, reads in self.reads[address].items():
                 # Set our model for ordered reads
-                m = self._train_model(reads, use_time_domain=False)
-                self.model_per_address_ordered[address][read_count] = m
+                self._train_model(reads, partial(ordered.__setitem__,
+                                                 read_count),
+                                  use_time_domain=False, scheduler=scheduler)
 
-            # Set our model for unordered reads
-            m = self._train_model(combined_reads)
-            self.model_per_address[address] = m
+            # Set our model for unordered reads (all of them, in read order,
+            # runs leave gaps between the positions)
+            self._train_model(self.reads[address].log,
+                              partial(self.model_per_address.__setitem__,
+                                      address),
+                              scheduler=scheduler)
 
     def merge(self, other):
         print "* Merging %s" % self.name
@@ -210,9 +255,9 @@ class PeripheralModelState:
                 self.read_count[address] = 0
 
             # Unordered reads
-            combined_reads = []
+            combined_reads = ReadLog()
             if address in self.reads:
-                for read_count in self.reads[address]:
+                for read_count in sorted(self.reads[address]):
                     combined_reads += self.reads[address][read_count]
 
             # Merge ordered reads
@@ -232,6 +277,14 @@ class PeripheralModelState:
                                      "models and trying again)" % (hex(address),
                                                                    read_count))
 
+                        our_reads = self.reads[address][read_count]
+                        our_stats = ReadStats(our_reads)
+                        other_reads = [(data[address][read_count],
+                                        ReadStats(data[address][read_count]))
+                                       for data in self.merged_data
+                                       if address in data and
+                                       read_count in data[address]]
+
                         # stop when all of our data work with the same model
                         for model in [PatternModel, MarkovModel]:
 
@@ -240,20 +293,17 @@ class PeripheralModelState:
                             logger.debug("Trying model %s" % repr(m0))
 
                             # Train our data
-                            if not m0.train(self.reads[address][read_count]):
+                            if not m0.train(our_reads, our_stats):
                                 continue
 
                             all_good = True
-                            for data in self.merged_data:
-                                if address in data and read_count in data[
-                                    address]:
-                                    m = model()
-                                    if not m.train(
-                                            data[address][read_count]):
-                                        all_good = False
-                                        break
-                                    else:
-                                        models.append(m)
+                            for reads, stats in other_reads:
+                                m = model()
+                                if not m.train(reads, stats):
+                                    all_good = False
+                                    break
+                                else:
+                                    models.append(m)
 
                             if not all_good:
                                 continue
@@ -282,16 +332,17 @@ class PeripheralModelState:
                                  other.model_per_address[address]))
                 # Get list of all reads
                 other_reads = []
-                our_reads = []
-                for read_count in self.reads[address]:
+                our_reads = ReadLog()
+                for read_count in sorted(self.reads[address]):
                     our_reads += self.reads[address][read_count]
 
                 for data in self.merged_data:
                     if address in data:
-                        reads = []
-                        for read_count in data[address]:
+                        reads = ReadLog()
+                        for read_count in sorted(data[address]):
                             reads += data[address][read_count]
-                        other_reads.append(reads)
+                        other_reads.append((reads, ReadStats(reads)))
+                our_stats = ReadStats(our_reads)
 
                 # stop when all of our data work with the same model
                 for model in [PatternModel, MarkovPatternModel, IncreasingModel,
@@ -303,13 +354,13 @@ class PeripheralModelState:
 
                     # Train our data
                     # print our_reads
-                    if not m0.train(our_reads):
+                    if not m0.train(our_reads, our_stats):
                         continue
 
                     all_good = True
-                    for reads in other_reads:
+                    for reads, stats in other_reads:
                         m = model()
-                        if not m.train(reads):
+                        if not m.train(reads, stats):
                             all_good = False
                             break
                         else:
@@ -463,61 +514,50 @@ class PeripheralModel:
         state.reset()
         return state
 
-    def train(self, filename):
+    def state_builder(self):
+        """
+        Something to feed this peripheral's events to, one at a time, to
+        build (and, when finished, train) its states
+
+        :return: PeripheralStateBuilder
+        """
+        return PeripheralStateBuilder(self)
+
+    def train(self, trace):
         """
         Train our model based on the log from real hardware
-        :param filename:
+        :param trace: TraceTable (or the filename of a recording to load)
         :return:
         """
-        l = LogReader(filename)
-        prev_states = []
-        state = self.current_state
-
-        # First, lets just build all of our states
-        for line in l:
-            # Extract our values form the log
-            try:
-                op, id, addr, val, pc, size, timestamp = line
-            except ValueError:
-                logger.warning("Weird line: " + repr(line))
-                continue
-
-            # Convert to ints
-            addr = int(addr)
-            val = int(val)
-            pc = int(pc)
-
-            # Ignore addresses that aren't in this peripheral
-            if addr not in self.addresses and addr != self.irq_num:
-                continue
-
-
-            # Handle writes
-            if op == "WRITE":
-                state = self._create_state(addr, "write", val)
-
-            # # Handle interrupts
-            # elif op == "ENTER":
-            #     prev_states.insert(0, state)
-            #     state = self._create_state(addr, "interrupt", val)
-            #
-            # elif op == "EXIT":
-            #     # Switch back to previous state
-            #     state = prev_states.pop()
-
-            elif op == "READ":
-                state.append_read(addr, val, pc, size, timestamp)
-
-            else:
-                logger.error("Saw an unrecognized operation (%s)!" % op)
-
-        l.close()
+        if not isinstance(trace, TraceTable):
+            trace = TraceTable.load(trace)
+
+        # Only look at the rows for this peripheral (and its interrupt)
+        addresses = set(self.addresses)
+        if self.irq_num is not None:
+            addresses.add(self.irq_num)
+        rows = trace.rows_for_addresses(addresses)
+
+        builder = self.state_builder()
+        for op, id, addr, val, pc, size, timestamp, count, last_timestamp in \
+                trace.rows(rows, runs=True):
+            builder.feed(op, addr, val, pc, size, timestamp, count,
+                         last_timestamp)
+        builder.finish()
+
+    def train_states(self, scheduler=None):
+        """
+        Train (and reset) every state, once they are all built
 
+        :param scheduler: FitScheduler to run the fits with (default: fit them
+        right away)
+        :return:
+        """
         # First, let's see if it's just storage
         for address in self.states:
             for operation in self.states[address]:
                 for value in self.states[address][operation]:
-                    self.states[address][operation][value].train()
+                    self.states[address][operation][value].train(scheduler)
                     self.states[address][operation][value].reset()
 
     def list_states(self):
@@ -557,6 +597,16 @@ class PeripheralModel:
            self.irq_num = other_peripheral.irq_num
            self.interrupt_timings = other_peripheral.interrupt_timings
            self.interrupt_trigger = other_peripheral.interrupt_trigger
+        self.merge_states(other_peripheral)
+
+    def merge_states(self, other_peripheral):
+        """
+        Merge the (trained) states of another peripheral into ours, and copy
+        the ones that we don't have
+
+        :param other_peripheral:
+        :return:
+        """
         # Merge known models
         for address in self.states:
             for operation in self.states[address]:
@@ -668,3 +718,58 @@ class PeripheralModel:
                 for value in self.states[address][operation]:
                     self.states[address][operation][value].reset()
 
+
+class PeripheralStateBuilder(object):
+    """
+    Builds the states of a PeripheralModel from its events, in trace order
+    """
+
+    def __init__(self, peripheral):
+        self.peripheral = peripheral
+        self.state = peripheral.current_state
+        self.prev_states = []
+
+    def feed(self, op, addr, val, pc, size, timestamp, count=1,
+             last_timestamp=None):
+        """
+        Account for the next event of this peripheral
+
+        :param op:
+        :param addr:
+        :param val:
+        :param pc:
+        :param size:
+        :param timestamp:
+        :param count: Number of reads that the row stands for
+        :param last_timestamp: Timestamp of the last of those reads
+        :return:
+        """
+        # Handle writes
+        if op == "WRITE":
+            self.state = self.peripheral._create_state(addr, "write", val)
+
+        # # Handle interrupts
+        # elif op == "ENTER":
+        #     self.prev_states.insert(0, self.state)
+        #     self.state = self.peripheral._create_state(addr, "interrupt",
+        #                                                val)
+        #
+        # elif op == "EXIT":
+        #     # Switch back to previous state
+        #     self.state = self.prev_states.pop()
+
+        elif op == "READ":
+            self.state.append_read(addr, val, pc, size, timestamp, count,
+                                   last_timestamp)
+
+        else:
+            logger.error("Saw an unrecognized operation (%s)!" % op)
+
+    def finish(self, scheduler=None):
+        """
+        Train the states, once every event was fed
+
+        :param scheduler: FitScheduler to run the fits with
+        :return:
+        """
+        self.peripheral.train_states(scheduler)
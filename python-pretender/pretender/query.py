@@ -0,0 +1,377 @@
+"""
+Queries over recordings (and over the traces embedded in models).
+
+A TraceQuery filters events by address range, operation, IRQ, pc, sequence
+number and time window.  Rather than reading and formatting the whole
+recording, query() only touches what it has to: the rows listed in the
+sidecar TraceIndex for the addresses or IRQs asked for, the part of a binary
+trace that falls in the sequence/time window (found by bisecting the
+memory-mapped trace), or the compressed blocks that overlap it.  Matches are
+streamed out a chunk at a time.
+"""
+import json
+import logging
+import os
+import pickle
+
+import numpy
+
+from pretender.clock import from_seconds, to_seconds
+from pretender.logger import LogReader, LogWriter, TraceIndex, \
+    index_filename, parse_tsv, iter_tsv, records_to_rows, OP_CODES, \
+    OP_READ, OP_WRITE, OP_ENTER, OP_EXIT, OP_RUN
+
+logger = logging.getLogger(__name__)
+
+QUERY_CHUNK_SIZE = 65536
+MODEL_TRACES_SUFFIX = ".traces"
+MODEL_TRACES_FILE = "groups.json"
+
+_ACCESS_OPS = numpy.array([OP_READ, OP_WRITE, OP_RUN])
+_IRQ_OPS = numpy.array([OP_ENTER, OP_EXIT])
+
+
+class TraceQuery(object):
+    """
+    Which events to return.  Every filter that is given has to match, except
+    that addresses and IRQs select different events (memory accesses and
+    interrupt ENTER/EXITs), so an event matches if it matches either.
+    """
+
+    def __init__(self, addresses=None, ops=None, irqs=None, pcs=None,
+                 seq=None, time=None):
+        """
+        :param addresses: List of (first, last) address ranges (inclusive)
+        :param ops: Operation names (READ also matches the RUN rows that
+        extend them)
+        :param irqs: IRQ numbers
+        :param pcs: Program counters
+        :param seq: (first, last) sequence numbers (inclusive, None is
+        open-ended)
+        :param time: (first, last) timestamps in nanoseconds since the start
+        of the recording (inclusive, None is open-ended)
+        """
+        self.addresses = list(addresses) if addresses else []
+        self.ops = None
+        if ops:
+            self.ops = set(op.upper() for op in ops)
+            if 'READ' in self.ops:
+                self.ops.add('RUN')
+            unknown = self.ops - set(OP_CODES)
+            if unknown:
+                raise ValueError("Unknown operations: %s" %
+                                 ", ".join(sorted(unknown)))
+        self.irqs = list(irqs) if irqs else []
+        self.pcs = list(pcs) if pcs else []
+        self.seq = seq
+        self.time = time
+
+    def __repr__(self):
+        return "<TraceQuery %r>" % dict((k, v) for k, v in
+                                        self.__dict__.items() if v)
+
+    @property
+    def selective(self):
+        """ Does this pick out addresses or IRQs (i.e., can an index help)? """
+        return bool(self.addresses or self.irqs)
+
+    def address_matches(self, address):
+        for first, last in self.addresses:
+            if first <= address <= last:
+                return True
+        return False
+
+    def index_keys(self, index):
+        """
+        The addresses in a TraceIndex that this query is interested in
+
+        :param index:
+        :return:
+        """
+        return [a for a in index.addresses if self.address_matches(a)]
+
+    def mask(self, records):
+        """
+        Which of these records match
+
+        :param records: numpy array of RECORD_DTYPE
+        :return: Boolean array
+        """
+        mask = numpy.ones(len(records), dtype=bool)
+        if self.ops is not None:
+            mask &= numpy.isin(records['op'],
+                               [OP_CODES[op] for op in self.ops])
+        if self.selective:
+            selected = numpy.zeros(len(records), dtype=bool)
+            if self.addresses:
+                in_range = numpy.zeros(len(records), dtype=bool)
+                for first, last in self.addresses:
+                    in_range |= (records['addr'] >= first) & \
+                                (records['addr'] <= last)
+                selected |= numpy.isin(records['op'], _ACCESS_OPS) & in_range
+            if self.irqs:
+                selected |= numpy.isin(records['op'], _IRQ_OPS) & \
+                            numpy.isin(records['addr'], self.irqs)
+            mask &= selected
+        if self.pcs:
+            mask &= numpy.isin(records['pc'], self.pcs)
+        for column, window in [('seq', self.seq), ('timestamp', self.time)]:
+            if window is None:
+                continue
+            first, last = window
+            if first is not None:
+                mask &= records[column] >= first
+            if last is not None:
+                mask &= records[column] <= last
+        return mask
+
+    def window(self, seqs, timestamps=None):
+        """
+        The slice of a trace that the sequence (and time) window covers,
+        found by bisecting the (sorted) columns
+
+        :param seqs: Sequence number column
+        :param timestamps: Timestamp column, if it is sorted
+        :return: (start, end)
+        """
+        start, end = 0, len(seqs)
+        for column, window in [(seqs, self.seq), (timestamps, self.time)]:
+            if window is None or column is None:
+                continue
+            first, last = window
+            if first is not None:
+                start = max(start, int(numpy.searchsorted(column, first,
+                                                          'left')))
+            if last is not None:
+                end = min(end, int(numpy.searchsorted(column, last, 'right')))
+        return start, max(start, end)
+
+    def overlaps(self, first_seq, last_seq, first_timestamp, last_timestamp):
+        """ Could a block with these bounds have anything for us? """
+        for first, last, window in [(first_seq, last_seq, self.seq),
+                                    (first_timestamp, last_timestamp,
+                                     self.time)]:
+            if window is None:
+                continue
+            if window[0] is not None and last < window[0]:
+                return False
+            if window[1] is not None and first > window[1]:
+                return False
+        return True
+
+
+def _chunks(array, chunk_size):
+    for start in xrange(0, len(array), chunk_size):
+        yield array[start:start + chunk_size]
+
+
+def query(filename, trace_query, chunk_size=QUERY_CHUNK_SIZE):
+    """
+    Run a query over a recording
+
+    :param filename: The recording (tab-separated, binary or compressed)
+    :param trace_query: TraceQuery
+    :param chunk_size: Maximum number of rows read at a time
+    :return: Iterator of numpy arrays (RECORD_DTYPE) of the matching events
+    """
+    reader = LogReader(filename)
+    index = None
+    if trace_query.selective:
+        index = TraceIndex.load(index_filename(filename))
+    try:
+        if reader.compressed:
+            parts = _query_compressed(reader, index, trace_query)
+        elif reader.binary:
+            parts = _query_binary(reader, index, trace_query, chunk_size)
+        else:
+            parts = _query_tsv(reader, index, trace_query, chunk_size)
+        for records in parts:
+            records = records[trace_query.mask(records)]
+            if len(records):
+                yield records
+    finally:
+        reader.close()
+
+
+def _index_rows(index, trace_query):
+    return index.rows_for(addresses=trace_query.index_keys(index),
+                          irqs=trace_query.irqs)
+
+
+def _query_binary(reader, index, trace_query, chunk_size):
+    # (old traces have to be converted, newer ones are just mapped)
+    records = reader.read_array(mmap=True)
+    # Timestamps only always increase since they come from a monotonic clock
+    timestamps = records['timestamp'] if reader.version > 1 else None
+    start, end = trace_query.window(records['seq'], timestamps)
+    if index is not None:
+        rows = _index_rows(index, trace_query)
+        rows = rows[(rows >= start) & (rows < end)]
+        for chunk in _chunks(rows, chunk_size):
+            yield records[chunk]
+    else:
+        for chunk in xrange(start, end, chunk_size):
+            yield records[chunk:min(chunk + chunk_size, end)]
+
+
+def _query_compressed(reader, index, trace_query):
+    blocks = reader.blocks
+    wanted = [b for b in xrange(len(blocks)) if trace_query.overlaps(
+        blocks.first_seqs[b], blocks.last_seqs[b],
+        blocks.first_timestamps[b], blocks.last_timestamps[b])]
+    if index is None:
+        for block in wanted:
+            yield reader.read_block(block)
+        return
+    # Only decompress the blocks that hold the rows in the index
+    rows = _index_rows(index, trace_query)
+    row_blocks = numpy.searchsorted(blocks.starts, rows, 'right') - 1
+    wanted = set(wanted)
+    for block in numpy.unique(row_blocks).tolist():
+        if block not in wanted:
+            continue
+        records = reader.read_block(block)
+        offsets = rows[row_blocks == block] - blocks.starts[block]
+        yield records[offsets[offsets < len(records)]]
+
+
+def _query_tsv(reader, index, trace_query, chunk_size):
+    seconds = reader.version == 1
+    if index is None:
+        # Nothing to go on, parse the whole thing (in bulk, a chunk at a time)
+        for records, _ in iter_tsv(reader.file, seconds=seconds):
+            yield records
+        return
+    # Seek straight to the lines in the index
+    offsets = index.offsets_for(addresses=trace_query.index_keys(index),
+                                irqs=trace_query.irqs)
+    for chunk in _chunks(offsets, chunk_size):
+        lines = []
+        for offset in chunk.tolist():
+            reader.file.seek(offset)
+            line = reader.file.readline()
+            lines.append(line if line.endswith('\n') else line + '\n')
+        yield parse_tsv("".join(lines), seconds)[0]
+
+
+def query_rows(filename, trace_query, chunk_size=QUERY_CHUNK_SIZE):
+    """
+    Run a query over a recording, one log row at a time
+
+    :param filename:
+    :param trace_query: TraceQuery
+    :param chunk_size:
+    :return: Iterator of (op, seq, addr, val, pc, size, timestamp)
+    """
+    for records in query(filename, trace_query, chunk_size):
+        for row in records_to_rows(records):
+            yield row
+
+
+def format_rows(records, seconds=False):
+    """
+    Format records as tab-separated lines, with the addresses, values and
+    pcs in hex
+
+    :param records: numpy array of RECORD_DTYPE
+    :param seconds: Print the timestamps as seconds instead of nanoseconds
+    :return: String of lines
+    """
+    lines = []
+    for op, seq, addr, val, pc, size, timestamp in records_to_rows(records):
+        if seconds:
+            timestamp = "%.9f" % to_seconds(timestamp)
+        lines.append("%s\t%d\t%#x\t%#x\t%#x\t%d\t%s\n" % (
+            op, seq, addr, val, pc, size, timestamp))
+    return "".join(lines)
+
+
+#
+# Traces embedded in (old-style) models
+#
+# Every MMIOGroup of a model keeps the part of the recording that it was
+# trained on.  Rather than unpickling the whole model for each query, those
+# traces are exported once, as indexed binary traces next to the model (in
+# <model>.traces/, with groups.json mapping each address to its group's
+# trace), and queried like any other recording.
+#
+def model_traces_dir(model_file):
+    return model_file + MODEL_TRACES_SUFFIX
+
+
+def _model_groups(model):
+    """ {group: addresses} for every model (MMIOGroup) that has a trace """
+    if not isinstance(model, dict) or 'peripherals' in model:
+        raise ValueError("This model has no embedded traces")
+    groups = {}
+    addresses = {}
+    for address, entry in model.items():
+        group = entry.get('model') if isinstance(entry, dict) else None
+        if getattr(group, 'trace', None) is None:
+            continue
+        groups[id(group)] = group
+        addresses.setdefault(id(group), []).append(address)
+    return [(groups[g], sorted(addresses[g])) for g in groups]
+
+
+def export_model_traces(model_file, force=False):
+    """
+    Export the traces embedded in a model (unless it was done already)
+
+    :param model_file:
+    :param force: Export them even if they are up to date
+    :return: {address: trace file}
+    """
+    directory = model_traces_dir(model_file)
+    groups_file = os.path.join(directory, MODEL_TRACES_FILE)
+    if not force and os.path.exists(groups_file) and \
+            os.path.getmtime(groups_file) >= os.path.getmtime(model_file):
+        with open(groups_file) as f:
+            return dict((int(a), os.path.join(directory, fn)) for a, fn in
+                        json.load(f).items())
+
+    logger.info("Exporting the traces in %s to %s" % (model_file, directory))
+    with open(model_file, 'rb') as f:
+        model = pickle.load(f)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    traces = {}
+    for group, addresses in _model_groups(model):
+        filename = "%08x.trace" % addresses[0]
+        writer = LogWriter(os.path.join(directory, filename), index=True,
+                           time_base=0.0)
+        for row in group.trace:
+            op, seq, addr, val, pc, size, timestamp = row
+            if isinstance(timestamp, float):
+                # (old models were trained on seconds)
+                timestamp = from_seconds(timestamp)
+            writer.write_row([op, seq, addr, val, pc, size, timestamp])
+        writer.close()
+        for address in addresses:
+            traces[address] = filename
+    with open(groups_file, 'w') as f:
+        json.dump(dict((str(a), fn) for a, fn in traces.items()), f,
+                  indent=2, sort_keys=True)
+    return dict((a, os.path.join(directory, fn)) for a, fn in traces.items())
+
+
+def model_trace(model_file, address):
+    """
+    The (exported) trace of the group that models this address
+
+    :param model_file:
+    :param address:
+    :return: Filename of the trace
+    """
+    traces = export_model_traces(model_file)
+    if address not in traces:
+        raise KeyError("No trace for %#x in %s" % (address, model_file))
+    return traces[address]
+
+
+def is_model_file(filename):
+    """ Does this look like a (pickled) model rather than a recording? """
+    with open(filename, 'rb') as f:
+        start = f.read(2)
+    # (a pickled dict starts with '(d' in protocol 0, '\x80\x02' in 2)
+    return start in ('(d', '\x80\x02')
@@ -0,0 +1,649 @@
+"""
+Run-length encoded read logs.
+
+Firmware that polls a status register reads the same value, from the same pc,
+over and over.  Rather than keeping a (value, pc, size, timestamp) tuple for
+each of those reads, a run of them is kept as a single ReadRun.  A ReadRun is
+still the (value, pc, size, timestamp) tuple of the first read, so code that
+doesn't care about runs can keep unpacking it as before, but it also knows how
+many reads it stands for and when the last one happened.
+
+A state can see millions of reads, so its read logs are ReadLogs: the same
+reads, kept in typed columns rather than as a list of tuples, and (past a
+number of entries) spilled to files in G.READ_LOG_SPILL_DIR.
+"""
+import array
+import bisect
+import itertools
+import os
+import tempfile
+
+import numpy
+
+import pretender.globals as G
+from pretender.period import smallest_run_period
+
+
+class ReadRun(tuple):
+    """
+    A (value, pc, size, timestamp) read that was repeated a number of times
+
+    (The number is in .repeats, tuples already have a count() method)
+    """
+
+    def __new__(cls, value, pc, size, timestamp, count, last_timestamp=None):
+        run = tuple.__new__(cls, (value, pc, size, timestamp))
+        run.repeats = count
+        run.last_timestamp = timestamp if last_timestamp is None else \
+            last_timestamp
+        return run
+
+    def __getnewargs__(self):
+        return tuple(self) + (self.repeats, self.last_timestamp)
+
+    def __repr__(self):
+        return "ReadRun(%s x %d)" % (tuple.__repr__(self), self.repeats)
+
+
+def make_read(value, pc, size, timestamp, count=1, last_timestamp=None):
+    """
+    A read log entry, i.e., a plain tuple for a single read or a ReadRun
+
+    :return:
+    """
+    if count == 1:
+        return value, pc, size, timestamp
+    return ReadRun(value, pc, size, timestamp, count, last_timestamp)
+
+
+def run_length(read):
+    """ How many reads this log entry stands for """
+    return getattr(read, 'repeats', 1)
+
+
+def last_timestamp(read):
+    """ When the last read of this log entry happened """
+    return getattr(read, 'last_timestamp', read[3])
+
+
+def split_run(read, count):
+    """
+    Split a run after its first count reads (count must be less than its
+    length).  The reads are taken to be evenly spaced in time.
+
+    :param read:
+    :param count:
+    :return: (the first count reads, the rest)
+    """
+    value, pc, size, timestamp = read
+    repeats = run_length(read)
+    last = last_timestamp(read)
+
+    def at(i):
+        # When read number i of the run happened
+        if isinstance(timestamp, float):
+            return timestamp + (last - timestamp) * i / float(repeats - 1)
+        return timestamp + (last - timestamp) * i // (repeats - 1)
+
+    return (make_read(value, pc, size, timestamp, count, at(count - 1)),
+            make_read(value, pc, size, at(count), repeats - count, last))
+
+
+def total_reads(log):
+    """ How many reads are in this log """
+    return sum(run_length(read) for read in log)
+
+
+def value_runs(log):
+    """
+    Iterate over (value, count) for every entry in the log
+
+    :param log:
+    :return:
+    """
+    for read in log:
+        yield read[0], run_length(read)
+
+
+def expand_values(log):
+    """
+    Every read value in the log, with the runs expanded
+
+    :param log:
+    :return:
+    """
+    return _expand(value_runs(log))
+
+
+def _expand(runs):
+    values = []
+    for value, count in runs:
+        if count == 1:
+            values.append(value)
+        else:
+            values.extend([value] * count)
+    return values
+
+
+class ReadLog(object):
+    """
+    A read log kept as columns (value, pc, size, timestamp, count,
+    last_timestamp) of machine integers (or floats, for float timestamps),
+    i.e., a few bytes per entry rather than a tuple of Python objects.
+
+    It behaves like the list of reads it replaces (append(), len(), indexing,
+    iteration and += all work with read tuples), and column() hands the
+    models numpy arrays instead.
+
+    Once more than G.READ_LOG_SPILL_ENTRIES entries are in memory, and if
+    G.READ_LOG_SPILL_DIR is set, they are moved to files in that directory
+    (which is left for the caller to remove).
+    """
+    COLUMNS = ('value', 'pc', 'size', 'timestamp', 'count', 'last_timestamp')
+    TYPECODES = {'value': 'l', 'pc': 'l', 'size': 'B', 'count': 'l'}
+
+    def __init__(self, reads=()):
+        """
+        :param reads: Reads to start with
+        """
+        self._spilled = 0
+        self._spill_files = None
+        self._reset(None)
+        self.extend(reads)
+
+    def _reset(self, time_typecode):
+        self._columns = {}
+        for name in self.COLUMNS:
+            typecode = self.TYPECODES.get(name, time_typecode or 'l')
+            self._columns[name] = array.array(typecode)
+        self._time_typecode = time_typecode
+
+    def __repr__(self):
+        return "<ReadLog (%d entries, %d on disk)>" % (len(self),
+                                                       self._spilled)
+
+    def __len__(self):
+        return self._spilled + len(self._columns['value'])
+
+    @staticmethod
+    def _row(read):
+        value, pc, size, timestamp = read
+        return value, pc, size, timestamp, run_length(read), \
+            last_timestamp(read)
+
+    def append(self, read):
+        """
+        :param read: (value, pc, size, timestamp) tuple or ReadRun
+        :return:
+        """
+        value, pc, size, timestamp = read
+        self._check_time(timestamp)
+        columns = self._columns
+        columns['value'].append(value)
+        columns['pc'].append(pc)
+        columns['size'].append(size)
+        columns['timestamp'].append(timestamp)
+        columns['count'].append(run_length(read))
+        columns['last_timestamp'].append(last_timestamp(read))
+        self._maybe_spill()
+
+    def insert(self, index, read):
+        """
+        :param index: Where the read goes (as for list.insert())
+        :param read:
+        :return:
+        """
+        if index < self._spilled:
+            self._unspill()
+        row = self._row(read)
+        self._check_time(row[3])
+        for name, value in zip(self.COLUMNS, row):
+            self._columns[name].insert(index - self._spilled, value)
+        self._maybe_spill()
+
+    def __setitem__(self, index, read):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("ReadLog index out of range")
+        if index < self._spilled:
+            self._unspill()
+        row = self._row(read)
+        self._check_time(row[3])
+        for name, value in zip(self.COLUMNS, row):
+            self._columns[name][index - self._spilled] = value
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("ReadLog slices can't skip entries")
+        else:
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("ReadLog index out of range")
+            start, stop = index, index + 1
+        if start >= stop:
+            return
+        if start < self._spilled:
+            self._unspill()
+        for name in self.COLUMNS:
+            del self._columns[name][start - self._spilled:
+                                    stop - self._spilled]
+
+    def extend(self, reads):
+        """
+        :param reads: Another ReadLog, or reads
+        :return:
+        """
+        if isinstance(reads, ReadLog) and reads._spilled == 0:
+            if len(reads) == 0:
+                return
+            if self._time_typecode is None:
+                self._convert_time(reads._time_typecode)
+            if self._time_typecode == reads._time_typecode:
+                # (Straight from array to array)
+                for name in self.COLUMNS:
+                    self._columns[name].extend(reads._columns[name])
+                self._maybe_spill()
+                return
+        for read in reads:
+            self.append(read)
+
+    def __iadd__(self, reads):
+        self.extend(reads)
+        return self
+
+    def _check_time(self, timestamp):
+        """ Pick the typecode of the timestamps from the first one """
+        if self._time_typecode == 'd':
+            return
+        if isinstance(timestamp, float):
+            # Int timestamps so far?  Keep them as floats from now on
+            self._convert_time('d')
+        elif self._time_typecode is None:
+            self._convert_time('l')
+
+    def _convert_time(self, typecode):
+        if self._spilled:
+            self._unspill()
+        for name in ('timestamp', 'last_timestamp'):
+            self._columns[name] = array.array(
+                typecode, [float(t) if typecode == 'd' else t for t in
+                           self._columns[name]])
+        self._time_typecode = typecode
+
+    def _maybe_spill(self):
+        if G.READ_LOG_SPILL_DIR is None or \
+                len(self._columns['value']) < G.READ_LOG_SPILL_ENTRIES:
+            return
+        if self._spill_files is None:
+            self._spill_files = {}
+            for name in self.COLUMNS:
+                fd, self._spill_files[name] = tempfile.mkstemp(
+                    dir=G.READ_LOG_SPILL_DIR, prefix="reads-",
+                    suffix="." + name)
+                os.close(fd)
+        for name in self.COLUMNS:
+            with open(self._spill_files[name], 'ab') as f:
+                self._columns[name].tofile(f)
+        self._spilled += len(self._columns['value'])
+        self._reset(self._time_typecode)
+
+    def _unspill(self):
+        """ Bring the spilled entries back into memory (to change them) """
+        columns = {}
+        for name in self.COLUMNS:
+            columns[name] = array.array(self._columns[name].typecode,
+                                        self._load(name).tostring())
+            columns[name].extend(self._columns[name])
+            os.remove(self._spill_files[name])
+        self._columns = columns
+        self._spilled = 0
+        self._spill_files = None
+
+    def _load(self, name):
+        """ The spilled part of a column """
+        dtype = numpy.dtype(self._columns[name].typecode)
+        return numpy.memmap(self._spill_files[name], dtype=dtype, mode='r',
+                            shape=(self._spilled,))
+
+    def column(self, name):
+        """
+        :param name: One of COLUMNS
+        :return: numpy array (a copy) of the whole column
+        """
+        column = self._columns[name]
+        dtype = numpy.dtype(column.typecode)
+        if len(column) > 0:
+            # (Copied right away, the array may be resized later)
+            in_memory = numpy.frombuffer(column, dtype=dtype).copy()
+        else:
+            in_memory = numpy.zeros(0, dtype=dtype)
+        if self._spilled == 0:
+            return in_memory
+        return numpy.concatenate((self._load(name), in_memory))
+
+    def columns(self, *names):
+        """
+        :param names: Some of COLUMNS
+        :return: A numpy array for each of them
+        """
+        return [self.column(name) for name in names]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("ReadLog index out of range")
+        if index < self._spilled:
+            row = [self._load(name)[index].item() for name in self.COLUMNS]
+        else:
+            row = [self._columns[name][index - self._spilled] for name in
+                   self.COLUMNS]
+        return make_read(*row)
+
+    def __iter__(self, chunk_size=65536):
+        # (Chunks of rows from the files first, then from memory)
+        for start in xrange(0, self._spilled, chunk_size):
+            stop = min(start + chunk_size, self._spilled)
+            for row in zip(*[self._load(name)[start:stop].tolist() for name
+                             in self.COLUMNS]):
+                yield make_read(*row)
+        for start in xrange(0, len(self._columns['value']), chunk_size):
+            for row in zip(*[self._columns[name][start:start + chunk_size]
+                             for name in self.COLUMNS]):
+                yield make_read(*row)
+
+    def __getstate__(self):
+        # Spilled entries go into the pickle too
+        state = {'time_typecode': self._time_typecode}
+        for name in self.COLUMNS:
+            state[name] = array.array(self._columns[name].typecode,
+                                      self.column(name).tostring())
+        return state
+
+    def __setstate__(self, state):
+        self._time_typecode = state['time_typecode']
+        self._columns = dict((name, state[name]) for name in self.COLUMNS)
+        self._spilled = 0
+        self._spill_files = None
+        self._maybe_spill()
+
+
+class PositionedReads(object):
+    """
+    The reads of an address (in a state) by position, i.e., by how many
+    times the address was read (in that state) before them, in one ReadLog.
+
+    A run covers the positions of all of its reads, and every position has
+    the read (or part of a run) that was last put there.  It looks like the
+    {position: [read]} dict it replaces: iterating goes over the positions
+    where an entry starts (in order), and indexing by one of them gives a
+    list with its entry.
+    """
+
+    def __init__(self):
+        self.positions = array.array('l')
+        self.log = ReadLog()
+
+    def __repr__(self):
+        return "<PositionedReads (%d positions)>" % len(self)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __iter__(self):
+        return iter(self.positions)
+
+    def keys(self):
+        return self.positions.tolist()
+
+    def items(self):
+        """ (position, [read]) in order """
+        for position, read in itertools.izip(self.positions, self.log):
+            yield position, [read]
+
+    def _find(self, position):
+        i = bisect.bisect_left(self.positions, position)
+        return i, i < len(self.positions) and self.positions[i] == position
+
+    def __contains__(self, position):
+        return self._find(position)[1]
+
+    def __getitem__(self, position):
+        i, found = self._find(position)
+        if not found:
+            raise KeyError(position)
+        return [self.log[i]]
+
+    def end(self):
+        """ The position after the last read """
+        if len(self.positions) == 0:
+            return 0
+        return self.positions[-1] + run_length(self.log[-1])
+
+    def put(self, position, read):
+        """
+        :param position:
+        :param read: What is read at that position from now on (a run, at
+        all of the positions it covers)
+        :return:
+        """
+        if position >= self.end():
+            self.positions.append(position)
+            self.log.append(read)
+            return
+
+        # The entries that start before the read's positions are over, from
+        # the one that reaches into them (if any)
+        end = position + run_length(read)
+        first = bisect.bisect_left(self.positions, position)
+        if first > 0 and self.positions[first - 1] + \
+                run_length(self.log[first - 1]) > position:
+            first -= 1
+        last = bisect.bisect_left(self.positions, end, first)
+
+        # Runs that stick out on either side keep the reads out there
+        positions, reads = [position], [read]
+        if first < last:
+            start = self.positions[first]
+            if start < position:
+                positions.insert(0, start)
+                reads.insert(0, split_run(self.log[first],
+                                          position - start)[0])
+            start = self.positions[last - 1]
+            if start + run_length(self.log[last - 1]) > end:
+                positions.append(end)
+                reads.append(split_run(self.log[last - 1], end - start)[1])
+
+        self.positions[first:last] = array.array('l', positions)
+        del self.log[first:last]
+        for i, read in enumerate(reads):
+            self.log.insert(first + i, read)
+
+
+def log_columns(log, *names):
+    """
+    Columns of a read log (a ReadLog, or a list of reads), as numpy arrays
+
+    :param log:
+    :param names: Some of ReadLog.COLUMNS
+    :return: A numpy array for each of them
+    """
+    if isinstance(log, ReadLog):
+        return log.columns(*names)
+    columns = []
+    for name in names:
+        if name == 'count':
+            column = [run_length(read) for read in log]
+        elif name == 'last_timestamp':
+            column = [last_timestamp(read) for read in log]
+        else:
+            i = ReadLog.COLUMNS.index(name)
+            column = [read[i] for read in log]
+        columns.append(numpy.array(column, dtype=numpy.dtype(
+            ReadLog.TYPECODES.get(name, 'd' if any(
+                isinstance(t, float) for t in column) else 'l'))))
+    return columns
+
+
+class ReadStats(object):
+    """
+    What the models want to know about a read log, collected in one pass over
+    it, so that every candidate model doesn't have to go through the log
+    again just to find out that it doesn't fit.
+
+    Everything is in terms of the reads (i.e., with the runs expanded), except
+    for the increasing samples, which are the points IncreasingModel fits: the
+    first read of every entry, and the last one too if it is a run.
+    """
+    # Logs shorter than this are summarized in Python, numpy's overhead is
+    # more than what it saves on them
+    VECTORIZE_MIN = 64
+
+    def __init__(self, log):
+        """
+        :param log: Read log
+        """
+        self._period = None
+        if len(log) < self.VECTORIZE_MIN:
+            self._from_reads(log)
+        else:
+            self._from_columns(*log_columns(log, 'value', 'count'))
+
+    def _from_reads(self, log):
+        self._runs = []
+        self._run_columns = None
+        self.histogram = {}
+        self.values = []
+        self.total = 0
+        self.samples = 0
+        self.decreases = 0
+        self.last_decrease = None
+
+        last = None
+        for read in log:
+            value, count = read[0], run_length(read)
+            self._runs.append((value, count))
+            if value not in self.histogram:
+                self.histogram[value] = 0
+                self.values.append(value)
+            self.histogram[value] += count
+            self.total += count
+
+            if self.samples > 0 and value < last:
+                self.decreases += 1
+                self.last_decrease = self.samples
+            self.samples += 1 if count == 1 else 2
+            last = value
+
+    def _from_columns(self, values, counts):
+        # Value and count of every entry
+        self._runs = None
+        self._run_columns = values, counts
+        self.total = int(counts.sum())
+
+        # Number of reads of every value, and the values in the order in
+        # which they were first read
+        distinct, first, inverse = numpy.unique(values, return_index=True,
+                                                return_inverse=True)
+        reads = numpy.zeros(len(distinct), dtype=numpy.int64)
+        numpy.add.at(reads, inverse, counts)
+        order = numpy.argsort(first, kind='mergesort')
+        self.values = distinct[order].tolist()
+        self.histogram = {}
+        for value, count in zip(self.values, reads[order].tolist()):
+            self.histogram[value] = count
+
+        # Increasing samples, how many times they went down, and the index of
+        # the last sample that did (or None)
+        runs_before = numpy.cumsum(counts > 1) - (counts > 1)
+        self.samples = len(values) + int(numpy.count_nonzero(counts > 1))
+        decreases = numpy.flatnonzero(values[1:] < values[:-1]) + 1
+        self.decreases = len(decreases)
+        self.last_decrease = None
+        if len(decreases):
+            last = decreases[-1]
+            self.last_decrease = int(last + runs_before[last])
+
+    def __len__(self):
+        if self._runs is None:
+            return len(self._run_columns[0])
+        return len(self._runs)
+
+    def __repr__(self):
+        return "<ReadStats (%d reads, %d values)>" % (self.total,
+                                                      len(self.values))
+
+    @property
+    def runs(self):
+        """ (value, count) of every entry """
+        if self._runs is None:
+            values, counts = self._run_columns
+            return zip(values.tolist(), counts.tolist())
+        return self._runs
+
+    def run_columns(self):
+        """ (values, counts) of the entries, as numpy arrays """
+        if self._runs is None:
+            return self._run_columns
+        return (numpy.array([value for value, count in self._runs],
+                            dtype=numpy.int64),
+                numpy.array([count for value, count in self._runs],
+                            dtype=numpy.int64))
+
+    @property
+    def majority_value(self):
+        """
+        The value that makes up more than half of the reads, or None
+        """
+        for value in self.histogram:
+            if self.histogram[value] > 0.5 * self.total:
+                return value
+        return None
+
+    @property
+    def period(self):
+        """
+        Length of the shortest pattern that the reads repeat (the last
+        repetition may be incomplete), i.e., 1 if they are all the same, and
+        the number of reads if they don't repeat at all
+        """
+        if self._period is None:
+            if len(self.values) <= 1:
+                self._period = 1
+            else:
+                self._period = smallest_run_period(*self.run_columns())
+        return self._period
+
+    def expanded(self, count=None):
+        """
+        Every read value, with the runs expanded
+
+        :param count: Only the first this many
+        :return:
+        """
+        if self._runs is None:
+            values, counts = self._run_columns
+            if count is not None and count < self.total:
+                # Only the runs up to the one that read number count is in,
+                # with that one cut short
+                ends = numpy.cumsum(counts)
+                last = int(numpy.searchsorted(ends, count, side='left'))
+                counts = counts[:last + 1].copy()
+                counts[last] -= ends[last] - count
+                values = values[:last + 1]
+            return numpy.repeat(values, counts).tolist()
+        if count is None:
+            return _expand(self._runs)
+        values = []
+        for value, repeats in self._runs:
+            if len(values) >= count:
+                break
+            values.extend([value] * min(repeats, count - len(values)))
+        return values
+
@@ -0,0 +1,303 @@
+"""
+A recording set: every run of one firmware, recorded on one board.
+
+The recorder writes a manifest (G.RECORDING_SET_FILE) next to the recordings,
+with the file, start time and checksum of each run, so that the training
+front end knows exactly what belongs together (and notices when a recording
+was truncated or swapped out), and can load the runs ahead in a pool of
+processes instead of one after the other.
+"""
+import collections
+import fnmatch
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import pretender.globals as G
+from pretender.logger import LogReader, index_filename
+from pretender.trace import TraceTable
+
+logger = logging.getLogger(__name__)
+
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+
+def file_checksum(filename):
+    """
+    SHA-256 of a file, read a chunk at a time
+
+    :param filename:
+    :return: Hex digest
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(CHECKSUM_CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def recording_filenames(directory):
+    """
+    Every recording in a directory (tab-separated, binary and compressed),
+    for directories without a manifest
+
+    A run that was converted (e.g., with scripts/trace_convert.py) is there
+    in more than one format, only the first of binary, compressed and
+    tab-separated is used (or it would be trained on twice).
+
+    :param directory:
+    :return:
+    """
+    runs = {}
+    for extension in [G.BINARY_RECORDING_EXTENSION,
+                      G.COMPRESSED_RECORDING_EXTENSION,
+                      G.RECORDING_EXTENSION]:
+        for filename in fnmatch.filter(os.listdir(directory),
+                                       "*.%s" % extension):
+            stem = filename[:-len(extension) - 1]
+            if stem in runs:
+                logger.warning("%s is also in %s, ignoring it" % (
+                    os.path.join(directory, filename), runs[stem]))
+                continue
+            runs[stem] = filename
+    return sorted(runs.values())
+
+
+class RecordingSet(object):
+    """
+    The manifest of a recording set.  File names are relative to the
+    directory that the manifest is in.
+    """
+    VERSION = 1
+
+    def __init__(self, directory, firmware=None, board=None):
+        """
+        :param directory: Where the recordings (and the manifest) are
+        :param firmware: Path to the firmware that was recorded
+        :param board: Which board it was recorded on
+        """
+        self.directory = directory
+        self.firmware = None
+        self.firmware_checksum = None
+        self.board = board
+        self.runs = []
+        if firmware is not None:
+            self.firmware = os.path.basename(firmware)
+            self.firmware_checksum = file_checksum(firmware)
+
+    def __repr__(self):
+        return "<RecordingSet %s (%d runs)>" % (self.directory, len(self))
+
+    def __len__(self):
+        return len(self.runs)
+
+    @staticmethod
+    def manifest_filename(directory):
+        return os.path.join(directory, G.RECORDING_SET_FILE)
+
+    def add_run(self, filename, start_time, duration=None):
+        """
+        Add a (finished) recording to the set
+
+        :param filename: The recording
+        :param start_time: Wall clock time (seconds) when it started
+        :param duration: How long it ran for (seconds)
+        :return:
+        """
+        run = {'file': os.path.relpath(filename, self.directory),
+               'start_time': start_time,
+               'duration': duration,
+               'size': os.path.getsize(filename),
+               'sha256': file_checksum(filename)}
+        index = index_filename(filename)
+        if os.path.exists(index):
+            run['index'] = os.path.relpath(index, self.directory)
+        self.runs.append(run)
+        return run
+
+    def add_recording(self, filename):
+        """
+        Add a recording that was made elsewhere (e.g., folded into the model
+        with pretender-model-generate --update), with the start time from
+        its header, unless it's already in the set
+
+        :param filename:
+        :return: The run
+        """
+        relative = os.path.relpath(filename, self.directory)
+        listed = None
+        for i, run in enumerate(self.runs):
+            if os.path.normpath(run['file']) == relative:
+                if run.get('sha256') is not None:
+                    return run
+                # (Listed from the directory, without a checksum)
+                listed = i
+        reader = LogReader(filename)
+        try:
+            start_time = reader.time_base or None
+        finally:
+            reader.close()
+        run = self.add_run(filename, start_time)
+        if listed is not None:
+            self.runs[listed] = self.runs.pop()
+        return run
+
+    def filenames(self):
+        """ Full paths of every recording, in the order they were recorded """
+        return [os.path.join(self.directory, run['file']) for run in
+                self.runs]
+
+    def save(self):
+        filename = self.manifest_filename(self.directory)
+        logger.info("Saving recording set to %s" % filename)
+        with open(filename, 'w') as f:
+            json.dump({'version': self.VERSION,
+                       'firmware': self.firmware,
+                       'firmware_sha256': self.firmware_checksum,
+                       'board': self.board,
+                       'runs': self.runs}, f, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Load the manifest of a recording set
+
+        :param directory:
+        :return: The RecordingSet, or None if there is no manifest
+        """
+        filename = cls.manifest_filename(directory)
+        if not os.path.exists(filename):
+            return None
+        with open(filename) as f:
+            data = json.load(f)
+        if data.get('version') != cls.VERSION:
+            raise ValueError("Unsupported recording set %s (version %s)" % (
+                filename, data.get('version')))
+        recordings = cls(directory, board=data.get('board'))
+        recordings.firmware = data.get('firmware')
+        recordings.firmware_checksum = data.get('firmware_sha256')
+        recordings.runs = data.get('runs', [])
+        return recordings
+
+    @classmethod
+    def from_directory(cls, directory):
+        """
+        The recording set in a directory, from its manifest if it has one, or
+        from every recording in it (without checksums) if it doesn't
+
+        :param directory:
+        :return:
+        """
+        recordings = cls.load(directory)
+        if recordings is None:
+            logger.info("No recording set in %s, using every recording in "
+                        "it" % directory)
+            recordings = cls(directory)
+            recordings.runs = [{'file': f} for f in
+                               recording_filenames(directory)]
+        return recordings
+
+    def verify(self):
+        """
+        Check that every recording is there and matches its checksum
+
+        :return: List of the recordings that don't
+        """
+        bad = []
+        for run, filename in zip(self.runs, self.filenames()):
+            if not _verify_run(filename, run.get('sha256')):
+                bad.append(filename)
+        return bad
+
+    def load_traces(self, jobs=None, verify=True):
+        """
+        Load every run into a TraceTable, a run per process
+
+        The runs are loaded ahead in the pool (at most jobs of them), each
+        into its own temporary directory (share()d), and handed over one at a
+        time (memory-mapped), so that only the run being used is in memory,
+        and nothing big goes through the pool's pipes.
+
+        :param jobs: Number of processes (default: one per core, 1 loads them
+        here, one after the other)
+        :param verify: Check the checksums of the recordings while loading
+        them
+        :return: Generator of TraceTables, in the order of the runs
+        """
+        work = [(filename, run.get('sha256') if verify else None)
+                for run, filename in zip(self.runs, self.filenames())]
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+        jobs = max(1, min(jobs, len(work)))
+        logger.info("Loading %d runs (%d jobs)" % (len(work), jobs))
+        if jobs == 1:
+            for w in work:
+                yield _load_run(w)
+            return
+
+        directory = tempfile.mkdtemp(prefix="pretender-runs-")
+        pool = multiprocessing.Pool(jobs)
+        try:
+            work = collections.deque(
+                (filename, checksum, os.path.join(directory, str(i)))
+                for i, (filename, checksum) in enumerate(work))
+            loading = collections.deque()
+            while work or loading:
+                # (No more than jobs runs are in the directory, besides the
+                # one being used)
+                while work and len(loading) < jobs:
+                    loading.append(pool.apply_async(_share_run,
+                                                    (work.popleft(),)))
+                # (A timeout so that a KeyboardInterrupt gets through)
+                shared = loading.popleft().get(2 ** 31)
+                if work:
+                    loading.append(pool.apply_async(_share_run,
+                                                    (work.popleft(),)))
+                yield TraceTable.open_shared(shared)
+                # (Still mapped if anybody kept it, but we're done with it)
+                shutil.rmtree(os.path.dirname(shared['files']['records']),
+                              True)
+        finally:
+            pool.terminate()
+            pool.join()
+            shutil.rmtree(directory, True)
+
+
+def _verify_run(filename, checksum):
+    if not os.path.exists(filename):
+        logger.error("Recording %s is missing" % filename)
+        return False
+    if checksum is not None and file_checksum(filename) != checksum:
+        logger.error("Recording %s does not match its checksum" % filename)
+        return False
+    return True
+
+
+def _load_run(work):
+    """ Load one run (in a worker process) """
+    filename, checksum = work
+    if not _verify_run(filename, checksum):
+        raise ValueError("Bad recording %s" % filename)
+    trace = TraceTable.load(filename)
+    # Sort it by address while we are in parallel, training needs it anyway
+    trace.build_address_index()
+    return trace
+
+
+def _share_run(work):
+    """
+    Load one run, and share() it in a directory (in a worker process)
+
+    :return: Handle for TraceTable.open_shared()
+    """
+    filename, checksum, directory = work
+    trace = _load_run((filename, checksum))
+    os.mkdir(directory)
+    return trace.share(directory)
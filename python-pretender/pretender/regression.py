@@ -0,0 +1,276 @@
+"""
+Least-squares lines, in NumPy.
+
+A straight line only needs a few sums of the points (their means, and the
+centered sums of squares and products), so a LinearFit keeps those.  The
+leave-one-out (externally studentized) residuals of every point then come from
+the diagonal of the hat matrix, which for a line is 1/n + (x - mean x)^2 / Sxx,
+and points are taken out of a fit by subtracting their sums, without going
+through the rest of the points again.
+
+The outlier test and the line statistics are the ones we used to get from
+statsmodels (OLS.outlier_test(), Bonferroni-corrected) and scipy
+(stats.linregress()).
+"""
+import logging
+import math
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+
+def _betacf(a, b, x, iterations=200, eps=3e-16):
+    """ Continued fraction of the incomplete beta function (Lentz) """
+    tiny = 1e-300
+    c = 1.0
+    d = 1.0 - (a + b) * x / (a + 1.0)
+    if abs(d) < tiny:
+        d = tiny
+    d = 1.0 / d
+    h = d
+    for m in xrange(1, iterations + 1):
+        m2 = 2 * m
+        aa = m * (b - m) * x / ((a + m2 - 1.0) * (a + m2))
+        d = 1.0 + aa * d
+        if abs(d) < tiny:
+            d = tiny
+        c = 1.0 + aa / c
+        if abs(c) < tiny:
+            c = tiny
+        d = 1.0 / d
+        h *= d * c
+        aa = -(a + m) * (a + b + m) * x / ((a + m2) * (a + m2 + 1.0))
+        d = 1.0 + aa * d
+        if abs(d) < tiny:
+            d = tiny
+        c = 1.0 + aa / c
+        if abs(c) < tiny:
+            c = tiny
+        d = 1.0 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1.0) < eps:
+            break
+    return h
+
+
+def betainc(a, b, x):
+    """
+    Regularized incomplete beta function I_x(a, b)
+
+    :param a:
+    :param b:
+    :param x: 0 <= x <= 1
+    :return:
+    """
+    if x <= 0.0:
+        return 0.0
+    if x >= 1.0:
+        return 1.0
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) +
+                     a * math.log(x) + b * math.log1p(-x))
+    if x < (a + 1.0) / (a + b + 2.0):
+        return front * _betacf(a, b, x) / a
+    return 1.0 - front * _betacf(b, a, 1.0 - x) / b
+
+
+def t_pvalue(t, df):
+    """
+    Two-sided p-value of a Student's t statistic
+
+    :param t:
+    :param df: Degrees of freedom
+    :return: 2 * P(T > |t|)
+    """
+    if math.isinf(t):
+        return 0.0
+    df = float(df)
+    return betainc(df / 2, 0.5, df / (df + t * t))
+
+
+def t_critical(p, df, iterations=200):
+    """
+    The |t| whose two-sided p-value is p (the inverse of t_pvalue())
+
+    :param p:
+    :param df: Degrees of freedom
+    :return: t^2 (so that statistics can be compared without a square root)
+    """
+    # t_pvalue() is I_z(df/2, 1/2), with z = df / (df + t^2), and I_z goes
+    # up with z, so look for z (well, log z: it gets tiny)
+    low, high = math.log(1e-300), 0.0
+    for _ in xrange(iterations):
+        log_z = (low + high) / 2
+        if betainc(df / 2.0, 0.5, math.exp(log_z)) < p:
+            low = log_z
+        else:
+            high = log_z
+        if high - low < 1e-15:
+            break
+    return df * (math.exp(-high) - 1.0)
+
+
+class LinearFit(object):
+    """
+    Least-squares line y = intercept + slope * x through a set of points
+    """
+
+    def __init__(self, x, y):
+        """
+        :param x:
+        :param y:
+        """
+        x = numpy.asarray(x, dtype=numpy.float64)
+        y = numpy.asarray(y, dtype=numpy.float64)
+        self.n = len(x)
+        self.mean_x, self.mean_y, self.sxx, self.sxy, self.syy = \
+            self._sums(x, y)
+
+    def __repr__(self):
+        return "<LinearFit y = %f*X + %f (%d points)>" % (
+            self.slope, self.intercept, self.n)
+
+    @staticmethod
+    def _sums(x, y):
+        if len(x) == 0:
+            return 0.0, 0.0, 0.0, 0.0, 0.0
+        mean_x = x.mean()
+        mean_y = y.mean()
+        dx = x - mean_x
+        dy = y - mean_y
+        return (float(mean_x), float(mean_y), float(numpy.dot(dx, dx)),
+                float(numpy.dot(dx, dy)), float(numpy.dot(dy, dy)))
+
+    @property
+    def slope(self):
+        if self.sxx <= 0:
+            return 0.0
+        return self.sxy / self.sxx
+
+    @property
+    def intercept(self):
+        return self.mean_y - self.slope * self.mean_x
+
+    def remove(self, x, y):
+        """
+        Take points out of the fit
+
+        :param x:
+        :param y:
+        :return:
+        """
+        x = numpy.asarray(x, dtype=numpy.float64)
+        y = numpy.asarray(y, dtype=numpy.float64)
+        m = len(x)
+        if m == 0:
+            return
+        n = self.n - m
+        if n <= 0:
+            self.n = 0
+            self.mean_x = self.mean_y = 0.0
+            self.sxx = self.sxy = self.syy = 0.0
+            return
+        # The (centered) sums combine as
+        #   S_all = S_kept + S_removed + d_x * d_y * n * m / (n + m)
+        # with d the difference of the two means
+        mean_x, mean_y, sxx, sxy, syy = self._sums(x, y)
+        kept_x = (self.n * self.mean_x - m * mean_x) / n
+        kept_y = (self.n * self.mean_y - m * mean_y) / n
+        dx = mean_x - kept_x
+        dy = mean_y - kept_y
+        weight = float(n) * m / self.n
+        self.sxx = max(0.0, self.sxx - sxx - dx * dx * weight)
+        self.sxy = self.sxy - sxy - dx * dy * weight
+        self.syy = max(0.0, self.syy - syy - dy * dy * weight)
+        self.mean_x = kept_x
+        self.mean_y = kept_y
+        self.n = n
+
+    def residuals(self, x, y):
+        """
+        :param x:
+        :param y:
+        :return: y - (intercept + slope * x)
+        """
+        return (numpy.asarray(y, dtype=numpy.float64) - self.mean_y -
+                self.slope * (numpy.asarray(x, dtype=numpy.float64) -
+                              self.mean_x))
+
+    def leverage(self, x):
+        """
+        :param x:
+        :return: Diagonal of the hat matrix at these points
+        """
+        dx = numpy.asarray(x, dtype=numpy.float64) - self.mean_x
+        return 1.0 / self.n + dx * dx / self.sxx
+
+    def studentized_residuals(self, x, y):
+        """
+        Externally studentized residuals: every residual over the standard
+        error of the fit without that point
+
+        :param x: Points of the fit
+        :param y:
+        :return: numpy array (inf if the rest of the points are on the line,
+        nan if this one is too)
+        """
+        residuals = self.residuals(x, y)
+        sse = numpy.dot(residuals, residuals)
+        kept = 1.0 - self.leverage(x)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            # Error variance of the fit without the point, and its residual
+            # in that fit
+            s2 = (sse - residuals * residuals / kept) / (self.n - 3)
+            return residuals / numpy.sqrt(numpy.maximum(s2, 0.0) * kept)
+
+    def outliers(self, x, y, alpha):
+        """
+        Bonferroni outlier test (like statsmodels' OLS.outlier_test())
+
+        :param x: Points of the fit
+        :param y:
+        :param alpha: Family-wise error rate
+        :return: numpy boolean array, True where the point is an outlier
+        """
+        if self.n <= 3 or self.sxx <= 0:
+            return numpy.zeros(len(x), dtype=bool)
+        t = self.studentized_residuals(x, y)
+        limit = t_critical(alpha / self.n, self.n - 3)
+        with numpy.errstate(invalid='ignore'):
+            return t * t > limit
+
+    def linregress(self, x, y, origin=0.0):
+        """
+        The line, and how well it fits (like scipy.stats.linregress())
+
+        :param x: Points of the fit
+        :param y:
+        :param origin: Where x = 0 is (for the intercept)
+        :return: (slope, intercept, r_value, p_value, std_err)
+        """
+        slope = self.slope
+        intercept = self.mean_y - slope * (self.mean_x - origin)
+        # (From the residuals: the points of a timer are so close to the line
+        # that 1 - r^2 from the sums would mostly be rounding errors)
+        residuals = self.residuals(x, y)
+        sse = float(numpy.dot(residuals, residuals))
+        if self.sxx <= 0 or self.syy <= 0:
+            r = 0.0
+        else:
+            r = math.sqrt(max(0.0, 1.0 - sse / self.syy))
+            r = math.copysign(r, self.sxy)
+        df = self.n - 2
+        if df <= 0:
+            p = 1.0 if self.syy <= 0 else 0.0
+            std_err = 0.0
+        elif self.sxx <= 0:
+            p = 1.0
+            std_err = float('nan')
+        else:
+            std_err = math.sqrt(sse / df / self.sxx)
+            if std_err > 0:
+                p = t_pvalue(slope / std_err, df)
+            else:
+                p = 1.0 if slope == 0 else 0.0
+        return slope, intercept, r, p, std_err
@@ -0,0 +1,100 @@
+"""
+Drawing values with the probabilities that they were observed with.
+
+The Markov models replay a read value (or a pattern, or a number of repeats)
+by drawing it from the distribution they saw while training, on every read
+of the peripheral.  A DiscreteSampler is built once, when the model is
+trained (or merged), so that a draw costs the same no matter how many
+values there are to draw from.
+"""
+import bisect
+import random
+
+
+class DiscreteSampler(object):
+    """
+    Draws one of a number of outcomes, each with a probability proportional
+    to its weight.
+
+    By default it uses an alias table (Vose's alias method): every one of n
+    equally likely slots holds an outcome and, for the rest of its
+    probability, an alias, so that a draw is one random number and one
+    comparison.  With alias=False, it bisects the cumulative weights
+    instead (i.e., inverse transform sampling, which for a given
+    random.random() picks the same outcome that walking the cumulative
+    probabilities in order does).
+    """
+
+    def __init__(self, outcomes, weights, alias=True):
+        """
+        :param outcomes:
+        :param weights: Weight of each outcome (e.g., how many times it was
+        observed)
+        :param alias: Build an alias table (else, bisect)
+        """
+        self.outcomes = list(outcomes)
+        weights = [float(w) for w in weights]
+        if len(self.outcomes) != len(weights):
+            raise ValueError("%d outcomes but %d weights" % (
+                len(self.outcomes), len(weights)))
+        total = sum(weights)
+        if not self.outcomes or total <= 0:
+            raise ValueError("Nothing to sample from")
+
+        self.probabilities = [w / total for w in weights]
+        self.alias = None
+        self.cumulative = None
+        if alias:
+            self._build_alias_table()
+        else:
+            self.cumulative = []
+            cumulative_probability = 0.0
+            for probability in self.probabilities:
+                cumulative_probability += probability
+                self.cumulative.append(cumulative_probability)
+
+    def _build_alias_table(self):
+        n = len(self.outcomes)
+        if n == 1:
+            self.keep = [1.0]
+            self.alias = [0]
+            return
+        scaled = [p * n for p in self.probabilities]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        # Probability of keeping the slot's own outcome, and its alias
+        self.keep = [1.0] * n
+        self.alias = range(n)
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.keep[less] = scaled[less]
+            self.alias[less] = more
+            # The alias gave the rest of the slot, take it out of its share
+            scaled[more] += scaled[less] - 1.0
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        # (Whatever is left is 1 up to rounding errors)
+
+    def __len__(self):
+        return len(self.outcomes)
+
+    def __repr__(self):
+        return "<DiscreteSampler %s>" % ", ".join(
+            "%r: %.3f" % (o, p) for o, p in zip(self.outcomes,
+                                                self.probabilities))
+
+    def sample(self):
+        """ Draw an outcome """
+        if self.alias is None:
+            i = bisect.bisect_right(self.cumulative, random.random())
+            # (The last cumulative probability may be a hair under 1)
+            return self.outcomes[min(i, len(self.outcomes) - 1)]
+
+        u = random.random() * len(self.outcomes)
+        i = int(u)
+        if u - i < self.keep[i]:
+            return self.outcomes[i]
+        return self.outcomes[self.alias[i]]
@@ -0,0 +1,316 @@
+"""
+In-memory, columnar view of a recording that is shared by every training
+stage, so that a trace only has to be read and parsed once.
+"""
+import logging
+import os
+
+import numpy
+
+from pretender.logger import LogReader, TraceIndex, index_filename, \
+    records_to_rows, RECORD_DTYPE, OP_CODES, OP_READ, OP_WRITE, OP_RUN
+
+logger = logging.getLogger(__name__)
+
+
+def fold_runs(records):
+    """
+    Fold every RUN row into the READ row just before it
+
+    :param records: numpy structured array of RECORD_DTYPE
+    :return: (records without RUN rows, number of reads per row, timestamp
+    of the last read per row, old row number -> new row number (or None if
+    nothing was folded))
+    """
+    count = numpy.ones(len(records), dtype=numpy.uint32)
+    runs = numpy.flatnonzero(records['op'] == OP_RUN)
+    if len(runs) == 0:
+        return records, count, records['timestamp'], None
+
+    reads = runs - 1
+    valid = reads >= 0
+    valid[valid] = (records['op'][reads[valid]] == OP_READ) & \
+                   (records['addr'][reads[valid]] ==
+                    records['addr'][runs[valid]])
+    if not valid.all():
+        logger.warning("Ignoring %d RUN rows without a READ before them" %
+                       (len(runs) - valid.sum()))
+    runs = runs[valid]
+    reads = reads[valid]
+
+    last_timestamp = records['timestamp'].copy()
+    last_timestamp[reads] = records['timestamp'][runs]
+    count[reads] = records['seq'][runs] - records['seq'][reads] + 1
+
+    keep = records['op'] != OP_RUN
+    row_map = numpy.cumsum(keep) - 1
+    row_map[~keep] = -1
+    return records[keep], count[keep], last_timestamp[keep], row_map
+
+
+class TraceTable(object):
+    """
+    A recording stored as typed numpy columns (op, seq, addr, val, pc, size,
+    timestamp), with lazily-built row indices per address and per operation.
+
+    Binary traces can be memory-mapped, in which case only the rows that are
+    actually touched are ever paged in.
+
+    Runs of identical reads (RUN rows) are folded into the READ that started
+    them: its count column says how many reads it stands for and its
+    last_timestamp column when the last one happened.
+    """
+
+    def __init__(self, records, filename=None, count=None,
+                 last_timestamp=None):
+        """
+        :param records: numpy structured array of RECORD_DTYPE
+        :param filename: Where this trace came from (informational)
+        :param count: Reads per row, if the runs are already folded
+        :param last_timestamp: Timestamp of the last read per row, if the
+        runs are already folded
+        """
+        self.row_map = None
+        if count is None:
+            records, count, last_timestamp, self.row_map = fold_runs(records)
+        self.records = records
+        self.filename = filename
+        self.count = count
+        self.last_timestamp = last_timestamp
+        self.op = records['op']
+        self.seq = records['seq']
+        self.addr = records['addr']
+        self.val = records['val']
+        self.pc = records['pc']
+        self.size = records['size']
+        self.timestamp = records['timestamp']
+
+        self._address_order = None
+        self._address_index = None
+        self._op_index = {}
+
+    def __repr__(self):
+        return "<TraceTable %s (%d rows)>" % (self.filename, len(self))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return self.rows()
+
+    @classmethod
+    def load(cls, filename, mmap=False):
+        """
+        Load a recording (tab-separated or binary) into a TraceTable
+
+        :param filename:
+        :param mmap: Memory-map binary traces instead of reading them
+        :return:
+        """
+        logger.info("Loading trace %s" % filename)
+        l = LogReader(filename)
+        records = l.read_array(mmap=mmap)
+        l.close()
+        trace = cls(records, filename=filename)
+
+        # Did the recorder leave us an index?
+        index = TraceIndex.load(index_filename(filename))
+        if index is not None:
+            if index.rows == len(records):
+                trace.use_index(index)
+            else:
+                logger.warning("Index for %s does not match the trace (%d != "
+                               "%d rows), ignoring it" % (filename, index.rows,
+                                                          len(records)))
+        return trace
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build a TraceTable from log rows (op, seq, addr, val, pc, size,
+        timestamp)
+
+        :param rows:
+        :return:
+        """
+        records = numpy.array([(OP_CODES[op], int(size), 0, int(addr),
+                                int(val), int(pc), int(seq), int(timestamp))
+                               for op, seq, addr, val, pc, size, timestamp
+                               in rows], dtype=RECORD_DTYPE)
+        return cls(records)
+
+    def share(self, directory):
+        """
+        Dump the (folded) columns and the address index into a directory, so
+        that other processes can memory-map the trace instead of getting a
+        pickled copy of it
+
+        :param directory: Where to put the arrays (e.g., a temporary
+        directory, which the caller removes once every process is done)
+        :return: Handle (small, and picklable) for open_shared()
+        """
+        self.build_address_index()
+        arrays = {'records': self.records,
+                  'count': self.count,
+                  'last_timestamp': self.last_timestamp,
+                  'address_order': self._address_order}
+        files = {}
+        for name, array in arrays.items():
+            files[name] = os.path.join(directory, "%s.npy" % name)
+            numpy.save(files[name], array)
+        return {'filename': self.filename,
+                'files': files,
+                'address_index': self._address_index}
+
+    @classmethod
+    def open_shared(cls, shared):
+        """
+        Memory-map a trace that another process share()d
+
+        :param shared: Handle returned by share()
+        :return: Read-only TraceTable
+        """
+        arrays = {}
+        for name, filename in shared['files'].items():
+            arrays[name] = numpy.load(filename, mmap_mode='r')
+        trace = cls(arrays['records'], filename=shared['filename'],
+                    count=arrays['count'],
+                    last_timestamp=arrays['last_timestamp'])
+        trace._address_order = arrays['address_order']
+        trace._address_index = shared['address_index']
+        return trace
+
+    def select(self, rows):
+        """
+        Return a new TraceTable with only the given rows (indices or mask)
+
+        :param rows:
+        :return:
+        """
+        return TraceTable(self.records[rows], filename=self.filename,
+                          count=self.count[rows],
+                          last_timestamp=self.last_timestamp[rows])
+
+    def rows(self, indices=None, chunk_size=65536, runs=False):
+        """
+        Iterate over (op, seq, addr, val, pc, size, timestamp) tuples with
+        native Python values, optionally restricted to the given row indices
+
+        :param indices:
+        :param chunk_size: Number of rows converted from numpy at a time
+        :param runs: Also include the number of reads and the last timestamp
+        of each row, i.e., (op, ..., timestamp, count, last_timestamp)
+        :return:
+        """
+        total = len(self) if indices is None else len(indices)
+        for start in xrange(0, total, chunk_size):
+            if indices is None:
+                chunk = slice(start, start + chunk_size)
+            else:
+                chunk = indices[start:start + chunk_size]
+            if runs:
+                rows = records_to_rows(self.records[chunk], self.count[chunk],
+                                       self.last_timestamp[chunk])
+            else:
+                rows = records_to_rows(self.records[chunk])
+            for row in rows:
+                yield row
+
+    def _build_address_index(self):
+        # A stable sort keeps the rows of each address in trace order
+        self._address_order = numpy.argsort(self.addr, kind='mergesort')
+        keys, starts, counts = numpy.unique(self.addr[self._address_order],
+                                            return_index=True,
+                                            return_counts=True)
+        self._address_index = {}
+        for key, start, count in zip(keys.astype(numpy.int64).tolist(),
+                                     starts.tolist(),
+                                     counts.tolist()):
+            self._address_index[key] = (start, start + count)
+
+    def build_address_index(self):
+        """ Build the per-address index now, instead of on first use """
+        if self._address_index is None:
+            self._build_address_index()
+
+    def use_index(self, index):
+        """
+        Use the row numbers of a sidecar TraceIndex instead of sorting the
+        address column ourselves
+
+        :param index:
+        :return:
+        """
+        keys = {}
+        for table in [index.addresses, index.irqs]:
+            for key, rows in table.items():
+                rows = numpy.asarray(rows)
+                if self.row_map is not None:
+                    # The index counts the RUN rows that we folded
+                    rows = self.row_map[rows]
+                    rows = rows[rows >= 0]
+                keys.setdefault(key, []).append(rows)
+        order = []
+        self._address_index = {}
+        start = 0
+        for key in sorted(keys):
+            rows = keys[key]
+            rows = rows[0] if len(rows) == 1 else numpy.sort(
+                numpy.concatenate(rows))
+            order.append(rows)
+            self._address_index[key] = (start, start + len(rows))
+            start += len(rows)
+        if order:
+            self._address_order = numpy.concatenate(order)
+        else:
+            self._address_order = numpy.zeros(0, dtype=numpy.intp)
+
+    def address_rows(self, address):
+        """
+        Row indices (in trace order) of every event at this address.
+
+        NOTE: ENTER/EXIT events store their IRQ number in the address column
+
+        :param address:
+        :return:
+        """
+        if self._address_index is None:
+            self._build_address_index()
+        if address not in self._address_index:
+            return numpy.zeros(0, dtype=numpy.intp)
+        start, end = self._address_index[address]
+        return self._address_order[start:end]
+
+    def rows_for_addresses(self, addresses):
+        """
+        Row indices (in trace order) of every event at any of these addresses
+
+        :param addresses:
+        :return:
+        """
+        rows = [self.address_rows(a) for a in addresses]
+        if not rows:
+            return numpy.zeros(0, dtype=numpy.intp)
+        return numpy.sort(numpy.concatenate(rows))
+
+    def op_rows(self, op):
+        """
+        Row indices (in trace order) of every event of this operation
+
+        :param op: Operation name (e.g., "READ") or code
+        :return:
+        """
+        if op in OP_CODES:
+            op = OP_CODES[op]
+        if op not in self._op_index:
+            self._op_index[op] = numpy.flatnonzero(self.op == op)
+        return self._op_index[op]
+
+    def accessed_addresses(self):
+        """
+        Return the set of addresses that were read or written
+
+        :return:
+        """
+        mask = (self.op == OP_READ) | (self.op == OP_WRITE)
+        return set(numpy.unique(self.addr[mask].astype(numpy.int64)).tolist())
@@ -0,0 +1,368 @@
+"""
+Single-pass training.
+
+Rather than scanning the whole trace once to find the interrupts, and then
+once more for every peripheral, a TrainingPass streams the trace once: every
+memory access is routed (through a PeripheralMap) to the
+state builder of the peripheral it belongs to, and the writes and interrupt
+ENTER/EXITs are fed to an InterruptAccumulator at the same time.
+
+Peripherals can also be trained in a pool of processes (train_peripherals()),
+which memory-map the trace rather than each getting a pickled copy of it, and
+whose models are then fitted by a FitScheduler.
+"""
+import logging
+import multiprocessing
+import shutil
+import tempfile
+from collections import defaultdict
+
+import numpy
+
+from pretender.clock import to_seconds
+from pretender.fitting import FitScheduler
+from pretender.peripheral_map import PeripheralMap
+from pretender.trace import TraceTable
+
+logger = logging.getLogger(__name__)
+
+
+class InterruptAccumulator(object):
+    """
+    Incrementally infers the interrupt association of a trace, i.e., which
+    peripheral cluster each IRQ belongs to, what triggers it, and how often
+    it fires.
+
+    Everything is gathered in a single sweep over the trace: a stack of the
+    interrupt handlers that are running cuts out the events of every handler
+    invocation (nested interrupts get their own events, not their parent's),
+    and the first ENTER of every IRQ remembers the last write to each
+    peripheral cluster (the trigger candidates), whose values are then
+    counted at every later ENTER.  finish() only has to look at the (small)
+    per-IRQ summaries, never at the trace again.
+    """
+
+    def __init__(self, peripheral_clusters, associate_with_cluster):
+        """
+        :param peripheral_clusters: Previously-extracted peripheral map
+        :param associate_with_cluster: Function (activity, clusters) ->
+        cluster number that votes for the cluster an ISR belongs to
+        """
+        self.peripheral_clusters = peripheral_clusters
+        self.associate_with_cluster = associate_with_cluster
+        self.peripheral_map = PeripheralMap.from_clusters(peripheral_clusters)
+
+        # Invocations of every IRQ: {'time', 'trace', 'counts', 'span'}
+        self.isr_activity = {}
+        # Handlers that haven't seen their EXIT yet, innermost last:
+        # (ENTER event, row, ISR instance)
+        self._stack = []
+
+        # Last value written to each address, and the addresses that were
+        # ever read with a different value than that
+        self._written = {}
+        self.read_mismatches = set()
+        # Every write to a peripheral: address -> [(row, value, timestamp)]
+        self.writes = defaultdict(list)
+        # Last write to each cluster (never the very first event of the
+        # trace): cluster -> (address, value)
+        self._last_cluster_write = {}
+
+        # Per IRQ: the last write to each cluster before its first ENTER,
+        # how often each value of those addresses was there at an ENTER, and
+        # (row, op, timestamp) of its ENTERs and EXITs
+        self.preceding_writes = {}
+        self.trigger_values = {}
+        self.irq_events = defaultdict(list)
+
+    def feed(self, row, op, addr, val, timestamp, event, count=1):
+        """
+        Account for the next event of the trace
+
+        :param row: Row number in the trace
+        :param op:
+        :param addr:
+        :param val:
+        :param timestamp:
+        :param event: The (op, seq, addr, val, pc, size, timestamp) row
+        :param count: Number of reads that the row stands for
+        :return:
+        """
+        if op == 'READ':
+            if val != self._written.get(addr):
+                self.read_mismatches.add(addr)
+        elif op == 'WRITE':
+            self._written[addr] = val
+            self.writes[addr].append((row, val, timestamp))
+            cluster = self.peripheral_map.lookup(addr)
+            if cluster != -1 and row > 0:
+                self._last_cluster_write[cluster] = (addr, val)
+
+        # Step 1: Cut out an interrupt handler's worth of stuff.  The events
+        # go to the innermost handler that is running.
+        if op == 'ENTER':
+            self._enter(row, addr, timestamp, event)
+        elif op == 'EXIT':
+            self._exit(row, addr, timestamp)
+        elif self._stack:
+            isr_instance = self._stack[-1][2]
+            isr_instance['trace'].append(event)
+            isr_instance['counts'].append(count)
+
+    def _enter(self, row, irq_num, timestamp, event):
+        self.irq_events[irq_num].append((row, 'ENTER', timestamp))
+        # Which value did each trigger candidate have when it fired?
+        if irq_num not in self.preceding_writes:
+            self.preceding_writes[irq_num] = dict(self._last_cluster_write)
+            self.trigger_values[irq_num] = defaultdict(
+                lambda: defaultdict(int))
+        trigger_values = self.trigger_values[irq_num]
+        for address, _ in self.preceding_writes[irq_num].values():
+            trigger_values[address][self._written.get(address)] += 1
+        self._stack.append((event, row, {'trace': [], 'counts': []}))
+
+    def _exit(self, row, irq_num, timestamp):
+        self.irq_events[irq_num].append((row, 'EXIT', timestamp))
+        # Normally the innermost handler is the one that returns, but we may
+        # have missed some EXITs
+        for depth in xrange(len(self._stack) - 1, -1, -1):
+            if self._stack[depth][0][2] == irq_num:
+                break
+        else:
+            logger.debug("EXIT of IRQ %d, which wasn't entered" % irq_num)
+            return
+        for enter, enter_row, isr_instance in self._stack[depth + 1:]:
+            logger.warning("Mismatched ISR enter %s" % repr(enter))
+        enter, enter_row, isr_instance = self._stack[depth]
+        del self._stack[depth:]
+        isr_instance['time'] = timestamp - enter[6]
+        isr_instance['span'] = (enter_row, row)
+        self.isr_activity.setdefault(irq_num, []).append(isr_instance)
+
+    def finish(self):
+        """
+        Finish the inference, once the whole trace was fed
+
+        :return: (interrupt mapping, triggers, timings, oneshots), like
+        PretenderModel.infer_interrupt_association()
+        """
+        peripheral_clusters = self.peripheral_clusters
+        interrupt_mapping = {}
+        oneshots = []
+
+        for enter, enter_row, isr_instance in self._stack:
+            # Mismatched enter
+            logger.warning("Mismatched ISR enter %s" % repr(enter))
+        self._stack = []
+
+        # Step 2: Let's figure out what peripheral cluster it goes to
+        # We use a tiered voting thingy, each ISR invocation has a bunch of MMIO accesses in it.
+        # We vote based on the MMIO accesses that belong to a given cluster, and vote based on
+        # all ISR invocations as well
+        for isr_num, activity in self.isr_activity.items():
+            logger.debug("Associating ISR %d" % isr_num)
+            cluster_number = self.associate_with_cluster(activity,
+                                                         self.peripheral_map)
+            if cluster_number == -1:
+                logger.warning(
+                    "Could not associate IRQ %d to a peripheral" % isr_num)
+                continue
+            logger.info("I think IRQ %d belongs in cluster %d: %s" % (
+                isr_num, cluster_number,
+                repr(peripheral_clusters[cluster_number])))
+            interrupt_mapping[cluster_number] = isr_num
+
+        # Step 3: Can we find a trigger?  It's the write to the peripheral
+        # closest to the first ENTER.
+        irq_triggers = {}
+        for cluster, irq_num in interrupt_mapping.items():
+            logger.info("Finding a trigger for interrupt %d" % irq_num)
+            trigger = self.preceding_writes.get(irq_num, {}).get(cluster)
+            if not trigger or not trigger[0]:
+                logger.info("Could not find a trigger for IRQ %d", irq_num)
+                continue
+            trigger_addr, trigger_val = trigger
+            logger.info(
+                "Found trigger for IRQ %d at address %#08x with value %#08x" % (
+                    irq_num, trigger_addr, trigger_val))
+            if trigger_addr in self.read_mismatches:
+                logger.warn("UH OH, one-shot detected for interrupt %d" %
+                            irq_num)
+                oneshots.append(irq_num)
+            # Now refine the bitpattern
+            trigger_vals = self.trigger_values[irq_num][trigger_addr]
+            logger.debug(repr(dict(trigger_vals)))
+            real_val = 0x00000000
+            for val, onoff in trigger_vals.items():
+                if onoff > 0:
+                    real_val |= val
+                else:
+                    real_val ^= val
+            logger.info("Refined trigger value is %#08x" % real_val)
+            irq_triggers[irq_num] = (trigger_addr, real_val)
+
+        # Step 4: Timing-based stuff
+        interrupt_timings = {}  # Map of interrupt_number to inter-interrupt timings.
+        for peripheral_cluster, irq_num in interrupt_mapping.items():
+            if not irq_triggers.has_key(irq_num):
+                continue
+            trigger_addr, trigger_val = irq_triggers[irq_num]
+            timings = self._interrupt_timings(irq_num, trigger_addr,
+                                              trigger_val)
+            logger.info("Got timings for interrupt %d" % (irq_num))
+            logger.info("Mean: %f" % numpy.mean(timings))
+            logger.info("Stdv: %f" % numpy.std(timings))
+            interrupt_timings[irq_num] = timings
+
+        return interrupt_mapping, irq_triggers, interrupt_timings, oneshots
+
+    def _interrupt_timings(self, irq_num, trigger_addr, trigger_val):
+        """
+        Collect the EXIT-to-ENTER timings, plus the initial trigger-to-enter
+        timing, of an interrupt (skipping the ones while it was turned off),
+        from its ENTERs and EXITs and the writes to its trigger
+
+        :return: The timings, in seconds
+        """
+        trigger_writes = self.writes[trigger_addr]
+        for x in xrange(len(trigger_writes)):
+            if trigger_writes[x][1] == trigger_val:
+                trigger_row, _, prev_time = trigger_writes[x]
+                break
+        else:
+            # Bug.
+            raise RuntimeError("Bug related to trigger-finding")
+
+        # Both are in trace order, walk them together
+        events = [(row, 'WRITE', timestamp, val) for row, val, timestamp in
+                  trigger_writes[x + 1:]]
+        events += [(row, op, timestamp, None) for row, op, timestamp in
+                   self.irq_events[irq_num] if row > trigger_row]
+        events.sort()
+
+        timings = []
+        disabled = False
+        entered = False
+        for row, op, timestamp, val in events:
+            if op == "ENTER":
+                if not disabled:
+                    timings.append(timestamp - prev_time)
+                    entered = True
+            elif op == 'EXIT':
+                if entered:
+                    prev_time = timestamp
+                    entered = False
+            elif val != trigger_val:
+                logger.debug("Interrupt disabled by write of %#08x" % val)
+                disabled = True
+                # I think we just turned it off.
+            else:
+                logger.debug("Turned on via write to trigger")
+                disabled = False
+        # The trace has integer nanoseconds, the interrupters sleep in
+        # seconds
+        return [to_seconds(t) for t in timings]
+
+
+class TrainingPass(object):
+    """
+    Trains the state machines of a set of peripherals, and infers their
+    interrupts, in a single pass over a trace
+    """
+
+    def __init__(self, peripherals, peripheral_clusters,
+                 associate_with_cluster):
+        """
+        :param peripherals: {cluster number: PeripheralModel}
+        :param peripheral_clusters: {cluster number: addresses}
+        :param associate_with_cluster: See InterruptAccumulator
+        """
+        self.builders = {}
+        for cluster, peripheral in peripherals.items():
+            self.builders[cluster] = peripheral.state_builder()
+        self.interrupts = InterruptAccumulator(peripheral_clusters,
+                                               associate_with_cluster)
+
+    def run(self, trace):
+        """
+        Stream the trace through the state builders and the interrupt
+        accumulator
+
+        :param trace: TraceTable
+        :return:
+        """
+        interrupts = self.interrupts
+        # Which peripheral every row belongs to, looked up all at once
+        route = [self.builders.get(cluster) for cluster in
+                 self.interrupts.peripheral_map.lookup_array(
+                     trace.addr).tolist()]
+        for row, event in enumerate(trace.rows(runs=True)):
+            op, id, addr, val, pc, size, timestamp, count, last_timestamp = \
+                event
+            if op == 'READ' or op == 'WRITE':
+                builder = route[row]
+                if builder is not None:
+                    builder.feed(op, addr, val, pc, size, timestamp, count,
+                                 last_timestamp)
+            interrupts.feed(row, op, addr, val, timestamp, event[:7], count)
+
+
+def train_peripherals(peripherals, trace, jobs=None):
+    """
+    Train peripherals (whose interrupts are already known) in a pool of
+    processes: their states are built a peripheral per process, and then the
+    models of every state of every peripheral are fitted together, so that a
+    single big peripheral doesn't end up being fitted in one process
+
+    :param peripherals: List of PeripheralModels
+    :param trace: TraceTable
+    :param jobs: Number of processes (default: one per core)
+    :return: List of the trained PeripheralModels, in the same order
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    build_jobs = max(1, min(jobs, len(peripherals)))
+    logger.info("Building %d peripherals (%d jobs)" % (len(peripherals),
+                                                       build_jobs))
+    # Start with the biggest ones, so that a big one isn't left for last
+    sizes = [len(trace.rows_for_addresses(p.addresses)) for p in peripherals]
+    order = sorted(xrange(len(peripherals)), key=lambda i: -sizes[i])
+
+    directory = tempfile.mkdtemp(prefix="pretender-")
+    try:
+        shared = trace.share(directory)
+        work = [(shared, peripherals[i]) for i in order]
+        pool = multiprocessing.Pool(build_jobs)
+        try:
+            # (map_async() so that a KeyboardInterrupt gets through)
+            built = pool.map_async(_build_peripheral, work,
+                                   chunksize=1).get(2 ** 31)
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        shutil.rmtree(directory)
+
+    result = [None] * len(peripherals)
+    for i, peripheral in zip(order, built):
+        result[i] = peripheral
+
+    scheduler = FitScheduler(jobs)
+    for peripheral in result:
+        peripheral.train_states(scheduler)
+    scheduler.run()
+    return result
+
+
+def _build_peripheral(work):
+    """ Build the states of one peripheral (in a worker process) """
+    shared, peripheral = work
+    trace = TraceTable.open_shared(shared)
+    # The same events that a TrainingPass routes to it
+    rows = trace.rows_for_addresses(peripheral.addresses)
+    builder = peripheral.state_builder()
+    for op, id, addr, val, pc, size, timestamp, count, last_timestamp in \
+            trace.rows(rows, runs=True):
+        builder.feed(op, addr, val, pc, size, timestamp, count,
+                     last_timestamp)
+    return peripheral
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+How long does it take to train a MarkovPatternModel on long read logs?
+
+The logs are made up, but look like what we record from a UART: a status
+register that mostly reads "ready" (in long polling runs), now and then
+"busy" for a few reads, and a data register that mostly reads idle, with
+bursts of received bytes.
+"""
+import argparse
+import random
+import time
+
+from pretender.models.markovpattern import MarkovPatternModel
+from pretender.readlog import ReadLog, ReadRun, ReadStats
+
+
+def status_register_log(entries, rng):
+    log = ReadLog()
+    for i in xrange(entries):
+        if rng.random() < 0.7:
+            # Polling until it's ready
+            log.append(ReadRun(0xc0, 0x8000, 4, i, rng.randint(1, 200)))
+        else:
+            log.append((rng.choice([0x00, 0x40, 0x80]), 0x8000, 4, i))
+    return log
+
+
+def uart_data_log(entries, rng, message="Hello World!\r\n"):
+    log = ReadLog()
+    i = 0
+    while i < entries:
+        log.append(ReadRun(0x00, 0x8004, 4, i, rng.randint(1, 50)))
+        i += 1
+        for c in message[:rng.randint(1, len(message))]:
+            log.append((ord(c), 0x8004, 4, i))
+            i += 1
+    return log
+
+
+def bench(name, log, repeat):
+    best_stats = best_train = None
+    for _ in xrange(repeat):
+        start = time.time()
+        stats = ReadStats(log)
+        summarized = time.time()
+        m = MarkovPatternModel()
+        m.train(log, stats)
+        done = time.time()
+        if best_stats is None or summarized - start < best_stats:
+            best_stats = summarized - start
+        if best_train is None or done - summarized < best_train:
+            best_train = done - summarized
+    print "%-16s %10d %12d %10.4f %10.4f %9d %9d" % (
+        name, len(log), stats.total, best_stats, best_train,
+        len(m.static_value_count), len(m.patterns))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", "-n", type=int, action='append',
+                        help="Log entries (default: 10^3 to 10^6)")
+    parser.add_argument("--repeat", "-r", type=int, default=3,
+                        help="Keep the best of this many runs")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print "%-16s %10s %12s %10s %10s %9s %9s" % (
+        "log", "entries", "reads", "stats (s)", "train (s)", "counts",
+        "patterns")
+    for entries in args.entries or [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]:
+        bench("status register", status_register_log(entries, rng),
+              args.repeat)
+        bench("uart data", uart_data_log(entries, rng), args.repeat)
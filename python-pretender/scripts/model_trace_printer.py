@@ -1,17 +1,11 @@
-import os, sys, pickle
+import sys
 
-fn = sys.argv[1]
-addr = int(sys.argv[2], 16)
+from pretender.query import TraceQuery, query, format_rows, model_trace
 
+# Print the trace that the model of an address was trained on
+# Usage: model_trace_printer.py <model> <address>
+# (see bin/pretender-trace for the filters)
 
-with open(fn, 'rb') as f:
-    m = pickle.load(f)
-mdl = m[addr]['model']
-
-for tr in mdl.trace:
-    n_op, n_id, n_addr, n_val, n_pc, n_size, n_timestamp = tr
-    n_addr = hex(n_addr)
-    n_val = hex(n_val)
-    n_pc = hex(n_pc)
-    print "%s %s %s %s %s %s %s" % (n_op, n_id, n_addr, n_val, n_pc, n_size, n_timestamp)
-
+for records in query(model_trace(sys.argv[1], int(sys.argv[2], 16)),
+                     TraceQuery()):
+    sys.stdout.write(format_rows(records))
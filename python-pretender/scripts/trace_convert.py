@@ -0,0 +1,36 @@
+import os, sys
+
+from pretender.logger import convert_log
+import pretender.globals as G
+
+# Convert tab-separated recordings into binary (or, with -z, block-compressed)
+# traces.
+# Usage: trace_convert.py [-z] <recording.tsv|recording_dir> [output.trace]
+
+args = sys.argv[1:]
+if args and args[0] == "-z":
+    extension = G.COMPRESSED_RECORDING_EXTENSION
+    args = args[1:]
+else:
+    extension = G.BINARY_RECORDING_EXTENSION
+
+src = args[0]
+if os.path.isdir(src):
+    pairs = []
+    for fn in sorted(os.listdir(src)):
+        if fn.endswith("." + G.RECORDING_EXTENSION):
+            base = fn[:-len(G.RECORDING_EXTENSION)]
+            pairs.append((os.path.join(src, fn),
+                          os.path.join(src, base + extension)))
+elif len(args) > 1:
+    pairs = [(src, args[1])]
+else:
+    pairs = [(src, os.path.splitext(src)[0] + "." + extension)]
+
+for tsv, trace in pairs:
+    written, skipped = convert_log(tsv, trace)
+    print "%s -> %s (%d rows, %d skipped)" % (tsv, trace, written, skipped)
+    if os.path.dirname(os.path.abspath(tsv)) == \
+            os.path.dirname(os.path.abspath(trace)):
+        # (recording_filenames() only picks up one of them)
+        print "  (%s is now ignored when training on its directory)" % tsv
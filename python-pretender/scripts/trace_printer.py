@@ -1,13 +1,11 @@
+import sys
 
-import sys, os, re
+from pretender.query import TraceQuery, query, format_rows
 
-# WRITE   72  1073744952  3812    134219732   4   1516661108.333252 
-
-with open(sys.argv[1]) as f:
-    for line in f.read().splitlines():
-        stuff = line.split()
-        stuff[2] = hex(int(stuff[2]))
-        stuff[3] = hex(int(stuff[3]))
-        stuff[4] = hex(int(stuff[4]))
-        print "\t".join(stuff)
+# WRITE   72  0x40000c38  0xee4   0x80006d4   4   1000046222212
+# Usage: trace_printer.py <recording> [address ...]
+# (see bin/pretender-trace for the other filters)
 
+addresses = [(int(a, 16), int(a, 16)) for a in sys.argv[2:]]
+for records in query(sys.argv[1], TraceQuery(addresses=addresses)):
+    sys.stdout.write(format_rows(records))